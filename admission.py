@@ -0,0 +1,237 @@
+"""
+Admission control: per-model concurrency limits with a bounded priority queue
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+PRIORITY_CLASSES = {"interactive": 0, "default": 5, "batch": 10}
+
+
+class AdmissionRejected(Exception):
+    """Base class for requests turned away by admission control"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionRejected):
+    pass
+
+
+class QueueTimeoutError(AdmissionRejected):
+    pass
+
+
+def parse_priority(value: Optional[str], default: int) -> int:
+    """Accept a priority class name or an integer (lower runs first)"""
+    if value is None or value == "":
+        return default
+    value = value.strip().lower()
+    if value in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value]
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+class Ticket:
+    """An admitted slot; release() is idempotent"""
+
+    __slots__ = ("gate", "waited", "admitted_at", "released")
+
+    def __init__(self, gate: "ModelGate", waited: float):
+        self.gate = gate
+        self.waited = waited
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.gate.observe_service_time(time.monotonic() - self.admitted_at)
+            self.gate.release()
+
+
+class ModelGate:
+    """Concurrency limit for one model with a priority-ordered wait queue"""
+
+    def __init__(self, model: str, concurrency: int, max_queue: int, queue_timeout: float):
+        self.model = model
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: List[list] = []
+        self._queued = 0
+        self._seq = itertools.count()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        # EWMA of slot hold time, used to suggest Retry-After
+        self.service_time = 1.0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and self._queued == 0
+
+    def retry_after(self) -> int:
+        backlog = (self._queued + 1) / max(self.concurrency, 1)
+        return max(1, math.ceil(backlog * self.service_time))
+
+    async def acquire(self, priority: int) -> Ticket:
+        start = time.monotonic()
+        if self.active < self.concurrency and not self._queued:
+            self.active += 1
+            return self._admit(start)
+
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(f"Queue for model {self.model} is full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(entry)
+            self.timeouts += 1
+            raise QueueTimeoutError(
+                f"Timed out after {self.queue_timeout:.1f}s waiting for model {self.model}", self.retry_after()
+            )
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        return self._admit(start)
+
+    def _abandon(self, entry: list) -> None:
+        future = entry[2]
+        if future.done() and not future.cancelled():
+            # The slot was handed over just as we gave up; pass it on
+            self.release()
+            return
+        future.cancel()
+        self._queued -= 1
+
+    def _admit(self, start: float) -> Ticket:
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return Ticket(self, waited)
+
+    def release(self) -> None:
+        """Hand the slot to the highest-priority waiter, or free it"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self._queued -= 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def observe_service_time(self, seconds: float) -> None:
+        self.service_time = 0.8 * self.service_time + 0.2 * seconds
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": self._queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "wait_seconds_avg": round(self.wait_seconds_total / self.admitted, 6) if self.admitted else 0.0,
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+            "service_time_ewma": round(self.service_time, 6),
+        }
+
+
+class AdmissionController:
+    """Per-model gates created on demand
+
+    The model name comes from the client, so at most `max_gates` gates are kept: once
+    that many exist, idle gates are dropped, least recently used first, before a new
+    one is created. Gates with requests active or queued are never dropped.
+    """
+
+    def __init__(self, default_concurrency: int, max_queue: int, queue_timeout: float,
+                 model_concurrency: Optional[Dict[str, int]] = None, max_gates: int = 256):
+        self.default_concurrency = default_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.model_concurrency = model_concurrency or {}
+        self.max_gates = max_gates
+        # Insertion order doubles as recency: a gate is moved to the end on every use
+        self.gates: Dict[str, ModelGate] = {}
+        self.evicted = 0
+
+    @staticmethod
+    def parse_model_limits(spec: str) -> Dict[str, int]:
+        """Parse "model=N,model=N" overrides"""
+        limits = {}
+        for item in spec.split(","):
+            model, sep, limit = item.strip().rpartition("=")
+            if sep and model:
+                limits[model] = int(limit)
+        return limits
+
+    @property
+    def enabled(self) -> bool:
+        return self.default_concurrency > 0 or any(v > 0 for v in self.model_concurrency.values())
+
+    def gate(self, model: str) -> Optional[ModelGate]:
+        gate = self.gates.pop(model, None)
+        if gate is None:
+            concurrency = self.model_concurrency.get(model, self.default_concurrency)
+            if concurrency <= 0:
+                return None
+            self._evict_idle()
+            gate = ModelGate(model, concurrency, self.max_queue, self.queue_timeout)
+        self.gates[model] = gate
+        return gate
+
+    def _evict_idle(self) -> None:
+        """Make room for one more gate by dropping the least recently used idle ones"""
+        excess = len(self.gates) - self.max_gates + 1
+        if excess <= 0:
+            return
+        for model in [m for m, g in self.gates.items() if g.idle][:excess]:
+            del self.gates[model]
+            self.evicted += 1
+
+    async def acquire(self, model: str, priority: int) -> Optional[Ticket]:
+        gate = self.gate(model)
+        if gate is None:
+            return None
+        return await gate.acquire(priority)
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int):
+        ticket = await self.acquire(model, priority)
+        try:
+            yield ticket
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {model: gate.stats() for model, gate in self.gates.items()}
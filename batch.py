@@ -0,0 +1,125 @@
+"""
+JSONL batch execution: bounded parallelism over a streamed request body
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Marks a line that was dropped for exceeding the size limit
+LINE_TOO_LONG = object()
+
+
+class BatchStreamingResponse(StreamingResponse):
+    """StreamingResponse that leaves receive() to the request body reader
+
+    The stock response listens for disconnects with receive(), which would steal
+    body chunks that are still being read while results stream out.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.stream_response(send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        if self.background is not None:
+            await self.background()
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[Any]:
+    """Split a byte stream into lines without ever holding more than one partial line"""
+    partial = b""
+    skipping = False
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            if skipping:
+                # Tail of an oversized line that was already reported
+                skipping = False
+                continue
+            yield LINE_TOO_LONG if len(line) > max_line_bytes else line
+        if len(partial) > max_line_bytes:
+            if not skipping:
+                yield LINE_TOO_LONG
+            skipping = True
+            partial = b""
+    if partial and not skipping:
+        # The last line may have arrived whole in the final chunk, so it is measured too
+        yield LINE_TOO_LONG if len(partial) > max_line_bytes else partial
+
+
+async def run_batch(lines: AsyncIterator[Any], handle: Callable[[int, Any], Awaitable[Dict[str, Any]]],
+                    parallelism: int, disconnected: Optional[Callable[[], Awaitable[None]]] = None
+                    ) -> AsyncIterator[Dict[str, Any]]:
+    """Run handle(line_number, line) for every non-blank line, yielding results in completion order
+
+    At most `parallelism` items run at once and at most as many finished results wait for
+    the client, so a slow reader stops the body from being consumed any further.
+    """
+    results: asyncio.Queue = asyncio.Queue(maxsize=parallelism)
+    slots = asyncio.Semaphore(parallelism)
+    workers: Set[asyncio.Task] = set()
+    body_read = asyncio.Event()
+    done = object()
+
+    async def work(number: int, line: Any) -> None:
+        try:
+            result = await handle(number, line)
+            await results.put(result)
+        finally:
+            slots.release()
+
+    async def feed() -> None:
+        try:
+            number = 0
+            async for line in lines:
+                number += 1
+                if line is not LINE_TOO_LONG and not line.strip():
+                    continue
+                await slots.acquire()
+                worker = asyncio.ensure_future(work(number, line))
+                workers.add(worker)
+                worker.add_done_callback(workers.discard)
+            body_read.set()
+            if workers:
+                await asyncio.gather(*workers)
+        except Exception as e:
+            logger.error(f"Batch input failed: {type(e).__name__}: {str(e)}")
+            await results.put({"error": {"message": f"Batch input failed: {str(e)}", "type": type(e).__name__}})
+        finally:
+            await results.put(done)
+
+    async def watch() -> None:
+        # Disconnects only become visible once the body has been read to the end
+        await body_read.wait()
+        await disconnected()
+
+    feeder = asyncio.ensure_future(feed())
+    watcher = asyncio.ensure_future(watch()) if disconnected is not None else None
+    try:
+        while True:
+            getter = asyncio.ensure_future(results.get())
+            waits = {getter} if watcher is None else {getter, watcher}
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                # The client went away; everything still running is abandoned below
+                getter.cancel()
+                return
+            result = getter.result()
+            if result is done:
+                return
+            yield result
+    finally:
+        tasks = [feeder, *workers, *([watcher] if watcher is not None else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Load test: drive /chat/completions of main.py at a fixed concurrency and arrival rate
+
+The app is called in-process through ASGI and its upstream is an in-process fake
+LMStudio (no GPU, no network), so the numbers reflect proxy overhead. Reports
+throughput, latency and TTFT percentiles, CPU per request and per chunk and
+memory growth as JSON, for comparison across commits.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import time
+import tracemalloc
+
+# Keep logging and caching out of the measurement; admission stays off unless asked for
+os.environ.setdefault("LOG_REQUEST", "off")
+os.environ.setdefault("LOG_CHUNKS", "off")
+os.environ.setdefault("LOG_SUMMARY", "off")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+os.environ.setdefault("ADMISSION_CONCURRENCY", "0")
+
+import httpx
+
+import main
+from bench_passthrough import build_upstream_body
+from upstream_pool import Backend, UpstreamPool
+
+# httpx logs every upstream request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Content of the fake upstream's chunks (see build_upstream_body); still countable after coalescing
+TOKEN_PATTERN = re.compile(rb"token\d+ ")
+
+
+class FakeStream(httpx.AsyncByteStream):
+    def __init__(self, frames: list, ttft: float, token_delay: float):
+        self.frames = frames
+        self.ttft = ttft
+        self.token_delay = token_delay
+
+    async def __aiter__(self):
+        if self.ttft:
+            await asyncio.sleep(self.ttft)
+        for i, frame in enumerate(self.frames):
+            if i and self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield frame
+
+
+def make_transport(chunks: int, ttft: float, token_delay: float) -> httpx.MockTransport:
+    """Fake LMStudio with pre-encoded bodies so the upstream side costs almost nothing"""
+    frames = build_upstream_body(chunks)
+    completion = json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "bench-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "token " * chunks},
+                     "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": chunks, "total_tokens": chunks + 10},
+    }).encode("utf-8")
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(await request.aread())
+        if body.get("stream"):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                  stream=FakeStream(frames, ttft, token_delay))
+        await asyncio.sleep(ttft + token_delay * chunks)
+        return httpx.Response(200, headers={"content-type": "application/json"}, content=completion)
+
+    return httpx.MockTransport(handler)
+
+
+async def call_app(app, body: bytes, headers: list = ()) -> dict:
+    """One POST /chat/completions through ASGI, timing the first and last body chunk"""
+    started = time.perf_counter()
+    result = {"status": None, "ttfb": None, "chunks": 0, "latency": None, "tokens": 0, "done": False, "error": False}
+    finished = asyncio.Event()
+    request_sent = False
+    pending = b""
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Starlette listens for a disconnect while streaming; only report one once we are done
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal pending
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            if message.get("body"):
+                if result["ttfb"] is None:
+                    result["ttfb"] = time.perf_counter() - started
+                result["chunks"] += 1
+                # Only whole SSE events are checked; a read may end anywhere
+                pending += message["body"]
+                end = pending.rfind(b"\n\n")
+                if end != -1:
+                    events, pending = pending[:end], pending[end + 2:]
+                    result["tokens"] += len(TOKEN_PATTERN.findall(events))
+                    result["done"] = result["done"] or b"data: [DONE]" in events
+                    result["error"] = result["error"] or b'data: {"error"' in events
+            if not message.get("more_body"):
+                finished.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/completions",
+        "raw_path": b"/chat/completions",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    await app(scope, receive, send)
+    finished.set()
+    result["latency"] = time.perf_counter() - started
+    return result
+
+
+def rss_bytes() -> int:
+    """Current resident set size; falls back to the peak where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99),
+            "mean": sum(ordered) / len(ordered) * 1000, "max": ordered[-1] * 1000}
+
+
+def build_body(i: int, stream: bool, distinct_prompts: int) -> bytes:
+    # Unique prompts by default so neither the cache nor single-flight can short-circuit the run
+    prompt = f"bench prompt {i % distinct_prompts if distinct_prompts else i}"
+    return json.dumps({"messages": [{"role": "user", "content": prompt}], "model": "bench-model",
+                       "stream": stream, "max_tokens": 256}).encode("utf-8")
+
+
+async def run_load(args, requests: int, record: bool) -> list:
+    rng = random.Random(args.seed)
+    limit = asyncio.Semaphore(args.concurrency)
+    results = []
+    headers = []
+    if args.coalesce_ms is not None:
+        headers.append((b"x-stream-coalesce", str(args.coalesce_ms).encode()))
+
+    async def one(i: int, stream: bool):
+        try:
+            result = await call_app(main.app, build_body(i, stream, args.distinct_prompts), headers)
+        finally:
+            limit.release()
+        result["stream"] = stream
+        if record:
+            results.append(result)
+
+    tasks = []
+    next_arrival = time.perf_counter()
+    for i in range(requests):
+        if args.rate > 0:
+            # Open loop: Poisson arrivals, still capped at --concurrency outstanding requests
+            next_arrival += rng.expovariate(args.rate)
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await limit.acquire()
+        tasks.append(asyncio.ensure_future(one(i, rng.random() < args.stream_ratio)))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def stream_outcome(result: dict, expected_tokens: int) -> str:
+    """ok only for a stream that delivered every token and ended with [DONE]"""
+    if result["error"]:
+        return "errored"
+    if not result["done"] or result["tokens"] != expected_tokens:
+        return "truncated"
+    return "ok"
+
+
+def summarize(results: list, wall: float, cpu: float, expected_tokens: int) -> dict:
+    answered = [r for r in results if r["status"] == 200]
+    outcomes = {"ok": 0, "truncated": 0, "errored": 0}
+    ok = []
+    for r in answered:
+        if r["stream"]:
+            outcome = stream_outcome(r, expected_tokens)
+            outcomes[outcome] += 1
+            if outcome != "ok":
+                continue
+        ok.append(r)
+    streams = [r for r in ok if r["stream"]]
+    chunks = sum(r["chunks"] for r in streams)
+    statuses = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "status_counts": statuses,
+        "stream_requests": len([r for r in answered if r["stream"]]),
+        "stream_ok": outcomes["ok"],
+        "stream_truncated": outcomes["truncated"],
+        "stream_errored": outcomes["errored"],
+        "stream_chunks": chunks,
+        "wall_seconds": wall,
+        "throughput_rps": len(ok) / wall if wall else None,
+        "chunks_per_second": chunks / wall if wall else None,
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "latency_ms_stream": percentiles([r["latency"] for r in streams]),
+        "latency_ms_non_stream": percentiles([r["latency"] for r in ok if not r["stream"]]),
+        "ttft_ms": percentiles([r["ttfb"] for r in streams if r["ttfb"] is not None]),
+        "cpu_seconds": cpu,
+        "cpu_ms_per_request": cpu / len(results) * 1000 if results else None,
+        "cpu_us_per_chunk": cpu / chunks * 1e6 if chunks else None,
+    }
+
+
+async def run(args) -> dict:
+    transport = make_transport(args.chunks, args.ttft, args.token_delay)
+    main.upstream_pool = UpstreamPool([Backend(main.LMSTUDIO_BASE_URL, http_client=httpx.AsyncClient(transport=transport))])
+    main.model_catalog.pool = main.upstream_pool
+
+    # Warm up so imports, pools and first-call allocations are not measured
+    await run_load(args, min(args.warmup, args.requests), record=False)
+    gc.collect()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_start = rss_bytes()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    results = await run_load(args, args.requests, record=True)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    gc.collect()
+    rss_end = rss_bytes()
+
+    report = {
+        "benchmark": "load",
+        "python": sys.version.split()[0],
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "stream_ratio": args.stream_ratio,
+            "chunks": args.chunks,
+            "ttft": args.ttft,
+            "token_delay": args.token_delay,
+            "distinct_prompts": args.distinct_prompts,
+            "passthrough": main.STREAM_PASSTHROUGH,
+            "coalesce_ms": args.coalesce_ms,
+            "seed": args.seed,
+        },
+        "results": summarize(results, wall, cpu, args.chunks),
+        "memory": {
+            "rss_start_bytes": rss_start,
+            "rss_end_bytes": rss_end,
+            "rss_growth_bytes": rss_end - rss_start,
+            "rss_growth_bytes_per_request": (rss_end - rss_start) / max(len(results), 1),
+        },
+    }
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report["memory"]["traced_current_bytes"] = current
+        report["memory"]["traced_peak_bytes"] = peak
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the proxy against an in-process fake upstream")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64, help="max outstanding requests")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Poisson arrival rate in requests/s; 0 runs closed-loop at --concurrency")
+    parser.add_argument("--stream-ratio", type=float, default=0.8, help="share of streaming requests")
+    parser.add_argument("--chunks", type=int, default=100, help="completion chunks per response")
+    parser.add_argument("--ttft", type=float, default=0.0, help="fake upstream time to first token (s)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="fake upstream delay per chunk (s)")
+    parser.add_argument("--distinct-prompts", type=int, default=0,
+                        help="cycle through this many prompts (0 = every prompt unique)")
+    parser.add_argument("--coalesce-ms", type=float, help="send X-Stream-Coalesce with this window")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="also report Python heap via tracemalloc (slow)")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
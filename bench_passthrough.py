@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Benchmark: SDK streaming path vs raw byte passthrough
+
+Runs both streaming paths of main.py against an in-process fake upstream
+(no LMStudio, no network) and reports per-chunk CPU cost and time-to-first-byte
+as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+# Keep logging out of the measurement
+os.environ.setdefault("LOG_REQUEST", "off")
+os.environ.setdefault("LOG_CHUNKS", "off")
+os.environ.setdefault("LOG_SUMMARY", "off")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+
+import httpx
+
+import main
+from upstream_pool import Backend, UpstreamPool
+
+
+def build_upstream_body(chunks: int) -> list:
+    """Pre-encode an LMStudio-like SSE stream so the fake upstream costs almost nothing"""
+    frames = []
+    for i in range(chunks):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "bench-model",
+            "system_fingerprint": "bench-model",
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": f"token{i} "},
+                         "logprobs": None, "finish_reason": None}],
+        }
+        frames.append(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+    final = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "bench-model",
+        "system_fingerprint": "bench-model",
+        "choices": [{"index": 0, "delta": {}, "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": chunks, "total_tokens": chunks + 10},
+    }
+    frames.append(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+    frames.append(b"data: [DONE]\n\n")
+    return frames
+
+
+class FrameStream(httpx.AsyncByteStream):
+    def __init__(self, frames: list):
+        self.frames = frames
+
+    async def __aiter__(self):
+        for frame in self.frames:
+            yield frame
+
+
+def make_transport(frames: list) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=FrameStream(frames))
+    return httpx.MockTransport(handler)
+
+
+async def drain_baseline(http_client: httpx.AsyncClient):
+    """Fake upstream + httpx cost only, subtracted from both paths"""
+    async with http_client.stream("POST", f"{main.LMSTUDIO_BASE_URL}/chat/completions", content=b"{}") as upstream:
+        async for data in upstream.aiter_raw():
+            yield data
+
+
+async def measure(label: str, make_stream, streams: int, chunks: int) -> dict:
+    ttfb = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(streams):
+        started = time.perf_counter()
+        first = None
+        async for _frame in make_stream():
+            if first is None:
+                first = time.perf_counter() - started
+        ttfb.append(first)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return {
+        "path": label,
+        "streams": streams,
+        "chunks_per_stream": chunks,
+        "cpu_seconds": cpu,
+        "wall_seconds": wall,
+        "cpu_us_per_chunk": cpu / (streams * chunks) * 1e6,
+        "ttfb_ms_p50": statistics.median(ttfb) * 1000,
+        "ttfb_ms_mean": statistics.mean(ttfb) * 1000,
+    }
+
+
+async def run(streams: int, chunks: int) -> dict:
+    frames = build_upstream_body(chunks)
+    transport = make_transport(frames)
+    main.upstream_pool = UpstreamPool([Backend(main.LMSTUDIO_BASE_URL, http_client=httpx.AsyncClient(transport=transport))])
+    baseline_client = httpx.AsyncClient(transport=transport)
+
+    request = main.ChatCompletionRequest(messages=[main.Message(role="user", content="bench")],
+                                         model="bench-model", stream=True)
+
+    # Warm up every path once so imports and pools are not measured
+    for make in (lambda: drain_baseline(baseline_client),
+                 lambda: main.generate_stream_response(request, "warmup"),
+                 lambda: main.generate_passthrough_response(request, "warmup")):
+        async for _ in make():
+            pass
+
+    results = [
+        await measure("upstream_baseline", lambda: drain_baseline(baseline_client), streams, chunks),
+        await measure("sdk", lambda: main.generate_stream_response(request, "bench"), streams, chunks),
+        await measure("passthrough", lambda: main.generate_passthrough_response(request, "bench"), streams, chunks),
+    ]
+    baseline = results[0]["cpu_us_per_chunk"]
+    for result in results[1:]:
+        result["proxy_cpu_us_per_chunk"] = result["cpu_us_per_chunk"] - baseline
+    sdk, passthrough = results[1], results[2]
+    return {
+        "benchmark": "stream_passthrough",
+        "python": sys.version.split()[0],
+        "results": results,
+        "speedup_cpu_per_chunk": sdk["proxy_cpu_us_per_chunk"] / max(passthrough["proxy_cpu_us_per_chunk"], 1e-9),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare SDK streaming with raw SSE passthrough")
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.streams, args.chunks))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark: non-streaming response handling, SDK models vs decoding the upstream bytes once
+
+Both paths start from the raw upstream body and end with the bytes sent to the
+client. The SDK path is the one main.py used before: parse into SDK models, dump
+choices and usage, validate a response model, dump it again and json.dumps.
+Reports microseconds per response as JSON.
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Any, Dict, List
+
+from openai._models import construct_type
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel
+
+import fast_json
+
+
+class ChatCompletionResponse(BaseModel):
+    id: str
+    object: str
+    created: int
+    model: str
+    choices: List[Dict[str, Any]]
+    usage: Dict[str, Any]
+
+
+def build_upstream_body(choices: int, content_chars: int) -> bytes:
+    """An LMStudio-like chat.completion with `choices` choices of `content_chars` characters each"""
+    text = ("The quick brown fox jumps over the lazy dog. 你好，世界。" * (content_chars // 50 + 1))[:content_chars]
+    body = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "bench-model",
+        "system_fingerprint": "bench-model",
+        "choices": [
+            {"index": i, "message": {"role": "assistant", "content": text}, "logprobs": None, "finish_reason": "stop"}
+            for i in range(choices)
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": choices * content_chars // 4,
+                  "total_tokens": 10 + choices * content_chars // 4},
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def sdk_path(raw: bytes) -> bytes:
+    upstream_response = construct_type(type_=ChatCompletion, value=json.loads(raw))
+    api_response = ChatCompletionResponse(
+        id=upstream_response.id,
+        object=upstream_response.object,
+        created=upstream_response.created,
+        model=upstream_response.model,
+        choices=[choice.model_dump() for choice in upstream_response.choices],
+        usage=upstream_response.usage.model_dump()
+    )
+    final_response = api_response.model_dump()
+    return json.dumps(final_response, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def raw_path(raw: bytes) -> bytes:
+    final_response = fast_json.loads(raw)
+    final_response["usage"] = final_response.get("usage") or {}
+    return fast_json.dumps(final_response)
+
+
+def measure(label: str, path, raw: bytes, iterations: int) -> dict:
+    for _ in range(min(iterations, 50)):
+        path(raw)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        body = path(raw)
+    seconds = time.perf_counter() - start
+    return {"path": label, "iterations": iterations, "us_per_response": seconds / iterations * 1e6, "bytes": len(body)}
+
+
+def run(choices: int, content_chars: int, iterations: int) -> dict:
+    raw = build_upstream_body(choices, content_chars)
+    sdk, fast = measure("sdk_models", sdk_path, raw, iterations), measure(f"raw_{fast_json.BACKEND}", raw_path, raw, iterations)
+    return {
+        "benchmark": "response_serialization",
+        "python": sys.version.split()[0],
+        "json_backend": fast_json.BACKEND,
+        "choices": choices,
+        "content_chars": content_chars,
+        "upstream_bytes": len(raw),
+        "results": [sdk, fast],
+        "speedup": sdk["us_per_response"] / max(fast["us_per_response"], 1e-9),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare non-streaming response serialization paths")
+    parser.add_argument("--choices", type=int, default=16, help="choices per response (n)")
+    parser.add_argument("--content-chars", type=int, default=2000, help="characters of content per choice")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run(args.choices, args.content_chars, args.iterations)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -0,0 +1,209 @@
+"""
+Disk-backed response store shared by every worker process on a host
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+"""
+
+# Reads refresh an entry's LRU position at most this often, so hot keys do not turn every hit into a write
+_TOUCH_INTERVAL = 60.0
+
+
+class DiskCache:
+    """SQLite (WAL mode) key/value store with a TTL and a size cap in bytes
+
+    Any number of processes may open the same file: readers never block each other
+    or the writer, and writes are serialized by SQLite's own locking. Each process
+    does its writes from one background thread, in transactions, so the event loop
+    never waits on fsync and a crash leaves either the old or the new entry.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024, ttl: float = 300.0,
+                 queue_size: int = 1024, busy_timeout: float = 5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+        self.dropped_writes = 0
+        self._local = threading.local()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+        self._writer = threading.Thread(target=self._run_writer, name="disk-cache-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL keeps the file consistent across crashes; only the last commits can be lost on power failure
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """(value, expires_at as a time.time() timestamp); blocks on SQLite, so call it off the event loop"""
+        now = time.time()
+        try:
+            row = self._reader().execute(
+                "SELECT value, expires_at, accessed_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Disk cache read failed: {type(e).__name__}: {str(e)}")
+            return None
+        if row is None or row[1] <= now:
+            # Expired rows are left for the writer's sweep
+            self.misses += 1
+            return None
+        self.hits += 1
+        if now - row[2] >= _TOUCH_INTERVAL:
+            self._submit(("touch", key, now))
+        return row[0], row[1]
+
+    def set(self, key: str, value: bytes) -> bool:
+        """Queue a write; returns False when it is too large or the writer is backed up"""
+        if len(value) > self.max_bytes:
+            return False
+        return self._submit(("set", key, value, time.time()))
+
+    def clear(self) -> None:
+        self._submit(("clear",))
+
+    def _submit(self, op: tuple) -> bool:
+        try:
+            self._queue.put_nowait(op)
+            return True
+        except queue.Full:
+            self.dropped_writes += 1
+            return False
+
+    def _run_writer(self) -> None:
+        conn = self._connect()
+        while True:
+            ops = [self._queue.get()]
+            # Drain whatever else is waiting so a burst commits (and syncs) once
+            while len(ops) < 256:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(op is None for op in ops)
+            try:
+                self._apply(conn, [op for op in ops if op is not None])
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Disk cache write failed: {type(e).__name__}: {str(e)}")
+            finally:
+                for _ in ops:
+                    self._queue.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def _apply(self, conn: sqlite3.Connection, ops: list) -> None:
+        if not ops:
+            return
+        written = False
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for op in ops:
+                if op[0] == "set":
+                    _, key, value, now = op
+                    conn.execute(
+                        "INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                        (key, value, len(value), now + self.ttl, now),
+                    )
+                    self.writes += 1
+                    written = True
+                elif op[0] == "touch":
+                    conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (op[2], op[1]))
+                elif op[0] == "clear":
+                    conn.execute("DELETE FROM entries")
+            if written:
+                self._evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Drop expired entries, then the least recently used ones until under the size cap"""
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def flush(self) -> None:
+        """Block until every queued write has been committed"""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters plus the table's size; blocks on SQLite, so call it off the event loop"""
+        stats: Dict[str, Any] = {
+            "path": self.path,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "dropped_writes": self.dropped_writes,
+            "pending_writes": self._queue.qsize(),
+        }
+        try:
+            entries, size = self._reader().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            stats.update(entries=entries, bytes=size)
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
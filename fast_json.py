@@ -0,0 +1,25 @@
+"""
+JSON for response bodies: orjson when it is installed, the standard library otherwise
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(value: Any) -> bytes:
+    """Compact UTF-8 JSON with non-ASCII characters left as-is, the same wire format with either backend"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,208 @@
+"""
+Hedged upstream calls and pre-first-token retries under a global retry budget
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+
+class LatencyTracker:
+    """Recent latency samples of one kind; the hedge delay is a percentile of them"""
+
+    def __init__(self, window: int = 512, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: "deque[float]" = deque(maxlen=window)
+        self._sorted: Optional[list] = None
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, q: float) -> Optional[float]:
+        """None until enough samples are in"""
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            # Re-sorted at most once per observation, and only when a hedge delay is needed
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(len(self._sorted) - 1, int(q / 100 * len(self._sorted)))]
+
+
+class RetryBudget:
+    """Caps extra upstream calls (hedges and retries) at `ratio` of requests
+
+    Every request deposits `ratio` tokens and every extra call withdraws one, so a
+    failing or stalling upstream cannot be hit with more than (1 + ratio) times the
+    normal load. `min_per_second` keeps a trickle of retries available when traffic is low.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, max_balance: float = 100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._balance = max(min_per_second, 1.0)
+        self._updated = time.monotonic()
+        self.withdrawn = 0
+        self.exhausted = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self) -> None:
+        self._refill()
+        self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self._balance < 1.0:
+            self.exhausted += 1
+            return False
+        self._balance -= 1.0
+        self.withdrawn += 1
+        return True
+
+    @property
+    def balance(self) -> float:
+        self._refill()
+        return self._balance
+
+
+class Hedger:
+    """Race attempts of one upstream call until the first item arrives
+
+    A second attempt is launched when the first has produced nothing after the hedge
+    delay (a percentile of recent first-item latencies), and a failed attempt is
+    retried right away; both only while another target exists and the budget allows.
+    Once an attempt yields its first item, every other attempt is cancelled and no
+    further retries happen, so nothing is ever resent after bytes reached the client.
+    """
+
+    def __init__(self, budget: RetryBudget, percentile: float = 95.0, min_delay: float = 0.05,
+                 initial_delay: float = 2.0, max_attempts: int = 2, max_trackers: int = 256):
+        self.budget = budget
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.max_attempts = max_attempts
+        # Least recently used first; the oldest is dropped once max_trackers are held
+        self.trackers: Dict[str, LatencyTracker] = {}
+        self.max_trackers = max_trackers
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+
+    def tracker(self, key: str) -> LatencyTracker:
+        tracker = self.trackers.pop(key, None)
+        if tracker is None:
+            tracker = LatencyTracker()
+            if len(self.trackers) >= self.max_trackers:
+                del self.trackers[next(iter(self.trackers))]
+        self.trackers[key] = tracker
+        return tracker
+
+    def delay(self, key: str) -> float:
+        observed = self.tracker(key).percentile(self.percentile)
+        return max(self.min_delay, observed if observed is not None else self.initial_delay)
+
+    async def stream(self, key: str, open_attempt: Callable[[int], AsyncIterator[Any]],
+                     can_launch: Callable[[], bool], retryable: Callable[[BaseException], bool],
+                     on_winner: Optional[Callable[[int], None]] = None) -> AsyncIterator[Any]:
+        """Yield the items of whichever attempt produces its first item first
+
+        open_attempt(n) returns the n-th attempt's iterator; it is only started once
+        awaited. can_launch() says whether another target is left for an extra attempt.
+        """
+        self.calls += 1
+        self.budget.deposit()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        pending: Dict[asyncio.Future, tuple] = {}
+        launched = 0
+
+        def launch() -> None:
+            nonlocal launched
+            iterator = open_attempt(launched)
+            pending[asyncio.ensure_future(iterator.__anext__())] = (iterator, launched)
+            launched += 1
+
+        def may_launch() -> bool:
+            return launched < self.max_attempts and can_launch() and self.budget.withdraw()
+
+        launch()
+        hedge_at = started + self.delay(key)
+        winner = None
+        first = empty = None
+        error: Optional[BaseException] = None
+        try:
+            while pending and winner is None:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    if may_launch():
+                        self.hedges += 1
+                        launch()
+                    continue
+                for task in done:
+                    iterator, number = pending.pop(task)
+                    exc = task.exception()
+                    if winner is None and (exc is None or isinstance(exc, StopAsyncIteration)):
+                        winner = (iterator, number)
+                        empty = exc is not None
+                        first = None if empty else task.result()
+                        continue
+                    if exc is not None and not isinstance(exc, StopAsyncIteration):
+                        error = exc
+                    await iterator.aclose()
+                if winner is None and error is not None and retryable(error) and may_launch():
+                    self.retries += 1
+                    launch()
+                    error = None
+        finally:
+            # Losers are cancelled mid-request, which closes their upstream connections
+            for task, (iterator, _) in pending.items():
+                task.cancel()
+            for task, (iterator, _) in pending.items():
+                try:
+                    await task
+                except BaseException:
+                    pass
+                await iterator.aclose()
+
+        if winner is None:
+            raise error
+        iterator, number = winner
+        self.tracker(key).observe(loop.time() - started)
+        if number > 0:
+            self.hedge_wins += 1
+        if on_winner is not None:
+            on_winner(number)
+        try:
+            if empty:
+                return
+            yield first
+            async for item in iterator:
+                yield item
+        finally:
+            await iterator.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "percentile": self.percentile,
+            "max_attempts": self.max_attempts,
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retries": self.retries,
+            "budget": {
+                "ratio": self.budget.ratio,
+                "balance": round(self.budget.balance, 3),
+                "withdrawn": self.budget.withdrawn,
+                "exhausted": self.budget.exhausted,
+            },
+            "delays": {key: round(self.delay(key), 4) for key in self.trackers},
+        }
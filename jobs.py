@@ -0,0 +1,316 @@
+"""
+Asynchronous completion jobs: accepted at once, generated by a bounded worker pool
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ("queued", "running", "completed", "failed", "cancelled")
+FINISHED = ("completed", "failed", "cancelled")
+
+
+class JobsFull(Exception):
+    """No room for another job until queued ones start or finished ones expire"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def assemble_completion(frames: List[str]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Fold chat.completion.chunk SSE frames into one chat.completion; returns (result, error)"""
+    completion: Dict[str, Any] = {"id": None, "object": "chat.completion", "created": None, "model": None}
+    choices: Dict[int, Dict[str, Any]] = {}
+    usage = None
+    for frame in frames:
+        if not frame.startswith("data: "):
+            continue
+        data = frame[6:].strip()
+        if data == "[DONE]":
+            continue
+        chunk = json.loads(data)
+        if "error" in chunk:
+            return None, {"message": str(chunk["error"]), "type": "upstream_error"}
+        for key in ("id", "created", "model"):
+            if completion[key] is None:
+                completion[key] = chunk.get(key)
+        for choice in chunk.get("choices") or ():
+            entry = choices.setdefault(choice.get("index", 0), {"role": "assistant", "parts": [], "finish_reason": None})
+            delta = choice.get("delta") or {}
+            if delta.get("role"):
+                entry["role"] = delta["role"]
+            if delta.get("content"):
+                entry["parts"].append(delta["content"])
+            if choice.get("finish_reason"):
+                entry["finish_reason"] = choice["finish_reason"]
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+    completion["choices"] = [
+        {"index": index, "message": {"role": entry["role"], "content": "".join(entry["parts"])},
+         "finish_reason": entry["finish_reason"]}
+        for index, entry in sorted(choices.items())
+    ]
+    completion["usage"] = usage
+    return completion, None
+
+
+class Job:
+    """One accepted completion; frames are the SSE frames generated so far"""
+
+    def __init__(self, job_id: str, model: Optional[str], execute: Callable[[], AsyncIterator[str]]):
+        self.id = job_id
+        self.model = model
+        self.execute = execute
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.frames: List[str] = []
+        self.bytes = 0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, seen: int, timeout: float) -> bool:
+        """Wait for frames past `seen` or the end of the job; False on timeout"""
+        if len(self.frames) > seen or self.done:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def events(self, offset: int = 0, heartbeat: float = 15.0) -> AsyncIterator[str]:
+        """The job's frames from `offset` on, each with an SSE id so clients can resume with Last-Event-ID"""
+        sent = max(0, offset)
+        while True:
+            while sent < len(self.frames):
+                yield f"id: {sent}\n{self.frames[sent]}"
+                sent += 1
+            if self.done:
+                return
+            if not await self.wait(sent, heartbeat):
+                # Keeps intermediate proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "id": self.id,
+            "object": "chat.completion.job",
+            "model": self.model,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "frames": len(self.frames),
+        }
+        if self.result is not None:
+            data["result"] = self.result
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobStore:
+    """Jobs by id, bounded by count and by the bytes of their frames
+
+    Finished jobs expire `ttl` seconds after they end and are evicted oldest first
+    when a bound is hit. Queued and running jobs are never evicted: when only they
+    are left, new submissions are refused instead.
+    """
+
+    def __init__(self, max_jobs: int = 1000, max_bytes: int = 256 * 1024 * 1024, ttl: float = 3600.0):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def _remove(self, job: Job) -> None:
+        del self._jobs[job.id]
+        self.bytes -= job.bytes
+
+    def sweep(self) -> None:
+        now = time.time()
+        for job in [j for j in self._jobs.values() if j.done and now - j.finished_at > self.ttl]:
+            self._remove(job)
+            self.expirations += 1
+
+    def _trim(self, extra_jobs: int = 0) -> bool:
+        """Evict finished jobs until both bounds hold; False if that is not enough"""
+        for job in [j for j in self._jobs.values() if j.done]:
+            if len(self._jobs) + extra_jobs <= self.max_jobs and self.bytes <= self.max_bytes:
+                break
+            self._remove(job)
+            self.evictions += 1
+        return len(self._jobs) + extra_jobs <= self.max_jobs and self.bytes <= self.max_bytes
+
+    def add(self, job: Job) -> None:
+        self.sweep()
+        if not self._trim(extra_jobs=1):
+            raise JobsFull("Job store is full of unfinished jobs", retry_after=30)
+        self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.sweep()
+        return self._jobs.get(job_id)
+
+    def append(self, job: Job, frame: str) -> None:
+        size = len(frame.encode("utf-8"))
+        job.frames.append(frame)
+        job.bytes += size
+        if job.id in self._jobs:
+            self.bytes += size
+            if self.bytes > self.max_bytes:
+                self._trim()
+        job._notify()
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATUSES, 0)
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
+
+
+class JobRunner:
+    """Run queued jobs on a fixed number of workers, oldest first"""
+
+    def __init__(self, store: JobStore, workers: int = 2, max_queued: int = 100):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue: "asyncio.Queue[Job]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(max(1, self.workers))]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    def submit(self, job: Job) -> None:
+        if self._queue.qsize() >= self.max_queued:
+            raise JobsFull(f"Job queue is full ({self.max_queued} waiting)", retry_after=30)
+        self.store.add(job)
+        self._queue.put_nowait(job)
+        self.start()
+
+    def cancel(self, job: Job) -> bool:
+        """False if the job had already finished"""
+        if job.done:
+            return False
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            # Still queued; the worker that dequeues it skips it
+            self._finish(job, "cancelled")
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.done:
+                continue
+            job.task = asyncio.ensure_future(self._run(job))
+            try:
+                await asyncio.wait([job.task])
+            except asyncio.CancelledError:
+                # Shutting down: take the running job with us
+                job.task.cancel()
+                raise
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        job._notify()
+        frames = job.execute()
+        try:
+            async for frame in frames:
+                self.store.append(job, frame)
+        except asyncio.CancelledError:
+            self._finish(job, "cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {type(e).__name__}: {str(e)}")
+            error = {"message": str(e), "type": type(e).__name__}
+            if getattr(e, "retry_after", None) is not None:
+                error["retry_after"] = e.retry_after
+            self._finish(job, "failed", error=error)
+            return
+        finally:
+            await frames.aclose()
+        try:
+            result, error = assemble_completion(job.frames)
+        except ValueError as e:
+            result, error = None, {"message": f"Unreadable stream frame: {str(e)}", "type": "invalid_frame"}
+        self._finish(job, "failed" if error else "completed", result=result, error=error)
+
+    def _finish(self, job: Job, status: str, result: Optional[Dict[str, Any]] = None,
+                error: Optional[Dict[str, Any]] = None) -> None:
+        job.status = status
+        job.finished_at = time.time()
+        job.result = result
+        job.error = error
+        job.execute = None
+        if status == "completed":
+            self.completed += 1
+        elif status == "failed":
+            self.failed += 1
+        else:
+            self.cancelled += 1
+        job._notify()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "jobs": self.store.counts(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "store": {
+                "jobs": len(self.store),
+                "max_jobs": self.store.max_jobs,
+                "bytes": self.store.bytes,
+                "max_bytes": self.store.max_bytes,
+                "ttl": self.store.ttl,
+                "evictions": self.store.evictions,
+                "expirations": self.store.expirations,
+            },
+        }
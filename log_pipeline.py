@@ -0,0 +1,142 @@
+"""
+Non-blocking structured logging for the proxy hot path
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Any, Dict, Optional
+
+PHASE_LEVELS = {"off": 0, "summary": 1, "full": 2}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as compact single-line JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload: Dict[str, Any] = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload["event"] = record.msg
+            payload.update(fields)
+        else:
+            payload["msg"] = record.getMessage()
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain-text format with structured fields appended as compact JSON"""
+
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + json.dumps(fields, ensure_ascii=False, separators=(",", ":"), default=str)
+        return line
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue raw records; formatting and I/O happen on the listener thread"""
+
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stdlib handler formats here, i.e. on the event loop thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def setup_logging(level: int = logging.INFO, log_format: str = "json", queue_size: int = 10000) -> None:
+    """Route all logging through a bounded queue drained by a background thread"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter())
+
+    log_queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+class PhaseLogger:
+    """Per-phase verbosity (request, chunk, summary) with chunk sampling"""
+
+    def __init__(self, logger: logging.Logger, request_level: str = "summary", chunk_level: str = "off",
+                 summary_level: str = "summary", chunk_sample_rate: float = 0.0):
+        self.logger = logger
+        self.levels = {
+            "request": PHASE_LEVELS.get(request_level, 1),
+            "chunk": PHASE_LEVELS.get(chunk_level, 0),
+            "summary": PHASE_LEVELS.get(summary_level, 1),
+        }
+        self.chunk_sample_rate = chunk_sample_rate
+
+    def enabled(self, phase: str, level: str = "summary") -> bool:
+        return self.levels[phase] >= PHASE_LEVELS[level]
+
+    def sample_chunk(self) -> bool:
+        """Decide whether this chunk gets logged; cheap enough to call per token"""
+        if not self.levels["chunk"] or self.chunk_sample_rate <= 0:
+            return False
+        return self.chunk_sample_rate >= 1 or random.random() < self.chunk_sample_rate
+
+    def event(self, event: str, request_id: str, **fields: Any) -> None:
+        fields["request_id"] = request_id
+        self.logger.info(event, extra={"fields": fields})
+
+    def error(self, event: str, request_id: str, **fields: Any) -> None:
+        fields["request_id"] = request_id
+        self.logger.error(event, extra={"fields": fields})
+
+
+def elapsed(start_time: float) -> float:
+    return round(time.time() - start_time, 6)
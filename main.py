@@ -1,18 +1,56 @@
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ValidationError
 import os
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import logging
 import json
 import time
 import uuid
-from openai import AsyncOpenAI
-from fastapi.responses import StreamingResponse
+import asyncio
+import hmac
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import fast_json
+from response_cache import CachedCompletion, ResponseCache, StreamRecording, make_cache_key
+from disk_cache import DiskCache
+from singleflight import SingleFlight, StreamBroadcaster
+from log_pipeline import PhaseLogger, elapsed, setup_logging
+from sse_passthrough import SSEScanner, stream_raw
+from stream_coalescer import coalesce_chunks, coalesce_raw
+from upstream_pool import Backend, UpstreamPool, is_backend_failure
+from hedging import Hedger, RetryBudget
+from prefix_affinity import PrefixAffinity
+from model_router import ModelRouter
+from model_catalog import ModelCatalog
+from metrics import CHUNK_BUCKETS, RATE_BUCKETS, Registry
+from log_pipeline import dropped_records
+from batch import LINE_TOO_LONG, BatchStreamingResponse, read_lines, run_batch
+from admission import AdmissionController, AdmissionRejected, QueueFullError, PRIORITY_CLASSES, parse_priority
+from profiler import ProfileBusy, StackSampler, pending_tasks, watch_event_loop
+from tracing import Trace, TraceBuffer, TraceStartMiddleware, received_at
+from semantic_cache import HashingEmbedder, LMStudioEmbedder, SemanticCache, SemanticQuery
+from ws_mux import MuxSession, StreamRejected
+from jobs import Job, JobRunner, JobsFull, JobStore
+from rate_limit import MemoryBuckets, RateLimited, Reservation, SQLiteBuckets, TokenRateLimiter, estimate_prompt_tokens, tenant_id
+
+# Logging configuration: verbosity per phase is off | summary | full
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_REQUEST = os.getenv("LOG_REQUEST", "summary")
+LOG_CHUNKS = os.getenv("LOG_CHUNKS", "off")
+LOG_CHUNK_SAMPLE_RATE = float(os.getenv("LOG_CHUNK_SAMPLE_RATE", "0.01"))
+LOG_SUMMARY = os.getenv("LOG_SUMMARY", "summary")
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+setup_logging(level=logging.INFO, log_format=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
+phase_log = PhaseLogger(
+    logger,
+    request_level=LOG_REQUEST,
+    chunk_level=LOG_CHUNKS,
+    summary_level=LOG_SUMMARY,
+    chunk_sample_rate=LOG_CHUNK_SAMPLE_RATE
+)
 
 app = FastAPI(title="LMStudio Chat Completion API", version="1.0.0")
 
@@ -23,17 +61,337 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID", "X-Cache"],
 )
+app.add_middleware(TraceStartMiddleware)
 
 # LMStudio configuration - adjust for your setup
 LMSTUDIO_BASE_URL = os.getenv("LMSTUDIO_BASE_URL", "http://192.168.10.41:1234/v1")
 MODEL_NAME = os.getenv("MODEL_NAME", "qwen/qwen3-coder-30b")
 
-# Initialize OpenAI client for LMStudio
-client = AsyncOpenAI(
-    base_url=LMSTUDIO_BASE_URL,
-    api_key="lm-studio"  # LMStudio doesn't require a real API key
+# Upstream pool: comma-separated "url[|weight]" list, defaults to the single LMSTUDIO_BASE_URL
+LMSTUDIO_BACKENDS = os.getenv("LMSTUDIO_BACKENDS", LMSTUDIO_BASE_URL)
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "3"))
+UPSTREAM_EJECTION_SECONDS = float(os.getenv("UPSTREAM_EJECTION_SECONDS", "30"))
+UPSTREAM_PROBE_INTERVAL = float(os.getenv("UPSTREAM_PROBE_INTERVAL", "10"))  # also the model catalog refresh interval
+MODEL_CATALOG_MAX_AGE = float(os.getenv("MODEL_CATALOG_MAX_AGE", "30"))  # older catalogs are revalidated on read
+# Prefix affinity: keep a conversation on the backend that holds its KV cache (only with several backends)
+PREFIX_AFFINITY_ENABLED = os.getenv("PREFIX_AFFINITY_ENABLED", "true").lower() == "true"
+PREFIX_AFFINITY_MAX_ENTRIES = int(os.getenv("PREFIX_AFFINITY_MAX_ENTRIES", "50000"))
+PREFIX_AFFINITY_LOAD_FACTOR = float(os.getenv("PREFIX_AFFINITY_LOAD_FACTOR", "1.25"))  # max load vs. fair share
+# Hedging: race a second backend when the first token is late, retry failures before the first token
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # of recent time-to-first-token
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_INITIAL_DELAY_MS = float(os.getenv("HEDGE_INITIAL_DELAY_MS", "2000"))  # until enough latencies are observed
+HEDGE_MAX_ATTEMPTS = int(os.getenv("HEDGE_MAX_ATTEMPTS", "2"))  # upstream calls per request, hedges and retries included
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))  # extra calls per request, across all requests
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1"))
+
+# Response cache configuration
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Only greedy (temperature 0) requests are cached unless sampled answers may be replayed too
+RESPONSE_CACHE_SAMPLED = os.getenv("RESPONSE_CACHE_SAMPLED", "false").lower() == "true"
+# Shared SQLite store behind the in-memory cache; empty keeps the cache per-process
+RESPONSE_CACHE_DISK_PATH = os.getenv("RESPONSE_CACHE_DISK_PATH", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+RESPONSE_CACHE_DISK_TTL = float(os.getenv("RESPONSE_CACHE_DISK_TTL", str(RESPONSE_CACHE_TTL)))
+# Semantic cache: answer paraphrases of an earlier prompt from the response cache (needs numpy)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_EMBEDDER = os.getenv("SEMANTIC_CACHE_EMBEDDER", "hashing").lower()  # hashing | lmstudio
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "text-embedding-nomic-embed-text-v1.5")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))  # cosine similarity of the last user message
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", str(RESPONSE_CACHE_TTL)))
+SEMANTIC_CACHE_EMBED_TIMEOUT_MS = float(os.getenv("SEMANTIC_CACHE_EMBED_TIMEOUT_MS", "250"))  # then the lookup is skipped
+CACHE_BYPASS_HEADER = "x-cache-bypass"
+STREAM_REPLAY_PACING = os.getenv("STREAM_REPLAY_PACING", "fast").lower()  # fast | original
+STREAM_REPLAY_HEADER = "x-cache-replay"
+
+# Single-flight coalescing of identical in-flight requests
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+STREAM_SUBSCRIBER_BUFFER = int(os.getenv("STREAM_SUBSCRIBER_BUFFER", "256"))  # frames per subscriber
+
+# Admission control: concurrency per model (0 = unlimited), bounded priority queue
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "4"))
+ADMISSION_MODEL_CONCURRENCY = os.getenv("ADMISSION_MODEL_CONCURRENCY", "")  # "model=N,model=N"
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "60"))
+ADMISSION_MAX_GATES = int(os.getenv("ADMISSION_MAX_GATES", "256"))  # per-model gates kept; idle ones are dropped beyond this
+PRIORITY_HEADER = "x-priority"
+
+# Model routing rules and fallback chains (JSON file, see model_router.py); empty = forward the model as-is
+MODEL_ROUTES_FILE = os.getenv("MODEL_ROUTES_FILE", "")
+MODEL_ROUTE_HEADER = "x-model-route"  # force a route by name, or "off"
+
+# Per-tenant token budgets: estimated prompt tokens + max_tokens per minute (0 = unlimited)
+RATE_LIMIT_TOKENS_PER_MINUTE = int(os.getenv("RATE_LIMIT_TOKENS_PER_MINUTE", "0"))
+RATE_LIMIT_MODEL_TOKENS_PER_MINUTE = os.getenv("RATE_LIMIT_MODEL_TOKENS_PER_MINUTE", "")  # "model=N,model=N"
+RATE_LIMIT_TENANT_HEADER = os.getenv("RATE_LIMIT_TENANT_HEADER", "").lower()  # tenants are keyed by API key when unset
+RATE_LIMIT_SHARED_PATH = os.getenv("RATE_LIMIT_SHARED_PATH", "")  # SQLite file shared by workers; empty = per-process
+
+# Non-streaming upstream calls are abandoned after this many seconds (0 = no limit)
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+
+# Raw SSE passthrough: forward upstream bytes without SDK parsing
+STREAM_PASSTHROUGH = os.getenv("STREAM_PASSTHROUGH", "false").lower() == "true"
+STREAM_PASSTHROUGH_HEADER = "x-stream-passthrough"
+
+# Stream coalescing: merge content deltas arriving within a window into one frame (0 = off)
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_MAX_BYTES = int(os.getenv("STREAM_COALESCE_MAX_BYTES", "1024"))
+STREAM_COALESCE_HEADER = "x-stream-coalesce"  # off | on | window in ms
+STREAM_COALESCE_DEFAULT_MS = 20.0  # used by "on" when no window is configured
+
+# WebSocket transport: many streams over one /ws/chat connection
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "64"))  # concurrent streams per connection
+WS_STREAM_WINDOW = int(os.getenv("WS_STREAM_WINDOW", "64"))  # chunks sent ahead of client credit (0 = no flow control)
+
+# JSONL batch endpoint
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "4"))  # items in flight per batch request
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "16"))  # cap for ?parallelism=
+BATCH_MAX_LINE_BYTES = int(os.getenv("BATCH_MAX_LINE_BYTES", str(1024 * 1024)))
+
+# Async jobs: accepted at once, generated by a worker pool, results kept in memory until they expire
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # jobs generating at the same time
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "100"))
+JOB_MAX_STORED = int(os.getenv("JOB_MAX_STORED", "1000"))  # jobs kept, finished ones included
+JOB_STORE_MAX_BYTES = int(os.getenv("JOB_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))  # seconds a finished job is kept
+JOB_HEARTBEAT_SECONDS = 15.0  # keep-alive comments on an idle /jobs/{id}/events stream
+
+# Request tracing: phase timings go out as Server-Timing; the last N traces are kept for /debug/requests
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "512"))
+TRACE_SSE_COMMENT = os.getenv("TRACE_SSE_COMMENT", "true").lower() == "true"  # trailing ": server-timing" on streams
+
+# Profiling endpoints under /debug/profile and /debug/asyncio; disabled unless an admin token is set
+DEBUG_ADMIN_TOKEN = os.getenv("DEBUG_ADMIN_TOKEN", "")
+DEBUG_ADMIN_HEADER = "x-admin-token"
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Initialize OpenAI clients for the LMStudio backends
+upstream_pool = UpstreamPool.from_config(
+    LMSTUDIO_BACKENDS,
+    api_key="lm-studio",  # LMStudio doesn't require a real API key
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+    ejection_seconds=UPSTREAM_EJECTION_SECONDS
+)
+# The catalog refresh loop doubles as the pool's active health probe
+model_catalog = ModelCatalog(upstream_pool, refresh_interval=UPSTREAM_PROBE_INTERVAL, max_age=MODEL_CATALOG_MAX_AGE)
+prefix_affinity = PrefixAffinity(
+    max_entries=PREFIX_AFFINITY_MAX_ENTRIES,
+    load_factor=PREFIX_AFFINITY_LOAD_FACTOR
+) if PREFIX_AFFINITY_ENABLED else None
+hedger = Hedger(
+    RetryBudget(ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND),
+    percentile=HEDGE_PERCENTILE,
+    min_delay=HEDGE_MIN_DELAY_MS / 1000,
+    initial_delay=HEDGE_INITIAL_DELAY_MS / 1000,
+    max_attempts=HEDGE_MAX_ATTEMPTS
+) if HEDGE_ENABLED else None
+
+def open_disk_cache() -> Optional[DiskCache]:
+    if not (RESPONSE_CACHE_ENABLED and RESPONSE_CACHE_DISK_PATH):
+        return None
+    try:
+        return DiskCache(RESPONSE_CACHE_DISK_PATH, max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES, ttl=RESPONSE_CACHE_DISK_TTL)
+    except Exception as e:
+        # A broken cache file must not keep the proxy from starting
+        logger.error(f"Disk cache disabled, cannot open {RESPONSE_CACHE_DISK_PATH}: {type(e).__name__}: {str(e)}")
+        return None
+
+disk_cache = open_disk_cache()
+
+def open_semantic_cache() -> Optional[SemanticCache]:
+    if not (RESPONSE_CACHE_ENABLED and SEMANTIC_CACHE_ENABLED):
+        return None
+    try:
+        if SEMANTIC_CACHE_EMBEDDER == "lmstudio":
+            embedder = LMStudioEmbedder(upstream_pool, SEMANTIC_CACHE_EMBEDDING_MODEL)
+        elif SEMANTIC_CACHE_EMBEDDER == "hashing":
+            embedder = HashingEmbedder()
+        else:
+            raise ValueError(f"unknown embedder {SEMANTIC_CACHE_EMBEDDER!r}")
+        return SemanticCache(embedder, threshold=SEMANTIC_CACHE_THRESHOLD,
+                             max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL,
+                             embed_timeout=SEMANTIC_CACHE_EMBED_TIMEOUT_MS / 1000)
+    except Exception as e:
+        logger.error(f"Semantic cache disabled: {type(e).__name__}: {str(e)}")
+        return None
+
+semantic_cache = open_semantic_cache()
+
+def load_model_router() -> Optional[ModelRouter]:
+    if not MODEL_ROUTES_FILE:
+        return None
+    try:
+        return ModelRouter.from_file(MODEL_ROUTES_FILE)
+    except Exception as e:
+        logger.error(f"Model routing disabled, cannot load {MODEL_ROUTES_FILE}: {type(e).__name__}: {str(e)}")
+        return None
+
+model_router = load_model_router()
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    store=disk_cache
+)
+admission = AdmissionController(
+    default_concurrency=ADMISSION_CONCURRENCY,
+    max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    model_concurrency=AdmissionController.parse_model_limits(ADMISSION_MODEL_CONCURRENCY),
+    max_gates=ADMISSION_MAX_GATES
+)
+rate_limiter = TokenRateLimiter(
+    default_limit=RATE_LIMIT_TOKENS_PER_MINUTE,
+    model_limits=AdmissionController.parse_model_limits(RATE_LIMIT_MODEL_TOKENS_PER_MINUTE),
+    store=SQLiteBuckets(RATE_LIMIT_SHARED_PATH) if RATE_LIMIT_SHARED_PATH else MemoryBuckets()
 )
+single_flight = SingleFlight()
+traces = TraceBuffer(TRACE_BUFFER_SIZE)
+stack_sampler = StackSampler()
+stream_broadcaster = StreamBroadcaster(buffer_size=STREAM_SUBSCRIBER_BUFFER)
+job_runner = JobRunner(
+    JobStore(max_jobs=JOB_MAX_STORED, max_bytes=JOB_STORE_MAX_BYTES, ttl=JOB_RESULT_TTL),
+    workers=JOB_WORKERS,
+    max_queued=JOB_MAX_QUEUED
+)
+
+# Models named in the config; with the catalog, these are the only model labels a metric series gets
+OTHER_MODEL_LABEL = "other"
+configured_models = {MODEL_NAME, *admission.model_concurrency, *rate_limiter.model_limits}
+if model_router is not None:
+    configured_models.update(model_router.models())
+
+def model_label(model: str) -> str:
+    """`model` if the proxy knows of it, else "other", so clients cannot add series at will"""
+    if model in configured_models or model in model_catalog.model_ids:
+        return model
+    return OTHER_MODEL_LABEL
+
+# Prometheus metrics; children are resolved once per request and updated on the hot path
+metrics_registry = Registry()
+request_latency = metrics_registry.histogram(
+    "llm_proxy_request_duration_seconds", "End-to-end request latency", ("model", "stream"))
+time_to_first_token = metrics_registry.histogram(
+    "llm_proxy_time_to_first_token_seconds", "Upstream request sent to first streamed chunk", ("model", "stream"))
+inter_chunk_latency = metrics_registry.histogram(
+    "llm_proxy_inter_chunk_latency_seconds", "Gap between consecutive upstream chunks", ("model", "stream"),
+    buckets=CHUNK_BUCKETS)
+output_tokens_per_second = metrics_registry.histogram(
+    "llm_proxy_output_tokens_per_second", "Completion tokens per second of generation", ("model", "stream"),
+    buckets=RATE_BUCKETS)
+requests_in_flight = metrics_registry.gauge(
+    "llm_proxy_requests_in_flight", "Chat requests currently being served", ("model", "stream"))
+requests_total = metrics_registry.counter(
+    "llm_proxy_requests_total", "Chat requests by response status", ("model", "stream", "status"))
+upstream_errors = metrics_registry.counter(
+    "llm_proxy_upstream_errors_total", "Failed upstream calls", ("model", "stream", "error_type"))
+upstream_cancellations = metrics_registry.counter(
+    "llm_proxy_upstream_cancellations_total", "Upstream generations aborted before completion",
+    ("model", "stream", "reason"))
+batch_items = metrics_registry.counter(
+    "llm_proxy_batch_items_total", "JSONL batch items by result status", ("status",))
+websocket_connections = metrics_registry.gauge(
+    "llm_proxy_websocket_connections", "Open /ws/chat connections")
+jobs_held = metrics_registry.gauge(
+    "llm_proxy_jobs", "Async jobs held by the job store", ("status",))
+admission_wait = metrics_registry.histogram(
+    "llm_proxy_admission_wait_seconds", "Time spent in the admission queue", ("model",))
+admission_queue_depth = metrics_registry.gauge(
+    "llm_proxy_admission_queue_depth", "Requests waiting for an admission slot", ("model",))
+admission_active = metrics_registry.gauge(
+    "llm_proxy_admission_active", "Admission slots in use", ("model",))
+admission_rejected = metrics_registry.counter(
+    "llm_proxy_admission_rejected_total", "Requests rejected by admission control", ("model", "reason"))
+rate_limited = metrics_registry.counter(
+    "llm_proxy_rate_limited_total", "Requests rejected by the per-tenant token rate limit", ("model",))
+rate_limit_tokens = metrics_registry.counter(
+    "llm_proxy_rate_limit_tokens_total", "Tokens charged to tenant budgets after reconciling with usage", ("model",))
+backend_in_flight = metrics_registry.gauge(
+    "llm_proxy_backend_in_flight", "In-flight requests per upstream backend", ("backend",))
+backend_healthy = metrics_registry.gauge(
+    "llm_proxy_backend_healthy", "1 when the backend is in the pool", ("backend",))
+cache_lookups = metrics_registry.counter(
+    "llm_proxy_response_cache_lookups_total", "Response cache lookups", ("result",))
+cache_bytes = metrics_registry.gauge(
+    "llm_proxy_response_cache_bytes", "Bytes held by the response cache")
+disk_cache_lookups = metrics_registry.counter(
+    "llm_proxy_disk_cache_lookups_total", "Lookups that reached the shared disk cache", ("result",))
+semantic_cache_lookups = metrics_registry.counter(
+    "llm_proxy_semantic_cache_lookups_total", "Semantic cache lookups", ("result",))
+semantic_similarity = metrics_registry.histogram(
+    "llm_proxy_semantic_cache_similarity", "Best similarity found per semantic cache lookup",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0))
+model_routes = metrics_registry.counter(
+    "llm_proxy_model_routes_total", "Requests sent to another model by a routing rule", ("route",))
+model_fallbacks = metrics_registry.counter(
+    "llm_proxy_model_fallbacks_total", "Requests moved to a fallback model", ("model", "fallback"))
+prefix_affinity_routes = metrics_registry.counter(
+    "llm_proxy_prefix_affinity_total", "Backend choices by prefix affinity outcome", ("result",))
+upstream_hedges = metrics_registry.counter(
+    "llm_proxy_upstream_hedges_total", "Extra upstream calls made before the first token", ("kind",))
+log_records_dropped = metrics_registry.counter(
+    "llm_proxy_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+def collect_state_metrics():
+    """Copy counters kept by other components into the registry at scrape time"""
+    # Several unknown models can share the "other" series, so their values are summed
+    gates: Dict[str, List[int]] = {}
+    for model, gate in admission.gates.items():
+        sums = gates.setdefault(model_label(model), [0, 0, 0, 0])
+        for i, value in enumerate((gate.queued, gate.active, gate.rejected, gate.timeouts)):
+            sums[i] += value
+    for model, (queued, active, rejected, timeouts) in gates.items():
+        admission_queue_depth.labels(model).set(queued)
+        admission_active.labels(model).set(active)
+        admission_rejected.labels(model, "queue_full").value = rejected
+        admission_rejected.labels(model, "queue_timeout").value = timeouts
+    for family, counts in ((rate_limited, rate_limiter.rejected), (rate_limit_tokens, rate_limiter.tokens_used)):
+        totals: Dict[str, int] = {}
+        for model, count in counts.items():
+            label = model_label(model)
+            totals[label] = totals.get(label, 0) + count
+        for model, count in totals.items():
+            family.labels(model).value = count
+    for backend in upstream_pool.backends:
+        backend_in_flight.labels(backend.name).set(backend.in_flight)
+        backend_healthy.labels(backend.name).set(1 if backend.healthy else 0)
+    cache_lookups.labels("hit").value = response_cache.hits
+    cache_lookups.labels("miss").value = response_cache.misses
+    cache_bytes.set(response_cache.stats()["bytes"])
+    if disk_cache is not None:
+        disk_cache_lookups.labels("hit").value = disk_cache.hits
+        disk_cache_lookups.labels("miss").value = disk_cache.misses
+    if semantic_cache is not None:
+        semantic_cache_lookups.labels("hit").value = semantic_cache.hits
+        semantic_cache_lookups.labels("miss").value = semantic_cache.misses - semantic_cache.stale
+        semantic_cache_lookups.labels("stale").value = semantic_cache.stale
+        semantic_cache_lookups.labels("timeout").value = semantic_cache.timeouts
+    if model_router is not None:
+        for route, count in model_router.routed.items():
+            model_routes.labels(route).value = count
+        for (source, target), count in model_router.fell_back.items():
+            model_fallbacks.labels(source, target).value = count
+    if prefix_affinity is not None:
+        prefix_affinity_routes.labels("hit").value = prefix_affinity.hits
+        prefix_affinity_routes.labels("miss").value = prefix_affinity.misses
+        prefix_affinity_routes.labels("overflow").value = prefix_affinity.overflows
+    if hedger is not None:
+        upstream_hedges.labels("hedge").value = hedger.hedges
+        upstream_hedges.labels("hedge_won").value = hedger.hedge_wins
+        upstream_hedges.labels("retry").value = hedger.retries
+        upstream_hedges.labels("budget_exhausted").value = hedger.budget.exhausted
+    for status, count in job_runner.store.counts().items():
+        jobs_held.labels(status).set(count)
+    log_records_dropped.labels().value = dropped_records()
+
+metrics_registry.add_collector(collect_state_metrics)
 
 class Message(BaseModel):
     role: str
@@ -47,255 +405,1362 @@ class ChatCompletionRequest(BaseModel):
     top_p: Optional[float] = 1.0
     stream: Optional[bool] = False
 
-class ChatCompletionResponse(BaseModel):
-    id: str
-    object: str
-    created: int
-    model: str
-    choices: List[Dict[str, Any]]
-    usage: Dict[str, Any]
+def cache_bypassed(fastapi_request: Request) -> bool:
+    """Check whether the client opted out of the response cache"""
+    if not RESPONSE_CACHE_ENABLED:
+        return True
+    if fastapi_request.headers.get(CACHE_BYPASS_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    cache_control = fastapi_request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+def cacheable(request: ChatCompletionRequest) -> bool:
+    """A sampled completion is one draw of many; replaying it would pin every caller to that draw"""
+    return RESPONSE_CACHE_SAMPLED or request.temperature == 0
+
+def passthrough_enabled(fastapi_request: Request) -> bool:
+    """Decide whether a stream is proxied as raw upstream bytes"""
+    value = fastapi_request.headers.get(STREAM_PASSTHROUGH_HEADER)
+    if value is None:
+        return STREAM_PASSTHROUGH
+    return value.lower() in ("1", "true", "yes")
+
+def coalesce_window(fastapi_request: Request) -> float:
+    """Coalescing window in seconds for this stream, 0 when frames go out one by one"""
+    value = fastapi_request.headers.get(STREAM_COALESCE_HEADER)
+    if value is None:
+        return STREAM_COALESCE_MS / 1000
+    value = value.strip().lower()
+    if value in ("off", "false", "no"):
+        return 0.0
+    if value in ("on", "true", "yes"):
+        return (STREAM_COALESCE_MS or STREAM_COALESCE_DEFAULT_MS) / 1000
+    try:
+        return max(0.0, float(value)) / 1000
+    except ValueError:
+        return STREAM_COALESCE_MS / 1000
+
+def request_priority(request: ChatCompletionRequest, fastapi_request: Request) -> int:
+    """Interactive streams run ahead of non-streaming calls unless the client says otherwise"""
+    default = PRIORITY_CLASSES["interactive"] if request.stream else PRIORITY_CLASSES["default"]
+    return parse_priority(fastapi_request.headers.get(PRIORITY_HEADER), default)
+
+async def reserve_tokens(tenant: str, request: ChatCompletionRequest, messages: List[Dict[str, Any]],
+                         trace: Optional[Trace] = None) -> Optional[Reservation]:
+    """Charge the tenant's budget for the prompt estimate plus max_tokens; raises RateLimited"""
+    if not rate_limiter.enabled:
+        return None
+    start = time.perf_counter()
+    try:
+        return await rate_limiter.reserve(tenant, request.model, estimate_prompt_tokens(messages), request.max_tokens or 0)
+    finally:
+        if trace is not None:
+            trace.since("ratelimit", start)
+
+def apply_model_route(request: ChatCompletionRequest, forced: Optional[str]) -> Optional[str]:
+    """Rewrite request.model by the routing rules; returns the route taken"""
+    if model_router is None:
+        return None
+    messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    model, route = model_router.route(
+        request.model, estimate_prompt_tokens(messages), request.max_tokens or 0,
+        lambda m: admission.gates[m].queued if m in admission.gates else 0,
+        forced=forced.strip() if forced else None
+    )
+    request.model = model
+    return route
+
+def fallback_chain(model: str) -> List[str]:
+    """Models to try in order, skipping overloaded ones while a fallback remains"""
+    if model_router is None:
+        return [model]
+    chain = model_router.chain(model)
+    depth = model_router.overload_queue_depth
+    if depth > 0:
+        chain = [m for m in chain[:-1] if not (m in admission.gates and admission.gates[m].queued >= depth)] + chain[-1:]
+    return chain
+
+def with_model(request: ChatCompletionRequest, model: str) -> ChatCompletionRequest:
+    return request if model == request.model else request.model_copy(update={"model": model})
+
+async def acquire_with_fallback(request: ChatCompletionRequest, priority: int):
+    """Take an admission slot on the first model in the fallback chain that admits; returns (ticket, request)"""
+    chain = fallback_chain(request.model)
+    for i, model in enumerate(chain):
+        try:
+            ticket = await admission.acquire(model, priority)
+        except AdmissionRejected:
+            if i == len(chain) - 1:
+                raise
+            continue
+        if model != request.model:
+            model_router.record_fallback(request.model, model)
+        return ticket, with_model(request, model)
+
+class AttemptUsage:
+    """Stands in for a Reservation while a stream may still be retried on another model"""
+
+    __slots__ = ("prompt_tokens", "used")
+
+    def __init__(self, prompt_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.used = 0
+
+    def settle(self, tokens_used: int) -> None:
+        self.used = tokens_used
+
+STREAM_ERROR_PREFIX = 'data: {"error"'
+
+async def stream_with_fallback(stream_source, request: ChatCompletionRequest, request_id: str,
+                               cache_key: Optional[str], coalesce: float, reservation: Optional[Reservation],
+                               trace: Optional[Trace], ticket, priority: int):
+    """Move to the next fallback model when a stream fails before its first frame
+    
+    `ticket` is the first model's admission slot. Each fallback model waits for a slot of
+    its own, after the previous one has been given back.
+    """
+    chain = fallback_chain(request.model)
+    used = 0
+    try:
+        for i, model in enumerate(chain):
+            if i > 0:
+                if ticket is not None:
+                    ticket.release()
+                    ticket = None
+                try:
+                    ticket = await admission.acquire(model, priority)
+                except AdmissionRejected as e:
+                    if phase_log.enabled("summary"):
+                        phase_log.event("stream.fallback_rejected", request_id, model=model, error=str(e))
+                    if i < len(chain) - 1:
+                        continue
+                    yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+                    return
+                if ticket is not None:
+                    admission_wait.labels(model_label(model)).observe(ticket.waited)
+                    if trace is not None:
+                        trace.record("queue", ticket.waited)
+            usage = AttemptUsage(reservation.prompt_tokens) if reservation is not None else None
+            # Only the requested model's output is recorded under its cache key
+            frames = stream_source(with_model(request, model), request_id, cache_key if i == 0 else None,
+                                   coalesce, usage, trace)
+            try:
+                try:
+                    first = await frames.__anext__()
+                except StopAsyncIteration:
+                    return
+                if isinstance(first, str) and first.startswith(STREAM_ERROR_PREFIX) and i < len(chain) - 1:
+                    if phase_log.enabled("summary"):
+                        phase_log.event("stream.fallback", request_id, model=model, fallback=chain[i + 1])
+                    continue
+                if model != request.model:
+                    model_router.record_fallback(request.model, model)
+                yield first
+                async for frame in frames:
+                    yield frame
+                return
+            finally:
+                await frames.aclose()
+                if usage is not None:
+                    used += usage.used
+    finally:
+        # The upstream stream is closed by now, so the slot is only freed once generation stopped
+        if ticket is not None:
+            ticket.release()
+        if reservation is not None:
+            reservation.settle(used)
+
+def open_stream(stream_source, request: ChatCompletionRequest, request_id: str, cache_key: Optional[str],
+                coalesce: float, reservation: Optional[Reservation], trace: Optional[Trace], ticket, priority: int):
+    """The stream of `request`, holding `ticket` (its admission slot) until the upstream stream ends"""
+    if model_router is not None and len(model_router.chain(request.model)) > 1:
+        return stream_with_fallback(stream_source, request, request_id, cache_key, coalesce, reservation, trace,
+                                    ticket, priority)
+    return admitted_stream(stream_source(request, request_id, cache_key, coalesce, reservation, trace), ticket)
+
+def choose_backend(model: Optional[str], messages: List[Dict[str, Any]]) -> Optional[Backend]:
+    """Prefer the backend that last served the longest prefix of this conversation; None leaves it to the pool"""
+    if prefix_affinity is None or len(upstream_pool.backends) < 2:
+        return None
+    return prefix_affinity.route(upstream_pool, model, messages)
+
+def hedged_call(key: str, first: Optional[Backend], open_attempt, served: List[Backend]):
+    """open_attempt(backend) on one backend, or raced across backends when hedging is on
+
+    The backend whose output is used is appended to `served` before its first item is yielded.
+    """
+    if hedger is None or len(upstream_pool.backends) < 2:
+        backend = first or upstream_pool.pick()
+        served.append(backend)
+        return open_attempt(backend)
+    tried: List[Backend] = []
+    
+    def start(number: int):
+        backend = first if number == 0 and first is not None else upstream_pool.pick(exclude=[b.name for b in tried])
+        tried.append(backend)
+        return open_attempt(backend)
+    
+    return hedger.stream(
+        key, start,
+        can_launch=lambda: bool(upstream_pool.available(exclude=[b.name for b in tried])),
+        retryable=is_backend_failure,
+        on_winner=lambda number: served.append(tried[number])
+    )
+
+async def cache_lookup(cache_key: str, trace: Optional[Trace] = None) -> Optional[Any]:
+    start = time.perf_counter()
+    value = await response_cache.get(cache_key)
+    if trace is not None:
+        trace.since("cache", start)
+    return value
+
+async def semantic_lookup(namespace: str, request: ChatCompletionRequest, messages: List[Dict[str, Any]],
+                          trace: Optional[Trace] = None) -> Tuple[Optional[Any], Optional[SemanticQuery]]:
+    """Cached answer to a near-duplicate prompt, and the query to file this request under on a miss"""
+    if semantic_cache is None:
+        return None, None
+    start = time.perf_counter()
+    try:
+        query = await semantic_cache.query(namespace, request.model, messages, request.max_tokens,
+                                           request.temperature, request.top_p)
+        if query is None:
+            return None, None
+        value, score = await semantic_cache.lookup(query, response_cache.get)
+    except asyncio.TimeoutError:
+        # Counted by the cache; a slow embedder is expected under load and not worth a log line per request
+        return None, None
+    except Exception as e:
+        # The semantic layer is an optimisation; a broken embedder only costs the lookup
+        logger.warning(f"Semantic cache lookup failed: {type(e).__name__}: {str(e)}")
+        return None, None
+    finally:
+        if trace is not None:
+            trace.since("semantic", start)
+    if score is not None:
+        semantic_similarity.observe(score)
+    return value, query
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was ready"""
+
+async def wait_for_disconnect(fastapi_request: Request) -> None:
+    # Once the body has been read, the next ASGI message is the disconnect
+    while (await fastapi_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def until_disconnected(fastapi_request: Request, awaitable):
+    """Await a non-streaming call, cancelling it if the client disconnects first"""
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(fastapi_request))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if not work.done():
+        work.cancel()
+        raise ClientDisconnected()
+    return work.result()
+
+async def tracked_stream(frames, model: str, start: float, trace: Optional[Trace] = None):
+    """Record in-flight and end-to-end latency metrics for a streaming response"""
+    # 499 (client closed request) unless the stream runs to the end
+    status = "499"
+    try:
+        async for frame in frames:
+            yield frame
+        status = "200"
+        if trace is not None and TRACE_SSE_COMMENT:
+            # Headers are long gone by now; SSE clients ignore comment lines
+            yield f": server-timing {trace.server_timing()}\n\n"
+    finally:
+        await frames.aclose()
+        requests_in_flight.labels(model, "true").dec()
+        request_latency.labels(model, "true").observe(time.perf_counter() - start)
+        requests_total.labels(model, "true", status).inc()
+        if trace is not None:
+            trace.finish(status)
+            traces.add(trace)
+
+async def admitted_stream(frames, ticket):
+    """Hold an admission slot until the upstream stream ends"""
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        # Close the upstream first so the slot is only freed once generation stopped
+        await frames.aclose()
+        if ticket is not None:
+            ticket.release()
+
+def replay_paced(fastapi_request: Request) -> bool:
+    """Decide whether a cached stream is replayed with its original pacing"""
+    pacing = fastapi_request.headers.get(STREAM_REPLAY_HEADER, STREAM_REPLAY_PACING).lower()
+    return pacing == "original"
+
+async def replay_stream_response(recording: StreamRecording, request_id: str, paced: bool):
+    """Replay a recorded streaming response"""
+    start_time = time.time()
+    async for frame in recording.replay(paced=paced):
+        yield frame
+    if phase_log.enabled("summary"):
+        phase_log.event("stream.replayed", request_id, frames=len(recording.frames), processing_time=elapsed(start_time))
+
+@app.on_event("startup")
+async def start_background_tasks():
+    model_catalog.start()
+    job_runner.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await model_catalog.stop()
+    await job_runner.stop()
+    if disk_cache is not None:
+        # Commit queued writes so the next process starts warm
+        await asyncio.get_running_loop().run_in_executor(None, disk_cache.close)
 
 @app.get("/")
 async def root():
     return {"message": "LMStudio Chat Completion API is running"}
 
+@app.get("/livez")
+async def liveness():
+    """Process is up and serving; never touches the upstream"""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readiness():
+    """Ready when a healthy backend and a model catalog are known, from cached state only"""
+    ready = model_catalog.ready
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "backends_healthy": sum(1 for b in upstream_pool.backends if b.healthy),
+        "catalog": model_catalog.status()
+    }
+    if not ready:
+        model_catalog.revalidate()
+        return JSONResponse(status_code=503, content=body)
+    return body
+
 @app.get("/health")
 async def health_check():
     request_id = str(uuid.uuid4())
     start_time = time.time()
     
-    logger.info(f"[{request_id}] Health check request received")
+    # Answered from cached state so probe latency does not depend on LMStudio
+    payload = model_catalog.payload
+    if payload is None or model_catalog.age > model_catalog.max_age:
+        model_catalog.revalidate()
+    
+    backends = model_catalog.backend_status()
+    connected = sum(1 for b in backends if b["healthy"] and b["models"] and not b["error"])
+    response_data = {
+        "status": "healthy" if connected else "unhealthy",
+        "lmstudio": "connected" if connected else "disconnected",
+        "models_count": len(payload["data"]) if payload else 0,
+        "backends_connected": connected,
+        "backends": backends,
+        "catalog": model_catalog.status(),
+        "request_id": request_id,
+        "processing_time": time.time() - start_time
+    }
+    if not connected:
+        response_data["error"] = model_catalog.last_error or "model catalog not loaded yet"
+    
+    return response_data
+
+def record_stream_phases(trace: Optional[Trace], sent_at: float, first_chunk_at: Optional[float],
+                         last_chunk_at: Optional[float]) -> None:
+    """Add time to first chunk and streaming duration once an upstream stream has ended"""
+    if trace is None or first_chunk_at is None:
+        return
+    trace.record("ttfc", first_chunk_at - sent_at)
+    trace.record("stream", last_chunk_at - first_chunk_at)
+
+async def generate_stream_response(request: ChatCompletionRequest, request_id: str, cache_key: Optional[str] = None,
+                                   coalesce_window: float = 0.0, reservation: Optional[Reservation] = None,
+                                   trace: Optional[Trace] = None):
+    """Generate streaming response for chat completion"""
+    start_time = time.time()
+    # Only fully completed streams are recorded into the cache
+    recording = StreamRecording() if cache_key else None
+    
+    metric_model = model_label(request.model)
+    ttft = time_to_first_token.labels(metric_model, "true")
+    chunk_gap = inter_chunk_latency.labels(metric_model, "true")
+    upstream = None
+    served: List[Backend] = []
+    content_chunks = 0
+    usage = None
+    finish_reason = None
     
     try:
-        logger.info(f"[{request_id}] Fetching models from LMStudio...")
-        models = await client.models.list()
+        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
         
-        response_data = {
-            "status": "healthy",
-            "lmstudio": "connected",
-            "models_count": len(models.data) if hasattr(models, 'data') else 0,
-            "request_id": request_id,
-            "processing_time": time.time() - start_time
-        }
+        chunk_count = 0
+        frames_sent = 0
+        content_length = 0
         
-        logger.info(f"[{request_id}] Health check successful: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
-        logger.info(f"[{request_id}] Available models: {json.dumps([model.model_dump() for model in models.data], ensure_ascii=False, indent=2) if hasattr(models, 'data') else 'No models data'}")
+        async def attempt(backend: Backend):
+            async with upstream_pool.lease(backend):
+                connect_start = time.perf_counter()
+                stream = await backend.client.chat.completions.create(
+                    model=request.model,
+                    messages=messages,
+                    temperature=request.temperature,
+                    max_tokens=request.max_tokens,
+                    top_p=request.top_p,
+                    stream=True
+                )
+                if trace is not None:
+                    trace.since("connect", connect_start)
+                try:
+                    async for chunk in stream:
+                        yield chunk
+                finally:
+                    # Dropping the connection is what makes LMStudio stop generating
+                    await stream.response.aclose()
         
-        return response_data
-    except Exception as e:
-        error_response = {
-            "status": "unhealthy",
-            "error": str(e),
-            "request_id": request_id,
-            "processing_time": time.time() - start_time
-        }
+        sent_at = time.perf_counter()
+        upstream = hedged_call(f"{metric_model}:stream", choose_backend(request.model, messages), attempt, served)
+        first_chunk_at = last_chunk_at = None
+        
+        async def received():
+            """Upstream chunks, observed before any coalescing"""
+            nonlocal chunk_count, content_chunks, content_length, usage, finish_reason, first_chunk_at, last_chunk_at
+            async for chunk in upstream:
+                chunk_count += 1
+                now = time.perf_counter()
+                if last_chunk_at is None:
+                    first_chunk_at = now
+                    ttft.observe(now - sent_at)
+                else:
+                    chunk_gap.observe(now - last_chunk_at)
+                last_chunk_at = now
+                
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content is not None:
+                    content_chunks += 1
+                    content_length += len(content)
+                if chunk.choices and chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                
+                # Per-chunk logging is sampled; the dump is only built for sampled chunks
+                if phase_log.sample_chunk():
+                    if phase_log.enabled("chunk", "full"):
+                        phase_log.event("stream.chunk", request_id, index=chunk_count, chunk=chunk.model_dump())
+                    else:
+                        phase_log.event("stream.chunk", request_id, index=chunk_count,
+                                        content_length=len(content) if content else 0)
+                yield chunk
+        
+        chunks = received()
+        if coalesce_window > 0:
+            chunks = coalesce_chunks(chunks, coalesce_window, STREAM_COALESCE_MAX_BYTES)
+        try:
+            async for chunk in chunks:
+                frames_sent += 1
+                serialize_start = time.perf_counter()
+                frame = f"data: {chunk.model_dump_json()}\n\n"
+                if trace is not None:
+                    trace.since("serialize", serialize_start)
+                if recording is not None:
+                    recording.add(time.time() - start_time, frame)
+                yield frame
+        finally:
+            await chunks.aclose()
         
-        logger.error(f"[{request_id}] Health check failed: {json.dumps(error_response, ensure_ascii=False, indent=2)}")
-        logger.error(f"[{request_id}] Exception details: {type(e).__name__}: {str(e)}")
+        record_stream_phases(trace, sent_at, first_chunk_at, last_chunk_at)
         
-        return error_response
+        if finish_reason is None:
+            # A clean EOF in the middle of generation is still a partial answer: no [DONE], no recording
+            raise ValueError("Upstream stream ended before a finish_reason")
+        
+        # Without usage in the stream, each content chunk counts as one token
+        completion_tokens = usage.completion_tokens if usage is not None else content_chunks
+        if first_chunk_at is not None and last_chunk_at > first_chunk_at:
+            output_tokens_per_second.labels(metric_model, "true").observe(
+                completion_tokens / (last_chunk_at - first_chunk_at))
+        
+        if phase_log.enabled("summary"):
+            phase_log.event("stream.completed", request_id, model=request.model, backend=served[0].name,
+                            chunks_received=chunk_count, frames_sent=frames_sent, finish_reason=finish_reason,
+                            total_content_length=content_length, processing_time=elapsed(start_time))
+        
+        if recording is not None:
+            recording.add(time.time() - start_time, "data: [DONE]\n\n")
+            response_cache.set(cache_key, recording, recording.size)
+        
+        yield "data: [DONE]\n\n"
+        
+    except (asyncio.CancelledError, GeneratorExit):
+        upstream_cancellations.labels(metric_model, "true", "client_disconnect").inc()
+        if phase_log.enabled("summary"):
+            phase_log.event("stream.cancelled", request_id, model=request.model, processing_time=elapsed(start_time))
+        raise
+    except Exception as e:
+        upstream_errors.labels(metric_model, "true", type(e).__name__).inc()
+        phase_log.error("stream.failed", request_id, error=str(e), error_type=type(e).__name__,
+                        processing_time=elapsed(start_time))
+        yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+    finally:
+        if upstream is not None:
+            await upstream.aclose()
+        if reservation is not None:
+            reservation.settle(usage.total_tokens if usage is not None else reservation.prompt_tokens + content_chunks)
 
-async def generate_stream_response(request: ChatCompletionRequest, request_id: str):
-    """Generate streaming response for chat completion"""
+async def generate_passthrough_response(request: ChatCompletionRequest, request_id: str, cache_key: Optional[str] = None,
+                                        coalesce_window: float = 0.0, reservation: Optional[Reservation] = None,
+                                        trace: Optional[Trace] = None):
+    """Stream LMStudio's SSE bytes straight through to the client"""
     start_time = time.time()
+    recording = StreamRecording() if cache_key else None
+    scanner = SSEScanner()
+    scanners: Dict[str, SSEScanner] = {}
+    served: List[Backend] = []
+    upstream = chunks = None
+    frames_sent = 0
+    metric_model = model_label(request.model)
+    ttft = time_to_first_token.labels(metric_model, "true")
+    chunk_gap = inter_chunk_latency.labels(metric_model, "true")
     
     try:
-        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
-        
-        # Log complete request details
-        request_data = {
-            "request_id": request_id,
-            "messages": messages,
+        payload = {
             "model": request.model,
+            "messages": [{"role": msg.role, "content": msg.content} for msg in request.messages],
             "temperature": request.temperature,
             "max_tokens": request.max_tokens,
             "top_p": request.top_p,
-            "stream": True,
-            "timestamp": start_time
+            "stream": True
         }
         
-        logger.info(f"[{request_id}] Starting streaming chat completion with full request: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
+        async def attempt(backend: Backend):
+            # Each attempt parses its own bytes; the winner's scanner is the one reported
+            scanners[backend.name] = SSEScanner()
+            async with upstream_pool.lease(backend):
+                async for data in stream_raw(backend.http, f"{backend.base_url}/chat/completions", payload,
+                                             scanners[backend.name],
+                                             headers={"Authorization": f"Bearer {backend.api_key}"}):
+                    yield data
         
-        stream = await client.chat.completions.create(
-            model=request.model,
-            messages=messages,
-            temperature=request.temperature,
-            max_tokens=request.max_tokens,
-            top_p=request.top_p,
-            stream=True
-        )
+        sent_at = time.perf_counter()
+        first_chunk_at = last_chunk_at = None
+        upstream = hedged_call(f"{metric_model}:stream", choose_backend(request.model, payload["messages"]),
+                               attempt, served)
         
-        chunk_count = 0
-        total_content = ""
+        async def received():
+            nonlocal first_chunk_at, last_chunk_at, scanner
+            async for data in upstream:
+                now = time.perf_counter()
+                if last_chunk_at is None:
+                    first_chunk_at = now
+                    ttft.observe(now - sent_at)
+                    scanner = scanners[served[0].name]
+                else:
+                    chunk_gap.observe(now - last_chunk_at)
+                last_chunk_at = now
+                yield data
         
-        async for chunk in stream:
-            chunk_count += 1
-            chunk_data = chunk.model_dump()
-            
-            logger.info(f"[{request_id}] Received streaming chunk #{chunk_count}: {json.dumps(chunk_data, ensure_ascii=False, indent=2)}")
-            
-            if chunk.choices[0].delta.content is not None:
-                content = chunk.choices[0].delta.content
-                total_content += content
-                logger.info(f"[{request_id}] Chunk #{chunk_count} content: {repr(content)}")
-                
-            yield f"data: {chunk.model_dump_json()}\n\n"
+        chunks = received()
+        if coalesce_window > 0:
+            chunks = coalesce_raw(chunks, coalesce_window, STREAM_COALESCE_MAX_BYTES)
+        async for data in chunks:
+            frames_sent += 1
+            if recording is not None:
+                recording.add(time.time() - start_time, data)
+            yield data
         
-        completion_summary = {
-            "chunks_received": chunk_count,
-            "total_content_length": len(total_content),
-            "total_content": repr(total_content),
-            "processing_time": time.time() - start_time
-        }
-        logger.info(f"[{request_id}] Streaming completed: {json.dumps(completion_summary, ensure_ascii=False, indent=2)}")
+        record_stream_phases(trace, sent_at, first_chunk_at, last_chunk_at)
         
-        yield "data: [DONE]\n\n"
+        if scanner.usage and first_chunk_at is not None and last_chunk_at > first_chunk_at:
+            output_tokens_per_second.labels(metric_model, "true").observe(
+                scanner.usage.get("completion_tokens", 0) / (last_chunk_at - first_chunk_at))
         
-    except Exception as e:
-        error_data = {
-            "error": str(e),
-            "error_type": type(e).__name__,
-            "processing_time": time.time() - start_time,
-            "request_id": request_id
-        }
+        if phase_log.enabled("summary"):
+            phase_log.event("stream.completed", request_id, model=request.model, backend=served[0].name, passthrough=True,
+                            frames=scanner.frames, frames_sent=frames_sent, bytes=scanner.bytes_seen,
+                            finish_reason=scanner.finish_reason,
+                            usage=scanner.usage, processing_time=elapsed(start_time))
+        
+        # A stream cut short upstream is forwarded as it came, but never stored
+        if scanner.finish_reason is None and not scanner.done:
+            phase_log.error("stream.incomplete", request_id, passthrough=True, frames=scanner.frames,
+                            processing_time=elapsed(start_time))
+        elif recording is not None:
+            response_cache.set(cache_key, recording, recording.size)
         
-        logger.error(f"[{request_id}] Streaming error: {json.dumps(error_data, ensure_ascii=False, indent=2)}")
-        yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
+    except (asyncio.CancelledError, GeneratorExit):
+        upstream_cancellations.labels(metric_model, "true", "client_disconnect").inc()
+        if phase_log.enabled("summary"):
+            phase_log.event("stream.cancelled", request_id, model=request.model, passthrough=True,
+                            frames=scanner.frames, processing_time=elapsed(start_time))
+        raise
+    except Exception as e:
+        upstream_errors.labels(metric_model, "true", type(e).__name__).inc()
+        phase_log.error("stream.failed", request_id, passthrough=True, error=str(e), error_type=type(e).__name__,
+                        processing_time=elapsed(start_time))
+        yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+    finally:
+        if chunks is not None:
+            await chunks.aclose()
+        if upstream is not None:
+            await upstream.aclose()
+        if reservation is not None:
+            # Without usage in the stream, each SSE frame counts as one token
+            used = scanner.usage.get("total_tokens") if scanner.usage else None
+            reservation.settle(used if used is not None else reservation.prompt_tokens + scanner.frames)
+
+async def fetch_chat_completion(request: ChatCompletionRequest, messages: List[Dict[str, Any]],
+                                request_id: str, priority: int, trace: Optional[Trace] = None) -> Dict[str, Any]:
+    """Run one non-streaming completion against LMStudio"""
+    metric_model = model_label(request.model)
+    async with admission.slot(request.model, priority) as ticket:
+        if ticket is not None:
+            admission_wait.labels(metric_model).observe(ticket.waited)
+            if trace is not None:
+                trace.record("queue", ticket.waited)
+        try:
+            async def attempt(backend: Backend):
+                async with upstream_pool.lease(backend):
+                    # Raw bytes: the body is decoded once here instead of into SDK models
+                    response = await backend.client.chat.completions.with_raw_response.create(
+                        model=request.model,
+                        messages=messages,
+                        temperature=request.temperature,
+                        max_tokens=request.max_tokens,
+                        top_p=request.top_p,
+                        stream=False
+                    )
+                yield response.content
+            
+            sent_at = time.perf_counter()
+            upstream = hedged_call(f"{metric_model}:complete", choose_backend(request.model, messages), attempt, [])
+            try:
+                # Cancelling the call closes its connection, which aborts the generation upstream
+                upstream_response = await asyncio.wait_for(upstream.__anext__(), timeout=REQUEST_TIMEOUT or None)
+            finally:
+                await upstream.aclose()
+            generation_time = time.perf_counter() - sent_at
+            if trace is not None:
+                trace.record("upstream", generation_time)
+        except asyncio.TimeoutError:
+            upstream_cancellations.labels(metric_model, "false", "timeout").inc()
+            raise
+        except asyncio.CancelledError:
+            upstream_cancellations.labels(metric_model, "false", "client_disconnect").inc()
+            raise
+        except Exception as e:
+            upstream_errors.labels(metric_model, "false", type(e).__name__).inc()
+            raise
+    
+    payload = fast_json.loads(upstream_response)
+    if not isinstance(payload, dict) or not isinstance(payload.get("choices"), list):
+        raise ValueError("Upstream response is not a chat completion")
+    usage = payload.get("usage") or {}
+    if usage.get("completion_tokens") and generation_time > 0:
+        output_tokens_per_second.labels(metric_model, "false").observe(usage["completion_tokens"] / generation_time)
+    
+    # The upstream object goes out as received, top-level fields such as system_fingerprint included
+    final_response = payload
+    final_response["model"] = payload.get("model") or request.model
+    final_response["usage"] = usage
+    if phase_log.enabled("summary", "full"):
+        phase_log.event("chat.response", request_id, response=final_response)
+    
+    return final_response
+
+async def fetch_with_fallback(request: ChatCompletionRequest, messages: List[Dict[str, Any]], request_id: str,
+                              priority: int, trace: Optional[Trace] = None) -> Tuple[Dict[str, Any], bool]:
+    """fetch_chat_completion down the fallback chain; returns (response, fell back)"""
+    chain = fallback_chain(request.model)
+    for i, model in enumerate(chain):
+        try:
+            final_response = await fetch_chat_completion(with_model(request, model), messages, request_id, priority, trace)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # A timeout is not "before the first token": the model was already generating
+            raise
+        except Exception as e:
+            if i == len(chain) - 1:
+                raise
+            if phase_log.enabled("summary"):
+                phase_log.event("chat.fallback", request_id, model=model, fallback=chain[i + 1],
+                                error=str(e), error_type=type(e).__name__)
+            continue
+        if model != request.model:
+            model_router.record_fallback(request.model, model)
+        return final_response, model != request.model
+
+def serialize(response: Dict[str, Any], trace: Optional[Trace] = None) -> bytes:
+    start = time.perf_counter()
+    body = fast_json.dumps(response)
+    if trace is not None:
+        trace.since("serialize", start)
+    return body
+
+async def complete_chat(request: ChatCompletionRequest, messages: List[Dict[str, Any]], request_id: str,
+                        priority: int, bypass_cache: bool, tenant: str,
+                        trace: Optional[Trace] = None) -> Tuple[CachedCompletion, str]:
+    """Answer a non-streaming request from the cache, a shared flight or LMStudio
+    
+    Returns (completion, X-Cache). The body is encoded once, when the upstream answer
+    arrives, and is all the cache keeps: hits send it as it was stored.
+    """
+    cache_key = make_cache_key(request.model, messages, request.temperature, request.top_p, request.max_tokens)
+    bypass_cache = bypass_cache or not cacheable(request)
+    query = None
+    if not bypass_cache:
+        cached = await cache_lookup(cache_key, trace)
+        if cached is not None:
+            return cached, "HIT"
+        cached, query = await semantic_lookup("complete", request, messages, trace)
+        if cached is not None:
+            return cached, "SEMANTIC"
+    
+    # Only requests that may reach LMStudio are charged against the tenant's budget
+    reservation = await reserve_tokens(tenant, request, messages, trace)
+    try:
+        if SINGLE_FLIGHT_ENABLED:
+            flight_start = time.perf_counter()
+            (final_response, fell_back), shared = await single_flight.do(
+                cache_key, lambda: fetch_with_fallback(request, messages, request_id, priority, trace)
+            )
+            if shared and trace is not None:
+                trace.since("coalesced", flight_start)
+        else:
+            (final_response, fell_back), shared = await fetch_with_fallback(request, messages, request_id, priority, trace), False
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # Generation ran until it was aborted; keep the estimate charged
+        raise
+    except Exception:
+        if reservation is not None:
+            reservation.cancel()
+        raise
+    
+    if reservation is not None:
+        # Joining someone else's flight generated nothing extra
+        reservation.settle(0 if shared else (final_response.get("usage") or {}).get("total_tokens", reservation.charged))
+    
+    body = serialize(final_response, trace)
+    completion = CachedCompletion(body, final_response.get("usage"))
+    if bypass_cache:
+        return completion, "BYPASS"
+    if shared:
+        return completion, "COALESCED"
+    if fell_back:
+        # A fallback model's answer must not be served later as the requested model's
+        return completion, "MISS"
+    response_cache.set(cache_key, completion, len(body))
+    if query is not None:
+        semantic_cache.add(query, cache_key)
+    return completion, "MISS"
+
+async def open_chat_stream(request: ChatCompletionRequest, messages: List[Dict[str, Any]], request_id: str,
+                           tenant: str, priority: int, bypass_cache: bool, coalesce: float, passthrough: bool,
+                           paced: bool, trace: Trace):
+    """Frames for a streaming request from the cache, a shared stream or LMStudio; returns (frames, X-Cache)
+    
+    Rate limit and admission are decided before this returns, so RateLimited and
+    AdmissionRejected surface while the caller can still answer with an error.
+    """
+    # Coalesced streams are framed differently, so they neither share flights nor recordings with others
+    namespace = f"stream:coalesce={coalesce:g}" if coalesce else "stream"
+    stream_key = make_cache_key(request.model, messages, request.temperature, request.top_p, request.max_tokens,
+                                namespace=namespace)
+    bypass_cache = bypass_cache or not cacheable(request)
+    cache_key = None if bypass_cache else stream_key
+    
+    recording = await cache_lookup(cache_key, trace) if cache_key else None
+    if recording is not None:
+        return replay_stream_response(recording, request_id, paced), "HIT"
+    query = None
+    if cache_key:
+        recording, query = await semantic_lookup(namespace, request, messages, trace)
+        if recording is not None:
+            return replay_stream_response(recording, request_id, paced), "SEMANTIC"
+    
+    cache_status = "BYPASS" if bypass_cache else "MISS"
+    stream_source = generate_passthrough_response if passthrough else generate_stream_response
+    
+    # Joining a shared stream needs neither a token reservation nor an admission slot
+    ticket = None
+    reservation = None
+    served = request
+    if not (SINGLE_FLIGHT_ENABLED and stream_broadcaster.joinable(stream_key)):
+        reservation = await reserve_tokens(tenant, request, messages, trace)
+        try:
+            ticket, served = await acquire_with_fallback(request, priority)
+        except AdmissionRejected:
+            if reservation is not None:
+                reservation.cancel()
+            raise
+        if ticket is not None:
+            admission_wait.labels(model_label(served.model)).observe(ticket.waited)
+            trace.record("queue", ticket.waited)
+    # A stream moved to a fallback model at admission is not recorded under the requested model's key
+    served_cache_key = cache_key if served is request else None
+    if query is not None and served_cache_key:
+        # Filed now; paraphrases find the recording once the stream has completed
+        semantic_cache.add(query, served_cache_key)
+    
+    if SINGLE_FLIGHT_ENABLED:
+        frames, shared = stream_broadcaster.subscribe(
+            stream_key,
+            lambda: open_stream(stream_source, served, request_id, served_cache_key, coalesce, reservation, trace,
+                                ticket, priority)
+        )
+        if shared:
+            cache_status = "COALESCED"
+            if ticket is not None:
+                ticket.release()
+            if reservation is not None:
+                reservation.cancel()
+    else:
+        frames = open_stream(stream_source, served, request_id, served_cache_key, coalesce, reservation, trace,
+                             ticket, priority)
+    return frames, cache_status
 
 @app.post("/chat/completions")
 async def chat_completions(request: ChatCompletionRequest, fastapi_request: Request):
     """Handle both streaming and non-streaming chat completions"""
     request_id = str(uuid.uuid4())
     start_time = time.time()
+    start_perf = time.perf_counter()
+    # Routed before anything is labelled, so metrics and cache keys see the model actually asked of LMStudio
+    route = apply_model_route(request, fastapi_request.headers.get(MODEL_ROUTE_HEADER))
+    metric_model = model_label(request.model)
+    stream_label = "true" if request.stream else "false"
+    tenant = tenant_id(fastapi_request.headers, RATE_LIMIT_TENANT_HEADER)
+    requests_in_flight.labels(metric_model, stream_label).inc()
+    # The trace starts when the request arrived, so body parsing and validation show up as "parse"
+    arrived = received_at(fastapi_request.scope)
+    trace = Trace(request_id, request.model, bool(request.stream), start=arrived)
+    if arrived is not None:
+        trace.record("parse", start_perf - arrived)
+    status = "500"
+    # Streaming responses hand their metrics and trace over to tracked_stream
+    handed_off = False
     
     try:
         messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
         
-        # Log complete request details
-        request_data = {
-            "request_id": request_id,
-            "client_ip": fastapi_request.client.host if fastapi_request.client else "unknown",
-            "method": fastapi_request.method,
-            "url": str(fastapi_request.url),
-            "headers": dict(fastapi_request.headers),
-            "request_body": {
-                "messages": messages,
+        # Request headers are never logged: they carry the caller's API key
+        if phase_log.enabled("request"):
+            request_fields = {
+                "client_ip": fastapi_request.client.host if fastapi_request.client else "unknown",
                 "model": request.model,
+                "stream": request.stream,
                 "temperature": request.temperature,
                 "max_tokens": request.max_tokens,
                 "top_p": request.top_p,
-                "stream": request.stream
+                "message_count": len(messages)
             }
-        }
-        
-        logger.info(f"[{request_id}] Chat completion request received: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
+            if phase_log.enabled("request", "full"):
+                request_fields["messages"] = messages
+            phase_log.event("chat.request", request_id, **request_fields)
         
         if request.stream:
-            logger.info(f"[{request_id}] Starting streaming response")
+            frames, cache_status = await open_chat_stream(
+                request, messages, request_id, tenant, request_priority(request, fastapi_request),
+                cache_bypassed(fastapi_request), coalesce_window(fastapi_request),
+                passthrough_enabled(fastapi_request), replay_paced(fastapi_request), trace
+            )
+            trace.cache = cache_status
+            headers = {
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Request-ID": request_id,
+                "X-Cache": cache_status,
+                "Server-Timing": trace.server_timing()
+            }
+            if route:
+                headers["X-Model-Route"] = route
+            handed_off = True
             return StreamingResponse(
-                generate_stream_response(request, request_id),
+                tracked_stream(frames, metric_model, start_perf, trace),
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Request-ID": request_id
-                }
+                # Upstream phases follow in the trailing ": server-timing" comment
+                headers=headers
             )
         else:
-            logger.info(f"[{request_id}] Starting non-streaming chat completion")
-            
-            # Log the request being sent to LMStudio
-            lmstudio_request = {
-                "model": request.model,
-                "messages": messages,
-                "temperature": request.temperature,
-                "max_tokens": request.max_tokens,
-                "top_p": request.top_p,
-                "stream": False
-            }
-            
-            logger.info(f"[{request_id}] Sending request to LMStudio: {json.dumps(lmstudio_request, ensure_ascii=False, indent=2)}")
+            completion, cache_status = await until_disconnected(fastapi_request, complete_chat(
+                request, messages, request_id, request_priority(request, fastapi_request), cache_bypassed(fastapi_request),
+                tenant, trace
+            ))
+            trace.cache = cache_status
             
-            response = await client.chat.completions.create(
-                model=request.model,
-                messages=messages,
-                temperature=request.temperature,
-                max_tokens=request.max_tokens,
-                top_p=request.top_p,
-                stream=False
-            )
+            if phase_log.enabled("summary"):
+                phase_log.event("chat.completed", request_id, cache=cache_status,
+                                usage=completion.usage, processing_time=elapsed(start_time))
             
-            # Log complete response from LMStudio
-            response_data = response.model_dump()
-            logger.info(f"[{request_id}] Received complete response from LMStudio: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
-            
-            # Create response object
-            api_response = ChatCompletionResponse(
-                id=response.id,
-                object=response.object,
-                created=response.created,
-                model=response.model,
-                choices=[choice.model_dump() for choice in response.choices],
-                usage=response.usage.model_dump()
-            )
-            
-            # Log final response being sent to client
-            final_response = api_response.model_dump()
-            logger.info(f"[{request_id}] Sending response to client: {json.dumps(final_response, ensure_ascii=False, indent=2)}")
-            logger.info(f"[{request_id}] Request completed in {time.time() - start_time:.2f}s")
-            
-            return api_response
+            status = "200"
+            requests_total.labels(metric_model, stream_label, status).inc()
+            headers = {"X-Cache": cache_status, "X-Request-ID": request_id, "Server-Timing": trace.server_timing()}
+            if route:
+                headers["X-Model-Route"] = route
+            return Response(content=completion.body, media_type="application/json", headers=headers)
             
+    except RateLimited as e:
+        status = "429"
+        requests_total.labels(metric_model, stream_label, status).inc()
+        phase_log.error("chat.rate_limited", request_id, model=request.model, tenant=tenant,
+                        error=str(e), retry_after=e.retry_after, processing_time=elapsed(start_time))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except AdmissionRejected as e:
+        status_code = 429 if isinstance(e, QueueFullError) else 503
+        status = str(status_code)
+        requests_total.labels(metric_model, stream_label, status).inc()
+        phase_log.error("chat.rejected", request_id, model=request.model, status_code=status_code,
+                        error=str(e), retry_after=e.retry_after, processing_time=elapsed(start_time))
+        raise HTTPException(status_code=status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ClientDisconnected:
+        status = "499"
+        requests_total.labels(metric_model, stream_label, status).inc()
+        if phase_log.enabled("summary"):
+            phase_log.event("chat.cancelled", request_id, reason="client_disconnect", processing_time=elapsed(start_time))
+        # Nobody is left to read this
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        status = "504"
+        requests_total.labels(metric_model, stream_label, status).inc()
+        phase_log.error("chat.timeout", request_id, model=request.model, timeout=REQUEST_TIMEOUT,
+                        processing_time=elapsed(start_time))
+        raise HTTPException(status_code=504, detail=f"Upstream did not respond within {REQUEST_TIMEOUT:g}s")
     except Exception as e:
-        error_data = {
-            "error": str(e),
-            "error_type": type(e).__name__,
-            "request_id": request_id,
-            "processing_time": time.time() - start_time
-        }
-        
-        logger.error(f"[{request_id}] Chat completion error: {json.dumps(error_data, ensure_ascii=False, indent=2)}")
-        logger.error(f"[{request_id}] Exception details: {type(e).__name__}: {str(e)}")
+        requests_total.labels(metric_model, stream_label, "500").inc()
+        phase_log.error("chat.failed", request_id, error=str(e), error_type=type(e).__name__,
+                        processing_time=elapsed(start_time))
         
         raise HTTPException(status_code=500, detail=f"Chat completion failed: {str(e)}")
+    finally:
+        if not handed_off:
+            requests_in_flight.labels(metric_model, stream_label).dec()
+            request_latency.labels(metric_model, stream_label).observe(time.perf_counter() - start_perf)
+            trace.finish(status)
+            traces.add(trace)
+
+async def open_mux_stream(connection: WebSocket, request_id: str, tenant: str, body: Dict[str, Any]):
+    """One WebSocket stream through the same pipeline, metrics and trace as a streaming POST"""
+    try:
+        request = ChatCompletionRequest(**body)
+    except (TypeError, ValidationError) as e:
+        raise StreamRejected(str(e), 400)
+    request.stream = True
+    apply_model_route(request, connection.headers.get(MODEL_ROUTE_HEADER))
+    metric_model = model_label(request.model)
+    start_perf = time.perf_counter()
+    trace = Trace(request_id, request.model, True, start=start_perf)
+    requests_in_flight.labels(metric_model, "true").inc()
+    status = "500"
+    handed_off = False
+    try:
+        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        frames, trace.cache = await open_chat_stream(
+            request, messages, request_id, tenant, request_priority(request, connection), cache_bypassed(connection),
+            coalesce_window(connection), passthrough_enabled(connection), replay_paced(connection), trace
+        )
+        handed_off = True
+        return tracked_stream(frames, metric_model, start_perf, trace)
+    except RateLimited as e:
+        status = "429"
+        raise StreamRejected(str(e), 429, e.retry_after)
+    except AdmissionRejected as e:
+        status = "429" if isinstance(e, QueueFullError) else "503"
+        raise StreamRejected(str(e), int(status), e.retry_after)
+    except asyncio.CancelledError:
+        status = "499"
+        raise
+    except Exception as e:
+        phase_log.error("ws.stream_failed", request_id, error=str(e), error_type=type(e).__name__)
+        raise StreamRejected(f"Chat completion failed: {str(e)}", 500)
+    finally:
+        if not handed_off:
+            requests_in_flight.labels(metric_model, "true").dec()
+            request_latency.labels(metric_model, "true").observe(time.perf_counter() - start_perf)
+            requests_total.labels(metric_model, "true", status).inc()
+            trace.finish(status)
+            traces.add(trace)
+
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    """Multiplex streaming completions over one connection; the protocol is described in ws_mux.MuxSession"""
+    connection_id = str(uuid.uuid4())
+    start_time = time.time()
+    await websocket.accept()
+    # Tenant, priority, routing and cache headers apply to every stream of the connection
+    tenant = tenant_id(websocket.headers, RATE_LIMIT_TENANT_HEADER)
+    
+    async def open_ws_stream(stream_id: str, body: Dict[str, Any]):
+        return await open_mux_stream(websocket, f"{connection_id}:{stream_id}", tenant, body)
+    
+    async def receive_text() -> str:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        text = message.get("text")
+        if text is None:
+            # The protocol is JSON text; 1003 is the close code for data a server cannot accept
+            await websocket.close(code=1003)
+            raise WebSocketDisconnect(1003)
+        return text
+    
+    session = MuxSession(websocket.send_text, open_ws_stream, max_streams=WS_MAX_STREAMS, window=WS_STREAM_WINDOW)
+    websocket_connections.labels().inc()
+    try:
+        await session.run(receive_text)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        websocket_connections.labels().dec()
+        if phase_log.enabled("summary"):
+            phase_log.event("ws.closed", connection_id, streams=session.started, cancelled=session.cancelled,
+                            processing_time=elapsed(start_time))
+
+async def run_batch_item(number: int, line: Any, batch_id: str, priority: int, bypass_cache: bool,
+                         tenant: str, forced_route: Optional[str] = None) -> Dict[str, Any]:
+    """Run one JSONL line as a non-streaming completion; failures become an inline error result"""
+    result: Dict[str, Any] = {"custom_id": None, "line": number}
+    request_id = f"{batch_id}:{number}"
+    start_perf = time.perf_counter()
+    model = MODEL_NAME
+    try:
+        if line is LINE_TOO_LONG:
+            raise ValueError(f"Line exceeds {BATCH_MAX_LINE_BYTES} bytes")
+        item = json.loads(line)
+        if not isinstance(item, dict):
+            raise ValueError("Each line must be a JSON object")
+        result["custom_id"] = item.get("custom_id")
+        # Either {"custom_id": ..., "body": {...}} as in the OpenAI batch format, or a flat request
+        body = item.get("body", item)
+        if not isinstance(body, dict):
+            raise ValueError("body must be a JSON object")
+        request = ChatCompletionRequest(**{k: v for k, v in body.items() if k != "custom_id"})
+        request.stream = False
+        apply_model_route(request, forced_route)
+        model = model_label(request.model)
+    except (ValueError, TypeError, ValidationError) as e:
+        batch_items.labels("400").inc()
+        result.update(status=400, error={"message": str(e), "type": "invalid_request"})
+        return result
+    
+    stream_label = "false"
+    requests_in_flight.labels(model, stream_label).inc()
+    try:
+        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        completion, cache_status = await complete_chat(request, messages, request_id, priority, bypass_cache, tenant)
+        result.update(status=200, cache=cache_status, response=completion.response)
+    except RateLimited as e:
+        result.update(status=429, retry_after=e.retry_after, error={"message": str(e), "type": "rate_limited"})
+    except AdmissionRejected as e:
+        status_code = 429 if isinstance(e, QueueFullError) else 503
+        result.update(status=status_code, retry_after=e.retry_after,
+                      error={"message": str(e), "type": type(e).__name__})
+    except asyncio.TimeoutError:
+        result.update(status=504, error={"message": f"Upstream did not respond within {REQUEST_TIMEOUT:g}s",
+                                         "type": "timeout"})
+    except Exception as e:
+        phase_log.error("batch.item_failed", request_id, error=str(e), error_type=type(e).__name__)
+        result.update(status=500, error={"message": f"Chat completion failed: {str(e)}", "type": type(e).__name__})
+    finally:
+        requests_in_flight.labels(model, stream_label).dec()
+        request_latency.labels(model, stream_label).observe(time.perf_counter() - start_perf)
+    
+    status = str(result["status"])
+    requests_total.labels(model, stream_label, status).inc()
+    batch_items.labels(status).inc()
+    return result
+
+@app.post("/chat/completions/batch")
+async def chat_completions_batch(fastapi_request: Request):
+    """Run a JSONL body of chat requests, streaming one JSON result line per item as each finishes
+    
+    The body is read incrementally, so results start flowing before the upload ends. Results
+    come back in completion order; match them up by custom_id or line.
+    """
+    batch_id = str(uuid.uuid4())
+    start_time = time.time()
+    try:
+        parallelism = int(fastapi_request.query_params.get("parallelism", BATCH_PARALLELISM))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="parallelism must be an integer")
+    parallelism = max(1, min(parallelism, BATCH_MAX_PARALLELISM))
+    priority = parse_priority(fastapi_request.headers.get(PRIORITY_HEADER), PRIORITY_CLASSES["batch"])
+    bypass_cache = cache_bypassed(fastapi_request)
+    tenant = tenant_id(fastapi_request.headers, RATE_LIMIT_TENANT_HEADER)
+    forced_route = fastapi_request.headers.get(MODEL_ROUTE_HEADER)
+    
+    async def results():
+        counts: Dict[str, int] = {}
+        try:
+            async for result in run_batch(
+                read_lines(fastapi_request.stream(), BATCH_MAX_LINE_BYTES),
+                lambda number, line: run_batch_item(number, line, batch_id, priority, bypass_cache, tenant, forced_route),
+                parallelism,
+                disconnected=lambda: wait_for_disconnect(fastapi_request)
+            ):
+                status = str(result.get("status", "error"))
+                counts[status] = counts.get(status, 0) + 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            if phase_log.enabled("summary"):
+                phase_log.event("batch.completed", batch_id, parallelism=parallelism, results=counts,
+                                processing_time=elapsed(start_time))
+    
+    return BatchStreamingResponse(results(), media_type="application/x-ndjson", headers={"X-Request-ID": batch_id})
+
+async def job_frames(request: ChatCompletionRequest, job_id: str, priority: int, tenant: str):
+    """Generate a job through the streaming path, charged, admitted, measured and traced like any other stream"""
+    start_perf = time.perf_counter()
+    metric_model = model_label(request.model)
+    trace = Trace(job_id, request.model, True, start=start_perf)
+    requests_in_flight.labels(metric_model, "true").inc()
+    status = "500"
+    frames = None
+    try:
+        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        reservation = await reserve_tokens(tenant, request, messages, trace)
+        try:
+            ticket, served = await acquire_with_fallback(request, priority)
+        except BaseException:
+            if reservation is not None:
+                reservation.cancel()
+            raise
+        if ticket is not None:
+            admission_wait.labels(model_label(served.model)).observe(ticket.waited)
+            trace.record("queue", ticket.waited)
+        frames = tracked_stream(
+            open_stream(generate_stream_response, served, job_id, None, 0.0, reservation, trace, ticket, priority),
+            metric_model, start_perf, trace
+        )
+    except RateLimited:
+        status = "429"
+        raise
+    except AdmissionRejected as e:
+        status = "429" if isinstance(e, QueueFullError) else "503"
+        raise
+    except asyncio.CancelledError:
+        status = "499"
+        raise
+    finally:
+        # Once frames exist, tracked_stream records the outcome
+        if frames is None:
+            requests_in_flight.labels(metric_model, "true").dec()
+            request_latency.labels(metric_model, "true").observe(time.perf_counter() - start_perf)
+            requests_total.labels(metric_model, "true", status).inc()
+            trace.finish(status)
+            traces.add(trace)
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        await frames.aclose()
+
+@app.post("/jobs/chat/completions", status_code=202)
+async def submit_job(request: ChatCompletionRequest, fastapi_request: Request):
+    """Accept a chat completion as a background job and return its id right away
+    
+    Poll GET /jobs/{id} for the result, or follow GET /jobs/{id}/events for the stream.
+    Jobs wait for admission in the batch class, so interactive traffic goes first.
+    """
+    job_id = f"job-{uuid.uuid4()}"
+    route = apply_model_route(request, fastapi_request.headers.get(MODEL_ROUTE_HEADER))
+    request.stream = True
+    priority = parse_priority(fastapi_request.headers.get(PRIORITY_HEADER), PRIORITY_CLASSES["batch"])
+    tenant = tenant_id(fastapi_request.headers, RATE_LIMIT_TENANT_HEADER)
+    job = Job(job_id, request.model, lambda: job_frames(request, job_id, priority, tenant))
+    try:
+        job_runner.submit(job)
+    except JobsFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if phase_log.enabled("request"):
+        phase_log.event("job.submitted", job_id, model=request.model, max_tokens=request.max_tokens,
+                        message_count=len(request.messages), queued=job_runner.queued)
+    headers = {"Location": f"/jobs/{job_id}", "X-Request-ID": job_id}
+    if route:
+        headers["X-Model-Route"] = route
+    return JSONResponse(status_code=202, content=job.to_dict(), headers=headers)
+
+@app.get("/jobs/stats")
+async def job_stats():
+    """Report the job queue, workers and store usage"""
+    return job_runner.stats()
+
+def find_job(job_id: str) -> Job:
+    job = job_runner.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a job, with the assembled chat.completion once it is completed"""
+    return find_job(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, fastapi_request: Request, offset: Optional[int] = None):
+    """The job's SSE stream from the start, from ?offset=N or after the Last-Event-ID the client reconnects with"""
+    job = find_job(job_id)
+    if offset is None:
+        last_event_id = fastapi_request.headers.get("last-event-id")
+        try:
+            offset = int(last_event_id) + 1 if last_event_id is not None else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be a frame number")
+    return StreamingResponse(
+        job.events(offset, JOB_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Request-ID": job_id}
+    )
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; its upstream generation is aborted"""
+    job = find_job(job_id)
+    if not job_runner.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already {job.status}")
+    return {"id": job_id, "status": "cancelling" if job.status == "running" else job.status}
 
 @app.get("/models")
 async def list_models(fastapi_request: Request):
     request_id = str(uuid.uuid4())
     start_time = time.time()
     
-    logger.info(f"[{request_id}] Models list request received from {fastapi_request.client.host if fastapi_request.client else 'unknown'}")
+    payload = await model_catalog.get()
+    if not payload or (not payload["data"] and model_catalog.last_error):
+        phase_log.error("models.failed", request_id, error=model_catalog.last_error, processing_time=elapsed(start_time))
+        raise HTTPException(status_code=503, detail=f"Failed to connect to LMStudio: {model_catalog.last_error}")
+    
+    headers = {"ETag": model_catalog.etag, "Cache-Control": f"max-age={int(model_catalog.max_age)}"}
+    if_none_match = fastapi_request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        # If-None-Match uses the weak comparison, so a W/ tag of the same value matches too
+        if "*" in tags or model_catalog.etag in {tag.removeprefix("W/") for tag in tags}:
+            return Response(status_code=304, headers=headers)
     
+    return Response(content=model_catalog.body, media_type="application/json", headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition"""
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Report response cache counters"""
+    disk_stats = None
+    if disk_cache is not None:
+        # Counting the entries scans the SQLite table; kept off the event loop like every other read
+        disk_stats = await asyncio.get_running_loop().run_in_executor(None, disk_cache.stats)
+    return {
+        "enabled": RESPONSE_CACHE_ENABLED,
+        "response_cache": response_cache.stats(),
+        "disk_cache": disk_stats,
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "single_flight": single_flight.stats(),
+        "stream_broadcaster": stream_broadcaster.stats()
+    }
+
+@app.get("/admission/stats")
+async def admission_stats():
+    """Report per-model concurrency, queue depth and wait time"""
+    return {
+        "default_concurrency": ADMISSION_CONCURRENCY,
+        "max_queue": ADMISSION_MAX_QUEUE,
+        "queue_timeout": ADMISSION_QUEUE_TIMEOUT,
+        "models": admission.stats()
+    }
+
+@app.get("/debug/requests")
+async def debug_requests(min_ms: float = 0.0, limit: int = 100):
+    """Most recent request traces, newest first; min_ms keeps only requests at least that slow"""
+    found = traces.query(min_duration=min_ms / 1000, limit=max(0, limit))
+    return {
+        "buffer_size": traces.size,
+        "recorded": traces.recorded,
+        "requests": [trace.to_dict() for trace in found]
+    }
+
+@app.get("/debug/requests/{request_id}")
+async def debug_request(request_id: str):
+    """One trace by its X-Request-ID"""
+    trace = traces.find(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"No trace for request {request_id} in the buffer")
+    return trace.to_dict()
+
+def require_admin(fastapi_request: Request) -> None:
+    """Gate the profiling and cache admin endpoints behind DEBUG_ADMIN_TOKEN"""
+    if not DEBUG_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled; set DEBUG_ADMIN_TOKEN to enable them")
+    supplied = fastapi_request.headers.get(DEBUG_ADMIN_HEADER, "")
+    if not hmac.compare_digest(supplied.encode("utf-8"), DEBUG_ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/debug/profile")
+async def debug_profile(fastapi_request: Request, seconds: float = 10.0, interval_ms: float = 5.0):
+    """Sample every thread's stack for N seconds; returns collapsed stacks for flamegraph tools"""
+    require_admin(fastapi_request)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
     try:
-        logger.info(f"[{request_id}] Fetching models from LMStudio...")
-        models = await client.models.list()
-        
-        # Log complete models response
-        models_data = models.model_dump()
-        logger.info(f"[{request_id}] Models retrieved successfully: {json.dumps(models_data, ensure_ascii=False, indent=2)}")
-        
-        # Log individual model details
-        if hasattr(models, 'data') and models.data:
-            for i, model in enumerate(models.data):
-                model_info = model.model_dump()
-                logger.info(f"[{request_id}] Model {i+1}: {json.dumps(model_info, ensure_ascii=False, indent=2)}")
-        
-        processing_time = time.time() - start_time
-        logger.info(f"[{request_id}] Models request completed in {processing_time:.2f}s")
-        
-        return models_data
-    except Exception as e:
-        error_data = {
-            "error": str(e),
-            "error_type": type(e).__name__,
-            "request_id": request_id,
-            "processing_time": time.time() - start_time
-        }
-        
-        logger.error(f"[{request_id}] Error fetching models: {json.dumps(error_data, ensure_ascii=False, indent=2)}")
-        logger.error(f"[{request_id}] Exception details: {type(e).__name__}: {str(e)}")
-        
-        raise HTTPException(status_code=503, detail=f"Failed to connect to LMStudio: {str(e)}")
+        # The sampler runs on a worker thread so the event loop keeps running and shows up in the samples
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            None, stack_sampler.sample, seconds, max(interval_ms, 1.0) / 1000
+        )
+    except ProfileBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(content=StackSampler.collapsed(stacks), media_type="text/plain; charset=utf-8",
+                    headers={"X-Profile-Samples": str(sum(stacks.values()))})
+
+@app.get("/debug/asyncio")
+async def debug_asyncio(fastapi_request: Request, seconds: float = 5.0, threshold_ms: float = 50.0):
+    """Pending tasks now, then slow callbacks and event loop lag over the next N seconds"""
+    require_admin(fastapi_request)
+    seconds = max(0.0, min(seconds, PROFILE_MAX_SECONDS))
+    tasks = pending_tasks(exclude=asyncio.current_task())
+    try:
+        loop_report = await watch_event_loop(seconds, max(threshold_ms, 1.0) / 1000) if seconds else None
+    except ProfileBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"pending_tasks": len(tasks), "tasks": tasks, "event_loop": loop_report}
+
+@app.get("/routing/stats")
+async def routing_stats():
+    """Report routing rules, how often each was taken and fallbacks between models"""
+    if model_router is None:
+        return {"enabled": False, "routes_file": MODEL_ROUTES_FILE or None}
+    return {"enabled": True, "routes_file": MODEL_ROUTES_FILE, **model_router.stats()}
+
+@app.get("/affinity/stats")
+async def affinity_stats():
+    """Report prefix affinity hits, bounded-load fallbacks and table size"""
+    return {
+        "enabled": prefix_affinity is not None and len(upstream_pool.backends) > 1,
+        "prefix_affinity": prefix_affinity.stats() if prefix_affinity is not None else None,
+        "backends": upstream_pool.status()
+    }
+
+@app.get("/hedging/stats")
+async def hedging_stats():
+    """Report hedges, retries, the retry budget and the current hedge delay per model"""
+    return {
+        "enabled": hedger is not None and len(upstream_pool.backends) > 1,
+        "hedging": hedger.stats() if hedger is not None else None
+    }
+
+@app.get("/ratelimit/stats")
+async def rate_limit_stats():
+    """Report per-model token budgets, rejections and remaining tokens per tenant bucket"""
+    return await rate_limiter.stats()
+
+@app.delete("/cache")
+async def cache_clear(fastapi_request: Request):
+    """Drop every cached response, including the disk store every worker shares"""
+    require_admin(fastapi_request)
+    response_cache.clear()
+    if semantic_cache is not None:
+        semantic_cache.clear()
+    return {"status": "cleared"}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,17 +1,83 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any
+import asyncio
 import logging
+import math
+import os
 import json
+import random
 import time
 import uuid
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def parse_distribution(spec: str) -> Callable[[random.Random], float]:
+    """Parse "0.5", "const:0.5", "uniform:a,b", "normal:mean,std", "lognormal:median,sigma" or "exp:mean" """
+    kind, _, params = spec.strip().partition(":")
+    if not params:
+        kind, params = "const", kind
+    values = [float(v) for v in params.split(",")]
+    kind = kind.lower()
+    if kind == "const":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        # Parameterised by the median, which is easier to read off a latency dashboard than mu
+        mu = math.log(values[0]) if values[0] > 0 else 0.0
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"Unknown distribution: {spec}")
+
+# Simulated upstream configuration
+SIM_MODELS = [m.strip() for m in os.getenv("SIM_MODELS", "dummy-model").split(",") if m.strip()]
+SIM_TTFT = os.getenv("SIM_TTFT", "lognormal:0.3,0.5")                  # seconds before the first token
+SIM_TOKEN_DELAY = os.getenv("SIM_TOKEN_DELAY", "normal:0.02,0.005")    # seconds per generated token
+SIM_OUTPUT_RATIO = os.getenv("SIM_OUTPUT_RATIO", "uniform:0.5,1.0")    # output length as a fraction of max_tokens
+SIM_TOKENS_PER_CHUNK = int(os.getenv("SIM_TOKENS_PER_CHUNK", "1"))
+SIM_CONCURRENCY = int(os.getenv("SIM_CONCURRENCY", "1"))               # per model, like one GPU; 0 = unlimited
+SIM_SEED = os.getenv("SIM_SEED")
+
+# Fault injection: probability per request, or force one with the X-Sim-Fault header
+SIM_FAULT_HEADER = "x-sim-fault"
+SIM_FAULT_SLOW_START_RATE = float(os.getenv("SIM_FAULT_SLOW_START_RATE", "0"))
+SIM_FAULT_SLOW_START_DELAY = float(os.getenv("SIM_FAULT_SLOW_START_DELAY", "10"))
+SIM_FAULT_DISCONNECT_RATE = float(os.getenv("SIM_FAULT_DISCONNECT_RATE", "0"))
+SIM_FAULT_ERROR_RATE = float(os.getenv("SIM_FAULT_ERROR_RATE", "0"))
+SIM_FAULT_ERROR_STATUS = [int(s) for s in os.getenv("SIM_FAULT_ERROR_STATUS", "500,503").split(",")]
+SIM_FAULT_TIMEOUT_RATE = float(os.getenv("SIM_FAULT_TIMEOUT_RATE", "0"))
+SIM_FAULT_TIMEOUT_SECONDS = float(os.getenv("SIM_FAULT_TIMEOUT_SECONDS", "300"))
+
+rng = random.Random(int(SIM_SEED)) if SIM_SEED else random.Random()
+sample_ttft = parse_distribution(SIM_TTFT)
+sample_token_delay = parse_distribution(SIM_TOKEN_DELAY)
+sample_output_ratio = parse_distribution(SIM_OUTPUT_RATIO)
+
+# Generated text is the poem, one character per token, repeated as needed
+POEM = (
+    "君不见，黄河之水天上来，奔流到海不复回。"
+    "君不见，高堂明镜悲白发，朝如青丝暮成雪。"
+    "人生得意须尽欢，莫使金樽空对月。"
+    "天生我材必有用，千金散尽还复来。"
+    "烹羊宰牛且为乐，会须一饮三百杯。"
+    "岑夫子，丹丘生，将进酒，杯莫停。"
+    "与君歌一曲，请君为我倾耳听。"
+    "钟鼓馔玉不足贵，但愿长醉不复醒。"
+    "古来圣贤皆寂寞，惟有饮者留其名。"
+    "陈王昔时宴平乐，斗酒十千恣欢谑。"
+    "主人何为言少钱，径须沽取对君酌。"
+    "五花马，千金裘，呼儿将出换美酒，"
+    "与尔同销万古愁。\n"
+)
+
 app = FastAPI(title="Dummy Chat API", version="1.0.0")
 
 # Add CORS middleware
@@ -35,144 +101,200 @@ class ChatCompletionRequest(BaseModel):
     top_p: Optional[float] = 1.0
     stream: Optional[bool] = False
 
+class SimulatedDisconnect(Exception):
+    """Raised inside a stream to drop the connection without a terminating chunk"""
+
+class ModelSlots:
+    """FIFO concurrency cap per model; requests beyond it queue like on a single-GPU server"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.active = 0
+        self.queued = 0
+        self.served = 0
+
+    async def __aenter__(self):
+        if self.semaphore is not None:
+            self.queued += 1
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.queued -= 1
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self.served += 1
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"concurrency": self.concurrency, "active": self.active, "queued": self.queued, "served": self.served}
+
+model_slots: Dict[str, ModelSlots] = {}
+
+def slots_for(model: str) -> ModelSlots:
+    slots = model_slots.get(model)
+    if slots is None:
+        slots = model_slots[model] = ModelSlots(SIM_CONCURRENCY)
+    return slots
+
+def pick_fault(request: Request) -> Optional[str]:
+    """slow_start | disconnect | error | timeout, or None"""
+    forced = request.headers.get(SIM_FAULT_HEADER)
+    if forced:
+        return forced.strip().lower()
+    for fault, rate in (("timeout", SIM_FAULT_TIMEOUT_RATE), ("error", SIM_FAULT_ERROR_RATE),
+                        ("slow_start", SIM_FAULT_SLOW_START_RATE), ("disconnect", SIM_FAULT_DISCONNECT_RATE)):
+        if rate and rng.random() < rate:
+            return fault
+    return None
+
+def error_response(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code,
+                        content={"error": {"message": message, "type": "simulated_error", "code": status_code}})
+
+def plan_completion(request: ChatCompletionRequest) -> Dict[str, Any]:
+    """Sample output length and timings for one request"""
+    max_tokens = max(1, request.max_tokens or 1000)
+    output_tokens = max(1, min(max_tokens, round(max_tokens * sample_output_ratio(rng))))
+    prompt_tokens = max(1, sum(len(m.content) for m in request.messages) // 4)
+    return {
+        "ttft": sample_ttft(rng),
+        "output_tokens": output_tokens,
+        "prompt_tokens": prompt_tokens,
+        "finish_reason": "length" if output_tokens >= max_tokens else "stop",
+    }
+
+def completion_text(tokens: int) -> str:
+    repeats = tokens // len(POEM) + 1
+    return (POEM * repeats)[:tokens]
+
+def usage(plan: Dict[str, Any]) -> Dict[str, int]:
+    return {
+        "prompt_tokens": plan["prompt_tokens"],
+        "completion_tokens": plan["output_tokens"],
+        "total_tokens": plan["prompt_tokens"] + plan["output_tokens"],
+    }
+
 @app.get("/health")
 async def health_check():
     """Simple health check endpoint"""
-    return {"status": "healthy", "dummy": "running"}
-
-async def generate_streaming_poetry(request_id: str, user_message: str):
-    """Generate streaming response with 将进酒 poem"""
-    poem_lines = [
-        "君不见，黄河之水天上来，奔流到海不复回。",
-        "君不见，高堂明镜悲白发，朝如青丝暮成雪。",
-        "人生得意须尽欢，莫使金樽空对月。",
-        "天生我材必有用，千金散尽还复来。",
-        "烹羊宰牛且为乐，会须一饮三百杯。",
-        "岑夫子，丹丘生，将进酒，杯莫停。",
-        "与君歌一曲，请君为我倾耳听。",
-        "钟鼓馔玉不足贵，但愿长醉不复醒。",
-        "古来圣贤皆寂寞，惟有饮者留其名。",
-        "陈王昔时宴平乐，斗酒十千恣欢谑。",
-        "主人何为言少钱，径须沽取对君酌。",
-        "五花马，千金裘，呼儿将出换美酒，",
-        "与尔同销万古愁。"
-    ]
-    
-    logger.info(f"[{request_id}] Starting poetry streaming")
-    
-    for i, line in enumerate(poem_lines):
-        chunk = {
+    return {
+        "status": "healthy",
+        "dummy": "running",
+        "models": {model: slots.stats() for model, slots in model_slots.items()},
+    }
+
+@app.get("/v1/models")
+@app.get("/models")
+async def list_models():
+    """OpenAI-style model list"""
+    return {
+        "object": "list",
+        "data": [{"id": model, "object": "model", "created": 0, "owned_by": "simulator"} for model in SIM_MODELS],
+    }
+
+async def generate_stream(request_id: str, request: ChatCompletionRequest, plan: Dict[str, Any],
+                          fault: Optional[str]):
+    """Stream the planned completion token by token under the model's concurrency cap"""
+    model = request.model or SIM_MODELS[0]
+    created = int(time.time())
+    text = completion_text(plan["output_tokens"])
+    # Disconnect somewhere in the middle of the output
+    disconnect_at = rng.randint(1, max(1, plan["output_tokens"] - 1)) if fault == "disconnect" else None
+
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra) -> str:
+        payload = {
             "id": f"chatcmpl-{request_id}",
             "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": "dummy-model",
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {
-                        "content": line + "\n"
-                    },
-                    "finish_reason": None
-                }
-            ]
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **extra,
         }
-        
-        yield f"data: {json.dumps(chunk)}\n\n"
-        
-        # Small delay for realistic streaming effect
-        import asyncio
-        await asyncio.sleep(0.5)
-    
-    # 添加空行和用户输入回显
-    echo_chunk = {
-        "id": f"chatcmpl-{request_id}",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": "dummy-model",
-        "choices": [
-            {
-                "index": 0,
-                "delta": {
-                    "content": "\n\n您刚才输入的内容是: " + user_message
-                },
-                "finish_reason": "stop"
-            }
-        ]
-    }
-    yield f"data: {json.dumps(echo_chunk)}\n\n"
-    
-    # 最终结束chunk
-    final_echo_chunk = {
-        "id": f"chatcmpl-{request_id}",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": "dummy-model",
-        "choices": [
-            {
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }
-        ]
-    }
-    yield f"data: {json.dumps(final_echo_chunk)}\n\n"
-    yield "data: [DONE]\n\n"
-    
-    logger.info(f"[{request_id}] Poetry streaming completed with user input echo")
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async with slots_for(model):
+        await asyncio.sleep(plan["ttft"])
+        yield chunk({"role": "assistant", "content": ""})
+        step = max(1, SIM_TOKENS_PER_CHUNK)
+        for start in range(0, plan["output_tokens"], step):
+            if start:
+                await asyncio.sleep(sum(sample_token_delay(rng) for _ in range(step)))
+            if disconnect_at is not None and start >= disconnect_at:
+                logger.info(f"[{request_id}] Simulated mid-stream disconnect after {start} tokens")
+                raise SimulatedDisconnect(request_id)
+            yield chunk({"content": text[start:start + step]})
+        yield chunk({}, plan["finish_reason"], usage=usage(plan))
+        yield "data: [DONE]\n\n"
 
+    logger.info(f"[{request_id}] Stream completed: {plan['output_tokens']} tokens")
+
+@app.post("/v1/chat/completions")
 @app.post("/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    """Handle chat completions with dummy responses"""
+async def chat_completions(request: ChatCompletionRequest, fastapi_request: Request):
+    """Simulated chat completion with sampled latency, output length and faults"""
     request_id = str(uuid.uuid4())
-    
+    fault = pick_fault(fastapi_request)
+    plan = plan_completion(request)
+
     # Log request received
-    logger.info(f"[{request_id}] Chat completion request received - stream: {request.stream}")
-    
+    logger.info(f"[{request_id}] Chat completion request received - stream: {request.stream}, "
+                f"tokens: {plan['output_tokens']}, fault: {fault}")
+
     try:
+        if fault == "timeout":
+            await asyncio.sleep(SIM_FAULT_TIMEOUT_SECONDS)
+            return error_response(504, "Simulated upstream timeout")
+        if fault == "error" or (fault and fault.isdigit()):
+            status_code = int(fault) if fault.isdigit() else rng.choice(SIM_FAULT_ERROR_STATUS)
+            return error_response(status_code, "Simulated upstream error")
+        if fault == "slow_start":
+            plan["ttft"] += SIM_FAULT_SLOW_START_DELAY
+
         if request.stream:
-            # 获取用户最后一条消息用于回显
-            user_message = request.messages[-1].content if request.messages else ""
-            logger.info(f"[{request_id}] Starting streaming response (将进酒), user input: {user_message}")
             return StreamingResponse(
-                generate_streaming_poetry(request_id, user_message),
+                generate_stream(request_id, request, plan, fault),
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
                 }
             )
-        else:
-            logger.info(f"[{request_id}] Returning non-streaming response (pong)")
-            
-            response_data = {
-                "id": f"chatcmpl-{request_id}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": request.model or "dummy-model",
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": "pong."
-                        },
-                        "finish_reason": "stop"
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": len(str(request.messages)),
-                    "completion_tokens": 1,
-                    "total_tokens": len(str(request.messages)) + 1
+
+        model = request.model or SIM_MODELS[0]
+        async with slots_for(model):
+            generation_time = sum(sample_token_delay(rng) for _ in range(plan["output_tokens"] - 1))
+            await asyncio.sleep(plan["ttft"] + generation_time)
+
+        response_data = {
+            "id": f"chatcmpl-{request_id}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": completion_text(plan["output_tokens"])
+                    },
+                    "finish_reason": plan["finish_reason"]
                 }
-            }
-            
-            logger.info(f"[{request_id}] Response sent: pong")
-            return response_data
-            
+            ],
+            "usage": usage(plan)
+        }
+
+        logger.info(f"[{request_id}] Response sent: {plan['output_tokens']} tokens")
+        return response_data
+
     except Exception as e:
         logger.error(f"[{request_id}] Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001, log_level="info")
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8001, log_level="info")
@@ -0,0 +1,164 @@
+"""
+Background-refreshed model catalog with stale-while-revalidate reads
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, FrozenSet, List, Optional
+
+from upstream_pool import Backend, UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCatalog:
+    """Merged /models view of every backend, served from memory"""
+
+    def __init__(self, pool: UpstreamPool, refresh_interval: float = 10.0, max_age: float = 30.0,
+                 probe_timeout: float = 5.0):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.probe_timeout = probe_timeout
+
+        self.payload: Optional[Dict[str, Any]] = None
+        self.body: bytes = b""
+        self.etag: Optional[str] = None
+        self.model_ids: FrozenSet[str] = frozenset()
+        self.fetched_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.refreshes = 0
+        self._backend_models: Dict[str, List[Dict[str, Any]]] = {}
+        self._backend_errors: Dict[str, Optional[str]] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    @property
+    def age(self) -> Optional[float]:
+        return None if self.fetched_at is None else time.monotonic() - self.fetched_at
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.payload and self.payload["data"]) and any(b.healthy for b in self.pool.backends)
+
+    async def _fetch(self, backend: Backend) -> None:
+        backend.last_probe = time.time()
+        try:
+            # No SDK retries: a probe should report the backend as it is right now
+            models = await asyncio.wait_for(backend.client.with_options(max_retries=0).models.list(),
+                                            timeout=self.probe_timeout)
+        except Exception as e:
+            if backend.healthy:
+                self.pool.report_failure(backend, e)
+            else:
+                backend.ejected_until = time.monotonic() + self.pool.ejection_seconds
+            self._backend_errors[backend.name] = f"{type(e).__name__}: {str(e)}"
+            return
+        self.pool.mark_healthy(backend)
+        self._backend_models[backend.name] = models.model_dump().get("data") or []
+        self._backend_errors[backend.name] = None
+
+    async def refresh(self) -> None:
+        """Fetch every due backend and rebuild the cached payload"""
+        now = time.monotonic()
+        # Ejected backends are only re-probed once their ejection window ends
+        due = [b for b in self.pool.backends if b.healthy or b.ejected_until <= now]
+        await asyncio.gather(*(self._fetch(b) for b in due))
+        self.refreshes += 1
+
+        models_by_id: Dict[str, Dict[str, Any]] = {}
+        for backend in self.pool.backends:
+            if not backend.healthy:
+                continue
+            for model in self._backend_models.get(backend.name, []):
+                models_by_id.setdefault(model["id"], model)
+
+        connected = [b for b in self.pool.backends if b.healthy and self._backend_errors.get(b.name) is None
+                     and b.name in self._backend_models]
+        if not connected:
+            self.last_error = "; ".join(e for e in self._backend_errors.values() if e) or "no backend reachable"
+            if self.payload is not None:
+                # Keep serving the last good catalog, but report it as stale
+                return
+
+        # Only fields that change on refresh go in, so the ETag stays stable between refreshes
+        backends = [
+            {
+                "name": b.name,
+                "healthy": b.healthy,
+                "models": [m["id"] for m in self._backend_models.get(b.name, [])],
+                "error": self._backend_errors.get(b.name),
+            }
+            for b in self.pool.backends
+        ]
+        payload = {"object": "list", "data": list(models_by_id.values()), "backends": backends}
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.payload = payload
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.model_ids = frozenset(models_by_id)
+        self.fetched_at = time.monotonic()
+        if connected:
+            self.last_error = None
+
+    async def _refresh_guarded(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {str(e)}"
+            logger.error(f"Model catalog refresh failed: {self.last_error}")
+
+    def revalidate(self) -> None:
+        """Start a background refresh unless one is already running"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_guarded())
+
+    async def get(self) -> Optional[Dict[str, Any]]:
+        """Cached payload; only the very first call waits for the upstream"""
+        if self.payload is None:
+            self.revalidate()
+            await asyncio.shield(self._refresh_task)
+        elif self.age > self.max_age:
+            self.revalidate()
+        return self.payload
+
+    async def _loop(self) -> None:
+        while True:
+            await self._refresh_guarded()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        if self._loop_task is None and self.refresh_interval > 0:
+            self._loop_task = asyncio.ensure_future(self._loop())
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._loop_task = None
+
+    def backend_status(self) -> List[Dict[str, Any]]:
+        backends = []
+        for backend in self.pool.backends:
+            status = backend.status()
+            status["models"] = [m["id"] for m in self._backend_models.get(backend.name, [])]
+            status["error"] = self._backend_errors.get(backend.name)
+            backends.append(status)
+        return backends
+
+    def status(self) -> Dict[str, Any]:
+        age = self.age
+        return {
+            "models_count": len(self.payload["data"]) if self.payload else 0,
+            "age": round(age, 3) if age is not None else None,
+            "stale": age is None or age > self.max_age,
+            "etag": self.etag,
+            "refreshes": self.refreshes,
+            "last_error": self.last_error,
+        }
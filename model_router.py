@@ -0,0 +1,136 @@
+"""
+Model routing rules loaded from a JSON file, with per-model fallback chains
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Conditions a route may test; every one given must hold
+CONDITIONS = (
+    "model",              # requested model name, or a list of names
+    "prompt_tokens_min",
+    "prompt_tokens_max",  # estimated prompt tokens
+    "max_tokens_min",
+    "max_tokens_max",     # the request's max_tokens
+    "queue_depth_min",    # requests queued for the requested model
+)
+
+
+class Route:
+    """Send matching requests to `model`"""
+
+    def __init__(self, name: str, model: str, when: Optional[Dict[str, Any]] = None):
+        when = when or {}
+        unknown = set(when) - set(CONDITIONS)
+        if unknown:
+            raise ValueError(f"Route {name}: unknown conditions {sorted(unknown)}")
+        self.name = name
+        self.model = model
+        self.when = when
+        models = when.get("model")
+        self.models = None if models is None else ({models} if isinstance(models, str) else set(models))
+
+    def matches(self, model: str, prompt_tokens: int, max_tokens: int, queue_depth: Callable[[str], int]) -> bool:
+        when = self.when
+        if self.models is not None and model not in self.models:
+            return False
+        if prompt_tokens < when.get("prompt_tokens_min", 0):
+            return False
+        if "prompt_tokens_max" in when and prompt_tokens > when["prompt_tokens_max"]:
+            return False
+        if max_tokens < when.get("max_tokens_min", 0):
+            return False
+        if "max_tokens_max" in when and max_tokens > when["max_tokens_max"]:
+            return False
+        # Checked last: it is the only condition that looks at shared state
+        if "queue_depth_min" in when and queue_depth(model) < when["queue_depth_min"]:
+            return False
+        return True
+
+
+class ModelRouter:
+    """First matching route wins; requests that match none keep their model
+
+    File format:
+        {
+          "routes": [
+            {"name": "classify", "model": "qwen/qwen3-4b",
+             "when": {"model": "qwen/qwen3-coder-30b", "prompt_tokens_max": 400, "max_tokens_max": 64}}
+          ],
+          "fallbacks": {"qwen/qwen3-coder-30b": ["qwen/qwen3-8b"]},
+          "overload_queue_depth": 16
+        }
+
+    A model whose admission queue holds at least overload_queue_depth requests is
+    skipped in favour of its fallbacks (0 = only fall back on rejection or error).
+    """
+
+    def __init__(self, routes: List[Route], fallbacks: Optional[Dict[str, List[str]]] = None,
+                 overload_queue_depth: int = 0):
+        self.routes = routes
+        self.fallbacks = fallbacks or {}
+        self.overload_queue_depth = overload_queue_depth
+        self.routed: Dict[str, int] = {}
+        self.fell_back: Dict[Tuple[str, str], int] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "ModelRouter":
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        routes = [
+            Route(item.get("name") or f"route{i}", item["model"], item.get("when"))
+            for i, item in enumerate(config.get("routes", []))
+        ]
+        fallbacks = {model: list(chain) for model, chain in config.get("fallbacks", {}).items()}
+        return cls(routes, fallbacks, int(config.get("overload_queue_depth", 0)))
+
+    def route(self, model: str, prompt_tokens: int, max_tokens: int, queue_depth: Callable[[str], int],
+              forced: Optional[str] = None) -> Tuple[str, Optional[str]]:
+        """Returns (model to use, name of the route taken or None)
+
+        `forced` names a route to take regardless of its conditions; "off", in any case, skips routing.
+        """
+        if forced:
+            if forced.lower() == "off":
+                return model, None
+            for route in self.routes:
+                if route.name == forced:
+                    return self._take(route)
+        for route in self.routes:
+            if route.matches(model, prompt_tokens, max_tokens, queue_depth):
+                return self._take(route)
+        return model, None
+
+    def _take(self, route: Route) -> Tuple[str, str]:
+        self.routed[route.name] = self.routed.get(route.name, 0) + 1
+        return route.model, route.name
+
+    def chain(self, model: str) -> List[str]:
+        """The model followed by its fallbacks, in order"""
+        return [model] + [m for m in self.fallbacks.get(model, []) if m != model]
+
+    def models(self) -> Set[str]:
+        """Every model named by a route or a fallback chain"""
+        models = set(self.fallbacks)
+        for chain in self.fallbacks.values():
+            models.update(chain)
+        for route in self.routes:
+            models.add(route.model)
+            models.update(route.models or ())
+        return models
+
+    def record_fallback(self, source: str, target: str) -> None:
+        self.fell_back[(source, target)] = self.fell_back.get((source, target), 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": [
+                {"name": r.name, "model": r.model, "when": r.when, "taken": self.routed.get(r.name, 0)}
+                for r in self.routes
+            ],
+            "fallbacks": self.fallbacks,
+            "overload_queue_depth": self.overload_queue_depth,
+            "fell_back": [
+                {"from": source, "to": target, "count": count}
+                for (source, target), count in sorted(self.fell_back.items())
+            ],
+        }
@@ -0,0 +1,95 @@
+"""
+Prompt-prefix affinity: send a conversation back to the backend that holds its KV cache
+"""
+import hashlib
+import math
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from upstream_pool import Backend, UpstreamPool
+
+
+def prefix_hashes(model: Optional[str], messages: List[Dict[str, Any]]) -> List[bytes]:
+    """Rolling hash of every message prefix: entry i covers messages[0..i]"""
+    hashes = []
+    digest = hashlib.blake2b((model or "").encode("utf-8"), digest_size=16).digest()
+    for message in messages:
+        h = hashlib.blake2b(digest, digest_size=16)
+        h.update((message.get("role") or "").encode("utf-8"))
+        h.update(b"\x00")
+        h.update((message.get("content") or "").encode("utf-8"))
+        digest = h.digest()
+        hashes.append(digest)
+    return hashes
+
+
+class PrefixAffinity:
+    """Bounded LRU table of prefix hash -> backend name, with bounded-load placement
+
+    A request goes to the backend that most recently served the longest prefix it
+    shares with earlier requests, unless that backend already carries more than
+    `load_factor` times its weighted share of the pool's in-flight requests; then
+    it falls back to least-outstanding-requests and the prefix moves with it.
+    """
+
+    def __init__(self, max_entries: int = 50000, load_factor: float = 1.25):
+        self.max_entries = max_entries
+        self.load_factor = load_factor
+        self._table: "OrderedDict[bytes, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.overflows = 0
+        self.evictions = 0
+        self.matched_messages = 0
+
+    def _within_bound(self, backend: Backend, candidates: List[Backend]) -> bool:
+        total = sum(b.in_flight for b in candidates) + 1
+        share = backend.weight / sum(b.weight for b in candidates)
+        return backend.in_flight + 1 <= math.ceil(self.load_factor * total * share)
+
+    def route(self, pool: UpstreamPool, model: Optional[str], messages: List[Dict[str, Any]]) -> Backend:
+        hashes = prefix_hashes(model, messages)
+        candidates = pool.available()
+        chosen = None
+        result = "miss"
+        for depth in range(len(hashes), 0, -1):
+            backend = pool.get(self._table.get(hashes[depth - 1], ""))
+            if backend is None or backend not in candidates:
+                continue
+            if self._within_bound(backend, candidates):
+                chosen = backend
+                result = "hit"
+                self.matched_messages += depth
+            else:
+                result = "overflow"
+            break
+        if result == "hit":
+            self.hits += 1
+        elif result == "overflow":
+            self.overflows += 1
+        else:
+            self.misses += 1
+        if chosen is None:
+            chosen = pool.pick()
+        self._record(hashes, chosen.name)
+        return chosen
+
+    def _record(self, hashes: List[bytes], name: str) -> None:
+        for digest in hashes:
+            self._table[digest] = name
+            self._table.move_to_end(digest)
+        while len(self._table) > self.max_entries:
+            self._table.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._table),
+            "max_entries": self.max_entries,
+            "load_factor": self.load_factor,
+            "hits": self.hits,
+            "misses": self.misses,
+            "overflows": self.overflows,
+            "evictions": self.evictions,
+            "avg_matched_messages": round(self.matched_messages / self.hits, 2) if self.hits else 0.0,
+        }
@@ -0,0 +1,155 @@
+"""
+On-demand profiling of the running process: stack sampling and an asyncio event loop view
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+
+class ProfileBusy(Exception):
+    """Another profile is already running in this process"""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class StackSampler:
+    """Sample every thread's Python stack at a fixed interval
+
+    Runs on its own thread, so the event loop keeps serving (and being sampled)
+    while a profile is taken. Only one profile runs at a time.
+    """
+
+    def __init__(self, max_depth: int = 128):
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, interval: float = 0.005) -> Counter:
+        """Blocks for `seconds`; returns collapsed stacks (root first, ';'-joined) with sample counts"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfileBusy("A profile is already running")
+        try:
+            return self._sample(seconds, interval)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds: float, interval: float) -> Counter:
+        stacks: Counter = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < self.max_depth:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, f"thread-{thread_id}"))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return stacks
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        """Brendan Gregg's folded format, as read by flamegraph.pl, speedscope and inferno"""
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collect asyncio debug mode's "Executing <Handle> took N seconds" warnings"""
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.callbacks: List[Dict[str, Any]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if isinstance(record.msg, str) and record.msg.startswith("Executing ") and len(record.args or ()) == 2:
+            handle, seconds = record.args
+            self.callbacks.append({"callback": str(handle), "duration_ms": round(seconds * 1000, 3)})
+
+
+_watching = False
+
+
+async def watch_event_loop(seconds: float, threshold: float, tick: float = 0.01) -> Dict[str, Any]:
+    """Watch the running loop for `seconds`: slow callbacks over `threshold` and scheduling lag
+
+    Slow callbacks come from asyncio's debug mode, switched on for the window only. Lag is
+    how late a heartbeat that sleeps `tick` wakes up, which also catches blocking inside
+    loops (such as uvloop) that do not report slow callbacks.
+    """
+    global _watching
+    if _watching:
+        raise ProfileBusy("The event loop is already being watched")
+    _watching = True
+    loop = asyncio.get_running_loop()
+    asyncio_logger = logging.getLogger("asyncio")
+    handler = _SlowCallbackHandler()
+    was_debug, was_threshold = loop.get_debug(), loop.slow_callback_duration
+    was_propagate = asyncio_logger.propagate
+    asyncio_logger.addHandler(handler)
+    # The warnings are collected here, not written to the service log
+    asyncio_logger.propagate = False
+    loop.slow_callback_duration = threshold
+    loop.set_debug(True)
+
+    lags: List[float] = []
+    stalls = []
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            before = time.monotonic()
+            await asyncio.sleep(tick)
+            lag = max(0.0, time.monotonic() - before - tick)
+            lags.append(lag)
+            if lag >= threshold:
+                stalls.append({"at": round(time.time(), 6), "lag_ms": round(lag * 1000, 3)})
+    finally:
+        loop.set_debug(was_debug)
+        loop.slow_callback_duration = was_threshold
+        asyncio_logger.removeHandler(handler)
+        asyncio_logger.propagate = was_propagate
+        _watching = False
+
+    lags.sort()
+    return {
+        "seconds": seconds,
+        "threshold_ms": threshold * 1000,
+        "slow_callbacks": sorted(handler.callbacks, key=lambda c: c["duration_ms"], reverse=True),
+        "loop_lag_ms": {
+            "samples": len(lags),
+            "p50": round(lags[len(lags) // 2] * 1000, 3) if lags else None,
+            "p99": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 3) if lags else None,
+            "max": round(lags[-1] * 1000, 3) if lags else None,
+        },
+        "stalls": stalls,
+    }
+
+
+def pending_tasks(stack_limit: int = 8, exclude: Optional[asyncio.Task] = None) -> List[Dict[str, Any]]:
+    """Every unfinished task on the running loop with where it is suspended"""
+    tasks = []
+    for task in asyncio.all_tasks():
+        if task is exclude or task.done():
+            continue
+        coro = task.get_coro()
+        tasks.append({
+            "name": task.get_name(),
+            "coro": getattr(coro, "__qualname__", repr(coro)),
+            "stack": [_frame_label(frame) for frame in task.get_stack(limit=stack_limit)],
+        })
+    tasks.sort(key=lambda t: t["coro"])
+    return tasks
@@ -0,0 +1,312 @@
+"""
+Per-tenant token-bucket rate limiting measured in LLM tokens
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fully refilled buckets are dropped once this many are held, since they are the same as no bucket
+_PRUNE_THRESHOLD = 10000
+# Counter key shared by models seen after max_models others
+OTHER_MODELS = "other"
+
+
+class RateLimited(Exception):
+    """The tenant has no token budget left for this model"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Rough prompt size without a tokenizer: ~4 characters per token plus per-message framing"""
+    chars = sum(len(m.get("content") or "") + len(m.get("role") or "") for m in messages)
+    return math.ceil(chars / 4) + 4 * len(messages)
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+
+def tenant_id(headers: Mapping[str, str], header_name: str = "") -> str:
+    """Identify the caller by a configured header, falling back to its API key
+
+    Only digests are kept, so stats and logs never expose a key or a header value.
+    """
+    if header_name:
+        value = headers.get(header_name, "").strip()
+        if value:
+            return "header:" + _digest(value)
+    auth = headers.get("authorization", "").strip()
+    scheme, _, token = auth.partition(" ")
+    key = token.strip() if scheme.lower() == "bearer" else auth
+    if not key:
+        return "anonymous"
+    return "key:" + _digest(key)
+
+
+def _refill(tokens: float, updated_at: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated_at) * rate)
+
+
+def _take(tokens: float, amount: float, rate: float, capacity: float) -> float:
+    """Seconds until `amount` can be taken, 0 when it can be taken now
+
+    A request larger than the whole bucket is let through once the bucket is full,
+    otherwise it could never run; the bucket then goes into debt.
+    """
+    if tokens >= amount or tokens >= capacity:
+        return 0.0
+    return max((min(amount, capacity) - tokens) / rate, 0.001)
+
+
+class MemoryBuckets:
+    """Buckets held in this process"""
+
+    shared = False
+
+    def __init__(self):
+        # key -> [tokens, updated_at, rate, capacity]
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], now, rate, capacity)
+            wait = _take(tokens, amount, rate, capacity)
+            if wait == 0:
+                tokens -= amount
+            self._buckets[key] = [tokens, now, rate, capacity]
+            if len(self._buckets) > _PRUNE_THRESHOLD:
+                self._prune(now)
+            return wait
+
+    def give(self, key: str, amount: float, rate: float, capacity: float) -> None:
+        """Return tokens to the bucket; a negative amount charges extra"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], now, rate, capacity)
+            self._buckets[key] = [min(capacity, tokens + amount), now, rate, capacity]
+
+    def _prune(self, now: float) -> None:
+        for key in [k for k, (tokens, updated_at, rate, capacity) in self._buckets.items()
+                    if _refill(tokens, updated_at, now, rate, capacity) >= capacity]:
+            del self._buckets[key]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {key: round(bucket[0], 1) for key, bucket in self._buckets.items()}
+
+
+class SQLiteBuckets:
+    """Buckets in a SQLite file shared by every worker process on a host
+
+    Each take/give is one short IMMEDIATE transaction, so concurrent workers see a
+    consistent balance. Calls block, and are meant to run in an executor thread.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, busy_timeout: float = 2.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL,"
+            " full_at REAL NOT NULL DEFAULT 0)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last balance update on power failure is harmless
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, key: str, amount: float, rate: float, capacity: float, take: bool) -> float:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], now, rate, capacity)
+            wait = 0.0
+            if take:
+                wait = _take(tokens, amount, rate, capacity)
+                if wait == 0:
+                    tokens -= amount
+            else:
+                tokens = min(capacity, tokens + amount)
+            # When the bucket will be full again, so pruning needs neither the rate nor the capacity
+            full_at = now + max(0.0, capacity - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, full_at))
+            # As in MemoryBuckets; the count is only checked when a key is added
+            if row is None and conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0] > _PRUNE_THRESHOLD:
+                conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def take(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        return self._update(key, amount, rate, capacity, take=True)
+
+    def give(self, key: str, amount: float, rate: float, capacity: float) -> None:
+        self._update(key, amount, rate, capacity, take=False)
+
+    def snapshot(self) -> Dict[str, float]:
+        rows = self._conn().execute("SELECT key, tokens FROM buckets").fetchall()
+        return {key: round(tokens, 1) for key, tokens in rows}
+
+
+class Reservation:
+    """Tokens charged up front for one request; settle() with the actual usage refunds the difference"""
+
+    __slots__ = ("limiter", "key", "model", "prompt_tokens", "charged", "settled")
+
+    def __init__(self, limiter: "TokenRateLimiter", key: str, model: str, prompt_tokens: int, charged: int):
+        self.limiter = limiter
+        self.key = key
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.charged = charged
+        self.settled = False
+
+    def settle(self, tokens_used: int) -> None:
+        if self.settled:
+            return
+        self.settled = True
+        self.limiter._reconcile(self, tokens_used)
+
+    def cancel(self) -> None:
+        """Nothing was generated for this request"""
+        self.settle(0)
+
+
+class TokenRateLimiter:
+    """Token buckets per (tenant, model), refilled at the model's tokens-per-minute limit"""
+
+    def __init__(self, default_limit: int, model_limits: Optional[Dict[str, int]] = None, store: Optional[Any] = None,
+                 max_models: int = 256):
+        self.default_limit = default_limit
+        self.model_limits = model_limits or {}
+        self.store = store or MemoryBuckets()
+        # Counters are kept per model name as the client sent it; past max_models they go under "other"
+        self.max_models = max_models
+        self.granted: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self.tokens_used: Dict[str, int] = {}
+        self.errors = 0
+        self._pending: set = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.default_limit > 0 or any(v > 0 for v in self.model_limits.values())
+
+    def limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_limit)
+
+    def _counter_key(self, model: str) -> str:
+        if model in self.granted or model in self.rejected or model in self.model_limits:
+            return model
+        return model if len(self.granted.keys() | self.rejected.keys()) < self.max_models else OTHER_MODELS
+
+    def _bucket_args(self, model: str) -> tuple:
+        limit = self.limit(model)
+        # The bucket holds one minute of budget
+        return limit / 60.0, float(limit)
+
+    async def _call(self, method, *args):
+        if not self.store.shared:
+            return method(*args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+        except sqlite3.Error as e:
+            # A locked or broken shared file must not take the proxy down: fail open
+            self.errors += 1
+            logger.warning(f"Rate limit store failed: {type(e).__name__}: {str(e)}")
+            return 0.0
+
+    async def reserve(self, tenant: str, model: str, prompt_tokens: int, max_tokens: int) -> Optional[Reservation]:
+        """Charge prompt_tokens + max_tokens, or raise RateLimited"""
+        if self.limit(model) <= 0:
+            return None
+        key = f"{tenant}|{model}"
+        amount = prompt_tokens + max_tokens
+        wait = await self._call(self.store.take, key, amount, *self._bucket_args(model))
+        counter = self._counter_key(model)
+        if wait > 0:
+            self.rejected[counter] = self.rejected.get(counter, 0) + 1
+            raise RateLimited(
+                f"Token rate limit of {self.limit(model)} tokens/min for model {model} exceeded", math.ceil(wait)
+            )
+        self.granted[counter] = self.granted.get(counter, 0) + 1
+        return Reservation(self, key, model, prompt_tokens, amount)
+
+    def _reconcile(self, reservation: Reservation, tokens_used: int) -> None:
+        counter = self._counter_key(reservation.model)
+        self.tokens_used[counter] = self.tokens_used.get(counter, 0) + tokens_used
+        refund = reservation.charged - tokens_used
+        if not refund:
+            return
+        args = (reservation.key, refund, *self._bucket_args(reservation.model))
+        if not self.store.shared:
+            self.store.give(*args)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.store.give(*args)
+            return
+        # Settling happens on the way out of a request; nothing waits for it
+        task = loop.create_task(self._call(self.store.give, *args))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def stats(self) -> Dict[str, Any]:
+        models = set(self.granted) | set(self.rejected)
+        stats: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "default_tokens_per_minute": self.default_limit,
+            "model_tokens_per_minute": self.model_limits,
+            "shared": self.store.shared,
+            "errors": self.errors,
+            "models": {
+                model: {
+                    "tokens_per_minute": self.limit(model),
+                    "granted": self.granted.get(model, 0),
+                    "rejected": self.rejected.get(model, 0),
+                    "tokens_used": self.tokens_used.get(model, 0),
+                }
+                for model in sorted(models)
+            },
+        }
+        try:
+            if self.store.shared:
+                # A full table scan of the shared file; kept off the event loop like every other store call
+                stats["buckets"] = await asyncio.get_running_loop().run_in_executor(None, self.store.snapshot)
+            else:
+                stats["buckets"] = self.store.snapshot()
+        except sqlite3.Error as e:
+            stats["buckets_error"] = str(e)
+        return stats
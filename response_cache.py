@@ -0,0 +1,234 @@
+"""
+Response cache for chat completions: in-process LRU, optionally backed by a shared disk store
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model: Optional[str], messages: List[Dict[str, Any]], temperature: Optional[float],
+                   top_p: Optional[float], max_tokens: Optional[int], namespace: str = "chat") -> str:
+    """Build a canonical hash of the request fields forwarded upstream"""
+    canonical = json.dumps(
+        {
+            "ns": namespace,
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expires_at")
+
+    def __init__(self, value: Any, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+_COMPLETION_PREFIX = b'{"completion":'
+
+
+def encode_value(value: Any) -> bytes:
+    """Serialize a CachedCompletion or a StreamRecording for the disk store"""
+    if isinstance(value, CachedCompletion):
+        # The body already is JSON; it is embedded as-is so reading it back needs no re-encoding
+        return _COMPLETION_PREFIX + value.body + b"}"
+    # Passthrough frames are raw byte slices that may split a UTF-8 sequence; they go as base64
+    payload = {"stream": [
+        [offset, base64.b64encode(frame).decode("ascii"), "b64"] if isinstance(frame, bytes) else [offset, frame]
+        for offset, frame in value.frames
+    ]}
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_value(data: bytes) -> Tuple[Any, int]:
+    """Inverse of encode_value; also returns the size to charge against the memory budget"""
+    if data.startswith(_COMPLETION_PREFIX):
+        body = data[len(_COMPLETION_PREFIX):-1]
+        # Read in the executor, so the one decode this needs stays off the event loop
+        return CachedCompletion(body, json.loads(body).get("usage")), len(body)
+    recording = StreamRecording()
+    for item in json.loads(data)["stream"]:
+        offset, frame = item[0], item[1]
+        recording.add(offset, base64.b64decode(frame) if len(item) > 2 else frame)
+    return recording, recording.size
+
+
+class ResponseCache:
+    """LRU cache with a TTL and a memory budget in bytes
+
+    With a `store`, entries are written through to it and memory misses are looked up
+    there, so warm entries are shared between workers and survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, max_bytes: int = 64 * 1024 * 1024,
+                 store: Optional[Any] = None):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store_errors = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Memory first, then the store; the store is read (and decoded) in the default executor"""
+        value = self._get_memory(key)
+        if value is None and self.store is not None:
+            value = await asyncio.get_running_loop().run_in_executor(None, self._load, key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def _get_memory(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def _load(self, key: str) -> Optional[Any]:
+        """Fetch a memory miss from the store and keep it in memory for what is left of its TTL"""
+        found = self.store.get_entry(key)
+        if found is None:
+            return None
+        data, expires_at = found
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            value, size = decode_value(data)
+        except (ValueError, KeyError, TypeError):
+            return None
+        self._put(key, value, size, ttl=min(self.ttl, remaining))
+        return value
+
+    def set(self, key: str, value: Any, size: int) -> bool:
+        """Store a value; returns False when it cannot fit in the memory budget
+
+        A failing store write is logged and counted, never raised: callers are
+        finishing a response that must reach the client either way.
+        """
+        stored = self._put(key, value, size)
+        if self.store is not None:
+            try:
+                self.store.set(key, encode_value(value))
+            except Exception as e:
+                self.store_errors += 1
+                logger.warning(f"Response cache store write failed: {type(e).__name__}: {str(e)}")
+        return stored
+
+    def _put(self, key: str, value: Any, size: int, ttl: Optional[float] = None) -> bool:
+        if size > self.max_bytes or self.max_entries <= 0:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "store_errors": self.store_errors,
+            }
+
+
+class CachedCompletion:
+    """A non-streaming response held only as its JSON body, encoded once when the response was stored
+
+    Hits send the body as-is; the usage is kept for logging, and the object is decoded
+    only for a caller that needs it.
+    """
+
+    __slots__ = ("body", "usage")
+
+    def __init__(self, body: bytes, usage: Optional[Dict[str, Any]] = None):
+        self.body = body
+        self.usage = usage
+
+    @property
+    def response(self) -> Dict[str, Any]:
+        return json.loads(self.body)
+
+
+class StreamRecording:
+    """SSE frames of a completed upstream stream with their original offsets"""
+
+    __slots__ = ("frames", "size")
+
+    def __init__(self):
+        self.frames: List[tuple] = []
+        self.size = 0
+
+    def add(self, offset: float, frame: Union[str, bytes]) -> None:
+        self.frames.append((offset, frame))
+        self.size += len(frame)
+
+    async def replay(self, paced: bool = False):
+        """Yield the recorded frames, optionally with the original pacing"""
+        replay_start = time.monotonic()
+        for offset, frame in self.frames:
+            if paced:
+                delay = offset - (time.monotonic() - replay_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield frame
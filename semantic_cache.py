@@ -0,0 +1,263 @@
+"""
+Semantic cache: find an earlier prompt whose last user message means the same thing
+"""
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from upstream_pool import UpstreamPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_WORD = re.compile(r"\w+")
+
+
+def split_prompt(messages: List[Dict[str, Any]]) -> Optional[Tuple[str, str]]:
+    """(hash of everything before the last user message, that message); None unless the prompt ends with a user turn"""
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    for message in messages[:-1]:
+        h.update((message.get("role") or "").encode("utf-8"))
+        h.update(b"\x00")
+        h.update((message.get("content") or "").encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest(), messages[-1].get("content") or ""
+
+
+def _normalized(vector: "np.ndarray") -> "np.ndarray":
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class HashingEmbedder:
+    """Feature hashing of words, word pairs and character trigrams
+
+    Local and deterministic: good for tests and FAQ-style traffic that paraphrases with
+    the same vocabulary, blind to synonyms. vector() is CPU-bound and grows with the text;
+    embed() runs it in the default executor.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def vector(self, text: str) -> "np.ndarray":
+        words = _WORD.findall(text.lower())
+        joined = f" {' '.join(words)} "
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        # Trigrams also cover scripts written without spaces, such as Chinese
+        features += [joined[i:i + 3] for i in range(len(joined) - 2)]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in features:
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return _normalized(vector)
+
+    async def embed(self, text: str) -> "np.ndarray":
+        return await asyncio.get_running_loop().run_in_executor(None, self.vector, text)
+
+
+class LMStudioEmbedder:
+    """Embeddings from the pool's OpenAI-compatible /embeddings endpoint; the model must be loaded in LMStudio"""
+
+    name = "lmstudio"
+
+    def __init__(self, pool: UpstreamPool, model: str):
+        self.pool = pool
+        self.model = model
+
+    async def embed(self, text: str) -> "np.ndarray":
+        async with self.pool.lease() as backend:
+            # A lookup is only worth a short wait; SemanticCache bounds it, retries would just outlast that
+            response = await backend.client.with_options(max_retries=0).embeddings.create(model=self.model, input=text)
+        return _normalized(np.asarray(response.data[0].embedding, dtype=np.float32))
+
+
+class SemanticQuery:
+    """An embedded prompt and the scope it may match in"""
+
+    def __init__(self, scope: str, vector: "np.ndarray"):
+        self.scope = scope
+        self.vector = vector
+
+
+class _Index:
+    """Unit vectors of one scope in a dense matrix; removal moves the last row into the gap"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((4, dim), dtype=np.float32)
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, vector: "np.ndarray", key: str) -> None:
+        row = len(self.keys)
+        if row == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+        self.vectors[row] = vector
+        self.keys.append(key)
+        self.rows[key] = row
+
+    def remove(self, key: str) -> None:
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.keys[row] = self.keys[last]
+            self.rows[self.keys[row]] = row
+        self.keys.pop()
+
+    def best(self, vector: "np.ndarray") -> Tuple[str, float]:
+        scores = self.vectors[:len(self.keys)] @ vector
+        row = int(np.argmax(scores))
+        return self.keys[row], float(scores[row])
+
+
+class SemanticCache:
+    """Per-scope vector indexes pointing at response cache keys
+
+    A scope is one model, one set of sampling parameters (max_tokens, temperature, top_p), one
+    kind of response and one exact context (system prompt and earlier turns); only the last
+    user message is compared, by cosine similarity.
+    Entries hold cache keys rather than responses, so the response cache stays the one
+    place answers are stored, bounded and expired. Entries are evicted least recently used.
+    """
+
+    def __init__(self, embedder, threshold: float = 0.9, max_entries: int = 10000, ttl: float = 300.0,
+                 embed_timeout: float = 0.25):
+        if np is None:
+            raise RuntimeError("The semantic cache needs numpy (pip install numpy)")
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Seconds; a slower embedding is abandoned and the request goes on without the semantic lookup
+        self.embed_timeout = embed_timeout
+        self._indexes: Dict[str, _Index] = {}
+        self._entries: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        # Best similarity of recent lookups, to tune the threshold against
+        self.scores: "deque[float]" = deque(maxlen=1024)
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.evictions = 0
+        self.skipped = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    async def query(self, namespace: str, model: Optional[str], messages: List[Dict[str, Any]],
+                    max_tokens: Optional[int], temperature: Optional[float],
+                    top_p: Optional[float]) -> Optional[SemanticQuery]:
+        split = split_prompt(messages)
+        if split is None:
+            self.skipped += 1
+            return None
+        context, text = split
+        try:
+            vector = await asyncio.wait_for(self.embedder.embed(text), self.embed_timeout or None)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        return SemanticQuery(f"{namespace}|{model}|{max_tokens}|{temperature}|{top_p}|{context}", vector)
+
+    async def lookup(self, query: SemanticQuery,
+                     get: Callable[[str], Awaitable[Any]]) -> Tuple[Optional[Any], Optional[float]]:
+        """await get(key) of the most similar earlier prompt in the scope if it clears the threshold; returns (value, similarity)"""
+        self.lookups += 1
+        index = self._indexes.get(query.scope)
+        if index is None or len(index) == 0 or index.vectors.shape[1] != len(query.vector):
+            self.misses += 1
+            return None, None
+        key, score = index.best(query.vector)
+        self.scores.append(score)
+        if score < self.threshold:
+            self.misses += 1
+            return None, score
+        entry = (query.scope, key)
+        if time.monotonic() - self._entries[entry] > self.ttl:
+            self._remove(entry)
+            self.expired += 1
+            self.misses += 1
+            return None, score
+        value = await get(key)
+        if value is None:
+            # Evicted from the response cache, or a stream that has not finished yet
+            self.stale += 1
+            self.misses += 1
+            return None, score
+        self.hits += 1
+        self._entries.move_to_end(entry)
+        return value, score
+
+    def add(self, query: SemanticQuery, key: str) -> None:
+        entry = (query.scope, key)
+        if entry in self._entries:
+            self._remove(entry)
+        index = self._indexes.get(query.scope)
+        if index is None:
+            index = self._indexes[query.scope] = _Index(len(query.vector))
+        index.add(query.vector, key)
+        self._entries[entry] = time.monotonic()
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, entry: Tuple[str, str]) -> None:
+        scope, key = entry
+        del self._entries[entry]
+        index = self._indexes[scope]
+        index.remove(key)
+        if len(index) == 0:
+            del self._indexes[scope]
+
+    def clear(self) -> None:
+        self._indexes.clear()
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        scores = sorted(self.scores)
+
+        def percentile(q: float) -> Optional[float]:
+            return round(scores[min(len(scores) - 1, int(q * len(scores)))], 4) if scores else None
+
+        return {
+            "embedder": self.embedder.name,
+            "threshold": self.threshold,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "scopes": len(self._indexes),
+            "ttl": self.ttl,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "stale": self.stale,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "embed_timeout": self.embed_timeout,
+            "similarity": {
+                "samples": len(scores),
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "max": round(scores[-1], 4) if scores else None,
+            },
+        }
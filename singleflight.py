@@ -0,0 +1,187 @@
+"""
+Single-flight coalescing of identical in-flight upstream calls
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+STREAM_OVERFLOW_FRAME = 'data: {"error": "client too slow, dropped from shared stream"}\n\n'
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Share one upstream call between identical concurrent non-streaming requests"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run fn once per key; returns (result, shared)"""
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        except asyncio.CancelledError:
+            # The upstream call only dies with its last waiter
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
+
+
+class _Subscriber:
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.dropped = False
+
+
+class _StreamFlight:
+    def __init__(self, key: str, buffer_size: int):
+        self.key = key
+        self.buffer_size = buffer_size
+        self.subscribers: Set[_Subscriber] = set()
+        # Frames seen so far, kept only while late joiners still fit in a buffer
+        self.history: Optional[List[Any]] = []
+        self.task: Optional[asyncio.Task] = None
+        # Set whenever a subscriber reads a frame or leaves, so a waiting producer re-checks
+        self.progress = asyncio.Event()
+
+    @property
+    def joinable(self) -> bool:
+        return self.history is not None and not (self.task and self.task.done())
+
+    async def publish(self, frame: Any) -> None:
+        """Hand frame to every subscriber, waiting while one of them has a full buffer
+
+        Waiting holds back the upstream read, so a lone slow reader slows generation down
+        instead of losing frames. A subscriber with a full buffer, the one that started the
+        stream included, is dropped as soon as waiting for it would starve another
+        subscriber that has already read everything it was given.
+        """
+        if self.history is not None:
+            self.history.append(frame)
+            if len(self.history) >= self.buffer_size:
+                self.history = None
+        for subscriber in list(self.subscribers):
+            while subscriber in self.subscribers and subscriber.queue.qsize() >= self.buffer_size:
+                if any(other is not subscriber and other.queue.empty() for other in self.subscribers):
+                    subscriber.dropped = True
+                    self.subscribers.discard(subscriber)
+                    subscriber.queue.put_nowait(None)
+                    break
+                self.progress.clear()
+                await self.progress.wait()
+            if subscriber in self.subscribers:
+                subscriber.queue.put_nowait(frame)
+
+    def finish(self) -> None:
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait(None)
+
+
+class StreamBroadcaster:
+    """Broadcast one upstream stream to every identical concurrent streaming request"""
+
+    def __init__(self, buffer_size: int = 256):
+        self.buffer_size = buffer_size
+        self._flights: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.dropped = 0
+
+    def joinable(self, key: str) -> bool:
+        """Whether a new subscriber for key would join an in-flight stream"""
+        flight = self._flights.get(key)
+        return flight is not None and flight.joinable
+
+    def subscribe(self, key: str, source: Callable[[], AsyncIterator[Any]]) -> Tuple[AsyncIterator[Any], bool]:
+        """Attach to the in-flight stream for key, starting it from source if needed"""
+        flight = self._flights.get(key)
+        shared = flight is not None and flight.joinable
+        subscriber = _Subscriber()
+
+        if shared:
+            self.followers += 1
+            for frame in flight.history:
+                subscriber.queue.put_nowait(frame)
+            flight.subscribers.add(subscriber)
+        else:
+            self.leaders += 1
+            flight = _StreamFlight(key, self.buffer_size)
+            flight.subscribers.add(subscriber)
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(self._produce(flight, source))
+
+        return self._consume(flight, subscriber), shared
+
+    async def _produce(self, flight: _StreamFlight, source: Callable[[], AsyncIterator[Any]]) -> None:
+        frames = source()
+        try:
+            async for frame in frames:
+                await flight.publish(frame)
+                if not flight.subscribers:
+                    break
+        except Exception as e:
+            logger.error(f"Shared stream {flight.key[:12]} failed: {type(e).__name__}: {str(e)}")
+        finally:
+            # Close the source right away so it releases its upstream resources
+            await frames.aclose()
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.finish()
+
+    async def _consume(self, flight: _StreamFlight, subscriber: _Subscriber):
+        try:
+            while True:
+                frame = await subscriber.queue.get()
+                flight.progress.set()
+                if frame is None:
+                    break
+                yield frame
+            if subscriber.dropped:
+                self.dropped += 1
+                yield STREAM_OVERFLOW_FRAME
+        finally:
+            flight.subscribers.discard(subscriber)
+            flight.progress.set()
+            if not flight.subscribers and flight.task and not flight.task.done():
+                flight.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(len(f.subscribers) for f in self._flights.values()),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "dropped_slow_subscribers": self.dropped,
+        }
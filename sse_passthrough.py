@@ -0,0 +1,98 @@
+"""
+Raw byte passthrough of upstream SSE streams
+"""
+import json
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+FINISH_REASON_MARKER = b'"finish_reason":'
+USAGE_MARKER = b'"usage":'
+# Events end with a blank line, so the terminator always follows a newline
+DONE_MARKER = b"\ndata: [DONE]"
+# Enough context to catch a marker split across two network reads
+SCAN_OVERLAP = 64
+
+
+class SSEScanner:
+    """Incrementally scan raw SSE bytes for finish_reason, usage and the [DONE] terminator"""
+
+    __slots__ = ("frames", "bytes_seen", "finish_reason", "usage", "done", "_tail")
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes_seen = 0
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self.done = False
+        self._tail = b""
+
+    def feed(self, data: bytes) -> None:
+        self.bytes_seen += len(data)
+        self.frames += data.count(b"\n\n")
+        window = self._tail + data
+        self._tail = window[-SCAN_OVERLAP:]
+        if not self.done and DONE_MARKER in window:
+            self.done = True
+
+        # Plain byte searches; no per-chunk JSON decoding
+        pos = window.rfind(FINISH_REASON_MARKER)
+        if pos != -1:
+            value = window[pos + len(FINISH_REASON_MARKER):pos + len(FINISH_REASON_MARKER) + 32].lstrip()
+            if value.startswith(b'"'):
+                end = value.find(b'"', 1)
+                if end != -1:
+                    self.finish_reason = value[1:end].decode("utf-8", "replace")
+
+        pos = window.rfind(USAGE_MARKER)
+        if pos != -1:
+            start = pos + len(USAGE_MARKER)
+            while start < len(window) and window[start] == 0x20:
+                start += 1
+            end = _match_brace(window, start)
+            if end != -1:
+                try:
+                    self.usage = json.loads(window[start:end + 1])
+                except ValueError:
+                    pass
+
+
+def _match_brace(data: bytes, start: int) -> int:
+    """Index of the brace closing the object that opens at start, or -1"""
+    if start >= len(data) or data[start] != 0x7B:
+        return -1
+    depth = 0
+    for i in range(start, min(len(data), start + 1024)):
+        byte = data[i]
+        if byte == 0x7B:  # {
+            depth += 1
+        elif byte == 0x7D:  # }
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+async def stream_raw(http_client: httpx.AsyncClient, url: str, payload: Dict[str, Any],
+                     scanner: SSEScanner, headers: Optional[Dict[str, str]] = None) -> AsyncIterator[bytes]:
+    """POST a streaming completion and yield the upstream bytes untouched"""
+    # identity encoding keeps the raw bytes forwardable as-is
+    request_headers = {
+        "Accept": "text/event-stream",
+        "Accept-Encoding": "identity",
+        "Content-Type": "application/json",
+    }
+    if headers:
+        request_headers.update(headers)
+    async with http_client.stream("POST", url, content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                                  headers=request_headers) as upstream:
+        if upstream.status_code != 200:
+            body = await upstream.aread()
+            raise httpx.HTTPStatusError(
+                f"Upstream returned {upstream.status_code}: {body[:500].decode('utf-8', 'replace')}",
+                request=upstream.request,
+                response=upstream,
+            )
+        async for data in upstream.aiter_raw():
+            scanner.feed(data)
+            yield data
@@ -0,0 +1,166 @@
+"""
+Adaptive coalescing of streamed chunks into fewer SSE frames
+"""
+import asyncio
+import re
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+# A raw SSE read carries the first token once it has a non-empty content delta
+_RAW_CONTENT = re.compile(rb'"content":\s*"[^"]')
+
+
+class _Reader:
+    """Pulls the source in its own task so items pile up while the consumer waits out a window"""
+
+    def __init__(self, size: Callable[[Any], int], max_bytes: int):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.items: List[Any] = []
+        self.buffered = 0
+        self.finished = False
+        self.error: Optional[Exception] = None
+        # Whether the consumer wants to hear about every item or only a full budget
+        self.wake_on_item = True
+        self._wakeup: Optional[asyncio.Future] = None
+        self._resume: Optional[asyncio.Future] = None
+
+    async def run(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for item in source:
+                self.items.append(item)
+                self.buffered += self.size(item)
+                if self.wake_on_item or self.buffered >= self.max_bytes:
+                    self._wake()
+                if self.buffered >= 4 * self.max_bytes:
+                    # The client is not keeping up; stop reading so backpressure reaches the upstream
+                    self._resume = asyncio.get_running_loop().create_future()
+                    await self._resume
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._wake()
+
+    def _wake(self) -> None:
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def wait(self, deadline: Optional[float] = None) -> None:
+        """Sleep until woken by the reader or, if given, the loop time `deadline`"""
+        loop = asyncio.get_running_loop()
+        self._wakeup = loop.create_future()
+        timer = loop.call_at(deadline, self._wake) if deadline is not None else None
+        try:
+            await self._wakeup
+        finally:
+            self._wakeup = None
+            if timer is not None:
+                timer.cancel()
+
+    def take(self) -> List[Any]:
+        items, self.items, self.buffered = self.items, [], 0
+        if self._resume is not None and not self._resume.done():
+            self._resume.set_result(None)
+        return items
+
+
+async def coalesce(source: AsyncIterator[Any], window: float, max_bytes: int,
+                   can_merge: Callable[[Any], bool], merge: Callable[[Any, Any], Any],
+                   size: Callable[[Any], int], has_content: Callable[[Any], bool]) -> AsyncIterator[Any]:
+    """Merge items that arrive within `window` seconds of the last flush, up to `max_bytes`
+
+    Everything up to and including the first content item is forwarded immediately so
+    TTFT is unchanged, and a slow stream (gaps longer than the window) is never delayed.
+    """
+    loop = asyncio.get_running_loop()
+    reader = _Reader(size, max_bytes)
+    task = asyncio.ensure_future(reader.run(source))
+    primed = False
+    last_flush = float("-inf")
+
+    try:
+        while True:
+            if not reader.items and not reader.finished:
+                reader.wake_on_item = True
+                await reader.wait()
+            deadline = last_flush + window
+            if primed and not reader.finished and reader.buffered < max_bytes and loop.time() < deadline:
+                reader.wake_on_item = False
+                await reader.wait(deadline)
+
+            items = reader.take()
+            if not items and reader.finished:
+                break
+
+            merged = None
+            mergeable = False
+            for item in items:
+                if not primed:
+                    primed = has_content(item)
+                    yield item
+                elif merged is not None and mergeable and can_merge(item):
+                    merged = merge(merged, item)
+                else:
+                    if merged is not None:
+                        yield merged
+                    merged, mergeable = item, can_merge(item)
+            if merged is not None:
+                yield merged
+            last_flush = loop.time()
+
+        if reader.error is not None:
+            raise reader.error
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def _chunk_content(chunk: Any) -> Optional[str]:
+    """Content of a plain content-only delta, else None"""
+    if getattr(chunk, "usage", None) is not None or len(chunk.choices) != 1:
+        return None
+    choice = chunk.choices[0]
+    delta = choice.delta
+    # The role is only meaningful on the first delta, which is never merged
+    if choice.finish_reason is not None or delta.tool_calls or delta.function_call:
+        return None
+    return delta.content
+
+
+def _merge_chunks(pending: Any, chunk: Any) -> Any:
+    pending.choices[0].delta.content += chunk.choices[0].delta.content
+    return pending
+
+
+def _chunk_size(chunk: Any) -> int:
+    content = chunk.choices[0].delta.content if chunk.choices else None
+    return len(content.encode("utf-8")) if content else 0
+
+
+def coalesce_chunks(chunks: AsyncIterator[Any], window: float, max_bytes: int) -> AsyncIterator[Any]:
+    """Merge consecutive SDK content deltas into one OpenAI-compatible chunk"""
+    return coalesce(
+        chunks, window, max_bytes,
+        can_merge=lambda chunk: bool(_chunk_content(chunk)),
+        merge=_merge_chunks,
+        size=_chunk_size,
+        has_content=lambda chunk: bool(chunk.choices and chunk.choices[0].delta.content),
+    )
+
+
+def coalesce_raw(data: AsyncIterator[bytes], window: float, max_bytes: int) -> AsyncIterator[bytes]:
+    """Batch raw SSE reads into fewer writes; events are left byte-for-byte intact"""
+    return coalesce(
+        data, window, max_bytes,
+        can_merge=lambda chunk: True,
+        merge=lambda pending, chunk: pending + chunk,
+        size=len,
+        has_content=lambda chunk: _RAW_CONTENT.search(chunk) is not None,
+    )
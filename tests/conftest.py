@@ -0,0 +1,96 @@
+"""
+main.py served in-process against a fake LMStudio; nothing here needs a network
+"""
+import os
+import sys
+
+# Set before main is imported: one backend, no background probing, quiet logs
+os.environ.update({
+    "LMSTUDIO_BACKENDS": "http://upstream-a/v1",
+    "UPSTREAM_PROBE_INTERVAL": "0",
+    "RESPONSE_CACHE_ENABLED": "true",
+    "LOG_REQUEST": "off",
+    "LOG_CHUNKS": "off",
+    "LOG_SUMMARY": "off",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import Callable, List, Optional
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+
+import main
+from bench_passthrough import FrameStream, build_upstream_body
+from response_cache import ResponseCache
+from upstream_pool import Backend, UpstreamPool
+
+
+def sse_response(frames: List[bytes]) -> httpx.Response:
+    """A streaming upstream answer that arrives as exactly these reads"""
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=FrameStream(frames))
+
+
+def split_reads(frames: List[bytes], size: int) -> List[bytes]:
+    """The same bytes cut into reads of `size`, ignoring frame and UTF-8 boundaries"""
+    data = b"".join(frames)
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def chunk_frames(text: str, model: str = "bench-model") -> List[bytes]:
+    """An SSE completion streaming `text` one character per chunk"""
+    frames = []
+    for ch in text:
+        chunk = {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 1700000000, "model": model,
+                 "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}]}
+        frames.append(b"data: " + main.fast_json.dumps(chunk) + b"\n\n")
+    # The finish_reason / usage chunk and [DONE]
+    return frames + build_upstream_body(0)
+
+
+class FakeUpstream:
+    """Installs a pool whose backends answer through `handler(backend_name, request)`"""
+
+    def __init__(self, monkeypatch, handler: Callable[[str, httpx.Request], httpx.Response],
+                 urls: List[str]):
+        self.handler = handler
+        self.requests: List[tuple] = []
+        backends = []
+        for url in urls:
+            backend = Backend(url, http_client=httpx.AsyncClient(transport=httpx.MockTransport(self._route(url))))
+            # Failures must surface at once, not after the SDK's own retries
+            backend.client = AsyncOpenAI(base_url=backend.base_url, api_key="test", http_client=backend.http,
+                                         max_retries=0)
+            backends.append(backend)
+        self.pool = UpstreamPool(backends)
+        monkeypatch.setattr(main, "upstream_pool", self.pool)
+
+    def _route(self, url: str):
+        name = httpx.URL(url).netloc.decode("ascii")
+
+        def handle(request: httpx.Request) -> httpx.Response:
+            self.requests.append((name, request))
+            return self.handler(name, request)
+        return handle
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    def install(handler, urls: Optional[List[str]] = None) -> FakeUpstream:
+        return FakeUpstream(monkeypatch, handler, urls or ["http://upstream-a/v1"])
+    return install
+
+
+@pytest.fixture
+def response_cache(monkeypatch) -> ResponseCache:
+    cache = ResponseCache()
+    monkeypatch.setattr(main, "response_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def client() -> TestClient:
+    # No context manager: startup would start the model catalog and the job workers
+    return TestClient(main.app)
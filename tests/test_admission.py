@@ -0,0 +1,76 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from admission import AdmissionController, ModelGate, QueueFullError, QueueTimeoutError
+
+
+def test_waiters_are_admitted_by_priority_then_arrival():
+    async def scenario():
+        gate = ModelGate("m", concurrency=1, max_queue=8, queue_timeout=5)
+        holder = await gate.acquire(5)
+        order = []
+
+        async def wait(name, priority):
+            ticket = await gate.acquire(priority)
+            order.append(name)
+            ticket.release()
+
+        waiters = [asyncio.ensure_future(wait(name, priority))
+                   for name, priority in [("batch", 10), ("default-1", 5), ("interactive", 0), ("default-2", 5)]]
+        await asyncio.sleep(0)
+        holder.release()
+        await asyncio.gather(*waiters)
+        return order, gate.active
+
+    order, active = asyncio.run(scenario())
+    assert order == ["interactive", "default-1", "default-2", "batch"]
+    assert active == 0
+
+
+def test_full_queue_and_queue_timeout_are_rejected():
+    async def scenario():
+        gate = ModelGate("m", concurrency=1, max_queue=1, queue_timeout=0.05)
+        await gate.acquire(5)
+        waiting = asyncio.ensure_future(gate.acquire(5))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError) as full:
+            await gate.acquire(5)
+        with pytest.raises(QueueTimeoutError):
+            await waiting
+        return full.value.retry_after, gate.stats()
+
+    retry_after, stats = asyncio.run(scenario())
+    assert retry_after >= 1
+    assert (stats["rejected"], stats["timeouts"], stats["queued"], stats["active"]) == (1, 1, 0, 1)
+
+
+def test_full_queue_answers_429_with_retry_after(monkeypatch, response_cache, fake_upstream, client):
+    controller = AdmissionController(default_concurrency=1, max_queue=0, queue_timeout=5)
+    monkeypatch.setattr(main, "admission", controller)
+    upstream = fake_upstream(lambda name, request: httpx.Response(500))
+    controller.gate("bench-model").active = 1  # busy with someone else's request
+
+    response = client.post("/chat/completions", json={"model": "bench-model",
+                                                      "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    assert upstream.requests == []
+
+
+def test_idle_gates_are_dropped_beyond_the_limit():
+    async def scenario():
+        controller = AdmissionController(default_concurrency=1, max_queue=4, queue_timeout=5, max_gates=2)
+        busy = await controller.acquire("busy", 5)
+        for i in range(50):
+            async with controller.slot(f"client-model-{i}", 5):
+                pass
+        return controller, busy
+
+    controller, busy = asyncio.run(scenario())
+    assert len(controller.gates) == 2
+    # The gate holding a slot survives every eviction
+    assert controller.gates["busy"] is busy.gate
+    assert controller.evicted == 49
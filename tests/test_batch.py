@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import httpx
+
+from batch import LINE_TOO_LONG, read_lines, run_batch
+from bench_serialize import build_upstream_body
+
+
+async def chunks_of(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_lines_are_split_across_reads_and_oversized_ones_reported():
+    body = b'{"a": 1}\n' + b"x" * 40 + b'\n\n{"b": 2}\n{"c": 3}'
+
+    async def scenario():
+        return [line async for line in read_lines(chunks_of(body, 7), max_line_bytes=16)]
+
+    assert asyncio.run(scenario()) == [b'{"a": 1}', LINE_TOO_LONG, b"", b'{"b": 2}', b'{"c": 3}']
+
+
+def test_oversized_lines_that_arrive_whole_are_reported():
+    body = b'{"a": 1}\n' + b"y" * 40 + b"\n" + b"z" * 40
+
+    async def scenario():
+        return [line async for line in read_lines(chunks_of(body, 1024), max_line_bytes=16)]
+
+    assert asyncio.run(scenario()) == [b'{"a": 1}', LINE_TOO_LONG, LINE_TOO_LONG]
+
+
+def test_batch_runs_at_most_parallelism_items_and_yields_in_completion_order():
+    in_flight = peak = 0
+
+    async def handle(number, line):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        # Later lines finish first
+        await asyncio.sleep(0.01 * (10 - number))
+        in_flight -= 1
+        return {"line": number}
+
+    async def lines():
+        for i in range(9):
+            yield b"{}" if i != 4 else b"   "
+
+    async def scenario():
+        return [result["line"] async for result in run_batch(lines(), handle, parallelism=3)]
+
+    order = asyncio.run(scenario())
+    assert peak == 3
+    # Line 5 was blank; every other line is answered once, keyed by its line number
+    assert sorted(order) == [1, 2, 3, 4, 6, 7, 8, 9]
+    assert order != sorted(order)
+
+
+def test_malformed_and_failing_lines_get_inline_errors(response_cache, fake_upstream, client):
+    def handler(name, request):
+        if "fail" in json.loads(request.content)["messages"][0]["content"]:
+            return httpx.Response(500, json={"error": "model crashed"})
+        return httpx.Response(200, content=build_upstream_body(1, 20))
+
+    fake_upstream(handler)
+    lines = [
+        json.dumps({"custom_id": "ok", "body": {"model": "bench-model", "messages": [{"role": "user", "content": "hi"}]}}),
+        "{not json",
+        json.dumps(["an", "array"]),
+        json.dumps({"custom_id": "no-messages", "body": {"model": "bench-model"}}),
+        "",
+        json.dumps({"custom_id": "upstream", "model": "bench-model", "messages": [{"role": "user", "content": "fail"}]}),
+    ]
+    response = client.post("/chat/completions/batch", content="\n".join(lines).encode("utf-8"))
+    assert response.status_code == 200
+    results = {r["line"]: r for r in map(json.loads, response.text.splitlines())}
+
+    assert sorted(results) == [1, 2, 3, 4, 6]
+    assert results[1]["status"] == 200 and results[1]["custom_id"] == "ok"
+    assert results[1]["response"]["choices"][0]["message"]["role"] == "assistant"
+    assert [results[n]["status"] for n in (2, 3, 4)] == [400, 400, 400]
+    assert results[4]["custom_id"] == "no-messages"
+    assert results[6]["status"] == 500 and results[6]["custom_id"] == "upstream"
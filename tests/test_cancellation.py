@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import httpx
+
+import main
+from conftest import chunk_frames
+
+REQUEST = {"model": main.MODEL_NAME, "messages": [{"role": "user", "content": "hi"}]}
+
+
+class HangingStream(httpx.AsyncByteStream):
+    """An upstream body that sends `frames`, then nothing until it is closed"""
+
+    def __init__(self, frames=()):
+        self.frames = frames
+        self.closed = False
+
+    async def __aiter__(self):
+        for frame in self.frames:
+            yield frame
+        await asyncio.sleep(30)
+
+    async def aclose(self):
+        self.closed = True
+
+
+def hanging_upstream(fake_upstream, frames=()):
+    body = HangingStream(frames)
+    fake_upstream(lambda name, request: httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=body))
+    return body
+
+
+def post_then_disconnect(body, after: float, probe):
+    """POST /chat/completions straight through ASGI; the client goes away `after` seconds in
+
+    Returns the ASGI messages sent and what `probe()` saw shortly after the app returned,
+    before loop teardown could close anything left open.
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/chat/completions", "raw_path": b"/chat/completions", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"test"), (b"content-type", b"application/json")],
+        "client": ("test", 1), "server": ("test", 80),
+    }
+    pending = [{"type": "http.request", "body": json.dumps(body).encode("utf-8"), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if pending:
+            return pending.pop()
+        await asyncio.sleep(after)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    async def scenario():
+        await asyncio.wait_for(main.app(scope, receive, send), timeout=5)
+        # A cancelled call unwinds on the next turns of the loop
+        await asyncio.sleep(0.01)
+        return probe()
+
+    return sent, asyncio.run(scenario())
+
+
+def cancellations(stream: str, reason: str):
+    return main.upstream_cancellations.labels(main.MODEL_NAME, stream, reason)
+
+
+def test_timeout_aborts_the_upstream_call(monkeypatch, response_cache, fake_upstream, client):
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0.05)
+    upstream = hanging_upstream(fake_upstream)
+    timeouts = cancellations("false", "timeout")
+    before = timeouts.value
+
+    response = client.post("/chat/completions", json=REQUEST)
+    assert response.status_code == 504
+    assert upstream.closed
+    assert timeouts.value == before + 1
+
+
+def test_disconnect_aborts_a_pending_completion(response_cache, fake_upstream):
+    upstream = hanging_upstream(fake_upstream)
+    disconnects = cancellations("false", "client_disconnect")
+    before = disconnects.value
+
+    sent, (closed, cancelled) = post_then_disconnect(
+        REQUEST, 0.05, lambda: (upstream.closed, disconnects.value - before))
+    assert sent[0]["status"] == 499
+    assert closed and cancelled == 1
+
+
+def test_disconnect_mid_stream_closes_the_upstream_stream(response_cache, fake_upstream):
+    upstream = hanging_upstream(fake_upstream, chunk_frames("partial")[:3])
+    disconnects = cancellations("true", "client_disconnect")
+    before = disconnects.value
+
+    sent, (closed, cancelled) = post_then_disconnect(
+        dict(REQUEST, stream=True), 0.1, lambda: (upstream.closed, disconnects.value - before))
+    assert sent[0]["status"] == 200
+    assert b"".join(m.get("body", b"") for m in sent[1:]).count(b"data: ") == 3
+    assert closed and cancelled == 1
+    # A stream cut short is not cached
+    assert response_cache.stats()["entries"] == 0
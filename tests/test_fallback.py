@@ -0,0 +1,53 @@
+import json
+
+import httpx
+import pytest
+
+import main
+from admission import AdmissionController
+from conftest import chunk_frames, sse_response
+from model_router import ModelRouter
+
+
+@pytest.fixture
+def fallbacks(monkeypatch):
+    monkeypatch.setattr(main, "model_router", ModelRouter([], {"primary": ["backup"]}))
+    controller = AdmissionController(default_concurrency=1, max_queue=4, queue_timeout=5)
+    monkeypatch.setattr(main, "admission", controller)
+    return controller
+
+
+def test_stream_fallback_takes_its_own_admission_slot(fallbacks, response_cache, fake_upstream, client):
+    active_during = {}
+
+    def handler(name, request):
+        model = json.loads(request.content)["model"]
+        active_during[model] = {m: gate.active for m, gate in fallbacks.gates.items()}
+        if model == "primary":
+            return httpx.Response(500, json={"error": "model crashed"})
+        return sse_response(chunk_frames("ok", model="backup"))
+
+    fake_upstream(handler)
+    with client.stream("POST", "/chat/completions", json={
+        "model": "primary", "messages": [{"role": "user", "content": "hi"}], "stream": True, "temperature": 0,
+    }) as response:
+        body = b"".join(response.iter_raw())
+
+    assert b'"model":"backup"' in body and b'{"error"' not in body
+    assert active_during["primary"] == {"primary": 1}
+    # The primary's slot was given back before the backup's was taken
+    assert active_during["backup"] == {"primary": 0, "backup": 1}
+    assert {m: gate.active for m, gate in fallbacks.gates.items()} == {"primary": 0, "backup": 0}
+
+
+def test_stream_fallback_reports_a_full_fallback_queue(fallbacks, response_cache, fake_upstream, client, monkeypatch):
+    fake_upstream(lambda name, request: httpx.Response(500, json={"error": "model crashed"}))
+    fallbacks.gate("backup").max_queue = 0
+    fallbacks.gate("backup").active = 1  # busy with someone else's request
+    with client.stream("POST", "/chat/completions", json={
+        "model": "primary", "messages": [{"role": "user", "content": "hi"}], "stream": True,
+    }) as response:
+        body = b"".join(response.iter_raw())
+
+    assert b'{"error"' in body and b"full" in body
+    assert fallbacks.gate("primary").active == 0
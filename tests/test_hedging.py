@@ -0,0 +1,114 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from conftest import chunk_frames, sse_response
+from hedging import Hedger, RetryBudget
+
+URLS = ["http://upstream-a/v1", "http://upstream-b/v1"]
+TEXT = "hedged"
+
+
+class StalledStream(httpx.AsyncByteStream):
+    """An upstream body that sends nothing for `stall` seconds, then the frames"""
+
+    def __init__(self, frames, stall: float):
+        self.frames = frames
+        self.stall = stall
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.stall)
+        for frame in self.frames:
+            yield frame
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def hedger(monkeypatch):
+    hedger = Hedger(RetryBudget(ratio=0.1, min_per_second=1.0), min_delay=0.02, initial_delay=0.05)
+    monkeypatch.setattr(main, "hedger", hedger)
+    return hedger
+
+
+def stream(client):
+    with client.stream("POST", "/chat/completions", json={
+        "model": "bench-model", "messages": [{"role": "user", "content": "hi"}], "stream": True,
+    }) as response:
+        return b"".join(response.iter_raw()).decode("utf-8")
+
+
+def test_stalled_first_attempt_is_hedged_and_the_loser_closed(hedger, response_cache, fake_upstream, client):
+    stalled = StalledStream(chunk_frames(TEXT), stall=5.0)
+    closed_while_streaming = []
+
+    class Winner(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            frames = chunk_frames(TEXT)
+            yield frames[0]
+            # Not at teardown: the loser is closed as soon as the winner's first token is in
+            closed_while_streaming.append(stalled.closed)
+            for frame in frames[1:]:
+                yield frame
+
+    def handler(name, request):
+        # The first call stalls before its first token, the hedge answers at once
+        if len(upstream.requests) == 1:
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stalled)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=Winner())
+
+    upstream = fake_upstream(handler, URLS)
+    body = stream(client)
+
+    assert "data: [DONE]" in body and '{"error"' not in body
+    assert len({name for name, _ in upstream.requests}) == 2
+    assert (hedger.hedges, hedger.hedge_wins, hedger.retries) == (1, 1, 0)
+    assert closed_while_streaming == [True]
+
+
+def test_server_error_before_first_token_is_retried_on_the_other_backend(hedger, response_cache,
+                                                                           fake_upstream, client):
+    def handler(name, request):
+        if len(upstream.requests) == 1:
+            return httpx.Response(500, json={"error": "model crashed"})
+        return sse_response(chunk_frames(TEXT))
+
+    upstream = fake_upstream(handler, URLS)
+    body = stream(client)
+
+    assert "data: [DONE]" in body and '{"error"' not in body
+    first, second = [name for name, _ in upstream.requests]
+    assert first != second
+    assert (hedger.retries, hedger.hedges) == (1, 0)
+
+
+def test_no_hedge_or_retry_once_the_budget_is_spent(hedger, response_cache, fake_upstream, client):
+    hedger.budget = RetryBudget(ratio=0.0, min_per_second=0.0)
+    assert hedger.budget.withdraw()
+
+    upstream = fake_upstream(lambda name, request: httpx.Response(500, json={"error": "model crashed"}), URLS)
+    assert '{"error"' in stream(client)
+    assert len(upstream.requests) == 1
+
+    stalled = StalledStream(chunk_frames(TEXT), stall=0.2)
+    upstream = fake_upstream(lambda name, request: httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, stream=stalled), URLS)
+    assert "data: [DONE]" in stream(client)
+    assert len(upstream.requests) == 1
+
+    assert (hedger.hedges, hedger.retries) == (0, 0)
+    assert hedger.budget.exhausted == 2
+
+
+def test_latency_trackers_are_bounded():
+    hedger = Hedger(RetryBudget(), max_trackers=2)
+    first = hedger.tracker("a:stream")
+    hedger.tracker("b:stream")
+    assert hedger.tracker("a:stream") is first
+    hedger.tracker("c:stream")
+    # The least recently used key goes
+    assert list(hedger.trackers) == ["a:stream", "c:stream"]
@@ -0,0 +1,24 @@
+import asyncio
+
+import main
+from conftest import chunk_frames, sse_response
+from jobs import assemble_completion
+
+
+def test_job_frames_are_measured_and_traced(fake_upstream):
+    fake_upstream(lambda name, request: sse_response(chunk_frames("done")))
+    request = main.ChatCompletionRequest(messages=[main.Message(role="user", content="hi")], model=main.MODEL_NAME,
+                                         stream=True)
+    completed = main.requests_total.labels(main.MODEL_NAME, "true", "200")
+    before = completed.value
+
+    async def run():
+        return [frame async for frame in main.job_frames(request, "job-test", 10, "tenant")]
+
+    frames = asyncio.run(run())
+    result, error = assemble_completion(frames)
+    assert error is None and result["choices"][0]["message"]["content"] == "done"
+    assert completed.value == before + 1
+    assert main.requests_in_flight.labels(main.MODEL_NAME, "true").value == 0
+    trace = main.traces.find("job-test")
+    assert trace is not None and trace.status == "200" and "ttfc" in trace.phases
@@ -0,0 +1,72 @@
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+from log_pipeline import JsonFormatter, NonBlockingQueueHandler, PhaseLogger, TextFormatter
+
+
+def make_record(msg, fields=None):
+    record = logging.LogRecord("proxy", logging.INFO, __file__, 1, msg, None, None)
+    if fields is not None:
+        record.fields = fields
+    return record
+
+
+def test_records_are_dropped_not_waited_on_when_the_queue_is_full():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=2))
+    logger = logging.getLogger("test_log_pipeline.full")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(5):
+            logger.info("event %d", i)
+    finally:
+        logger.removeHandler(handler)
+    assert handler.queue.qsize() == 2 and handler.dropped == 3
+    # Queued as they were logged: the message is formatted later, on the listener thread
+    assert handler.queue.get_nowait().msg == "event %d"
+
+
+def test_formatting_happens_on_the_listener_thread():
+    formatted_on = []
+
+    class Recording(logging.Handler):
+        def emit(self, record):
+            self.format(record)
+            formatted_on.append(threading.current_thread())
+
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, Recording())
+    listener.start()
+    try:
+        NonBlockingQueueHandler(log_queue).handle(make_record("hello"))
+    finally:
+        listener.stop()
+    assert formatted_on and formatted_on[0] is not threading.current_thread()
+
+
+def test_structured_fields_are_formatted_on_one_line():
+    fields = {"request_id": "r1", "model": "qwen", "content": "你好\nworld"}
+    line = JsonFormatter().format(make_record("chat.completed", fields))
+    assert "\n" not in line
+    payload = json.loads(line)
+    assert (payload["event"], payload["request_id"], payload["content"]) == ("chat.completed", "r1", "你好\nworld")
+    assert json.loads(JsonFormatter().format(make_record("plain")))["msg"] == "plain"
+
+    text = TextFormatter().format(make_record("chat.completed", fields))
+    assert text.startswith("INFO:proxy:chat.completed {") and json.loads(text.split(" ", 1)[1]) == fields
+
+
+def test_phase_levels_and_chunk_sampling():
+    logger = logging.getLogger("test_log_pipeline.phases")
+    quiet = PhaseLogger(logger, request_level="off", chunk_level="off", summary_level="summary", chunk_sample_rate=1.0)
+    assert not quiet.enabled("request")
+    assert quiet.enabled("summary") and not quiet.enabled("summary", "full")
+    assert not quiet.sample_chunk()
+
+    every = PhaseLogger(logger, chunk_level="full", chunk_sample_rate=1.0)
+    assert all(every.sample_chunk() for _ in range(100))
+    sampled = PhaseLogger(logger, chunk_level="summary", chunk_sample_rate=0.1)
+    assert 0 < sum(sampled.sample_chunk() for _ in range(2000)) < 500
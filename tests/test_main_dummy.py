@@ -0,0 +1,95 @@
+import asyncio
+import json
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main_dummy
+from main_dummy import ModelSlots, completion_text, parse_distribution
+
+REQUEST = {"model": "dummy-model", "messages": [{"role": "user", "content": "x" * 40}], "max_tokens": 30}
+
+
+@pytest.fixture
+def simulator(monkeypatch) -> TestClient:
+    # No waiting, and every completion runs to max_tokens
+    monkeypatch.setattr(main_dummy, "sample_ttft", lambda rng: 0.0)
+    monkeypatch.setattr(main_dummy, "sample_token_delay", lambda rng: 0.0)
+    monkeypatch.setattr(main_dummy, "sample_output_ratio", lambda rng: 1.0)
+    monkeypatch.setattr(main_dummy, "model_slots", {})
+    return TestClient(main_dummy.app, raise_server_exceptions=False)
+
+
+def data_frames(body: str):
+    return [line[len("data: "):] for line in body.split("\n\n") if line.startswith("data: ")]
+
+
+def test_distributions_parse_and_sample_within_bounds():
+    rng = random.Random(7)
+    assert parse_distribution("0.5")(rng) == 0.5
+    assert parse_distribution("const:2")(rng) == 2.0
+    assert all(1.0 <= parse_distribution("uniform:1,2")(rng) <= 2.0 for _ in range(100))
+    assert all(parse_distribution("normal:0,5")(rng) >= 0.0 for _ in range(100))
+    median = sorted(parse_distribution("lognormal:0.3,0.5")(rng) for _ in range(2001))[1000]
+    assert 0.25 < median < 0.35
+    with pytest.raises(ValueError):
+        parse_distribution("zipf:1")
+
+
+def test_completion_follows_the_plan(simulator):
+    body = simulator.post("/v1/chat/completions", json=REQUEST).json()
+    assert body["choices"][0]["message"]["content"] == completion_text(30)
+    assert body["choices"][0]["finish_reason"] == "length"
+    assert body["usage"] == {"prompt_tokens": 10, "completion_tokens": 30, "total_tokens": 40}
+
+
+def test_stream_sends_every_token_then_usage_and_done(simulator):
+    body = simulator.post("/v1/chat/completions", json=dict(REQUEST, stream=True)).text
+    frames = data_frames(body)
+    assert frames[-1] == "[DONE]"
+    chunks = [json.loads(frame) for frame in frames[:-1]]
+    assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks) == completion_text(30)
+    assert chunks[-1]["choices"][0]["finish_reason"] == "length" and chunks[-1]["usage"]["completion_tokens"] == 30
+
+
+def test_faults_are_forced_by_header(simulator):
+    response = simulator.post("/v1/chat/completions", json=REQUEST, headers={"x-sim-fault": "503"})
+    assert response.status_code == 503 and response.json()["error"]["type"] == "simulated_error"
+
+    # The test client drops a body whose stream raised, so the generator is driven directly
+    request = main_dummy.ChatCompletionRequest(**REQUEST)
+    plan = main_dummy.plan_completion(request)
+    sent = []
+
+    async def disconnected():
+        with pytest.raises(main_dummy.SimulatedDisconnect):
+            async for frame in main_dummy.generate_stream("r1", request, plan, "disconnect"):
+                sent.append(frame)
+
+    asyncio.run(disconnected())
+    frames = data_frames("".join(sent))
+    # Cut off mid-output: no finish_reason, no [DONE]
+    assert 1 < len(frames) < 31 and "[DONE]" not in frames
+    assert all(json.loads(frame)["choices"][0]["finish_reason"] is None for frame in frames)
+
+
+def test_requests_beyond_the_concurrency_cap_queue():
+    async def scenario():
+        slots = ModelSlots(1)
+        release = asyncio.Event()
+
+        async def generate():
+            async with slots:
+                await release.wait()
+
+        tasks = [asyncio.ensure_future(generate()) for _ in range(3)]
+        await asyncio.sleep(0)
+        during = (slots.active, slots.queued)
+        release.set()
+        await asyncio.gather(*tasks)
+        return during, slots.stats()
+
+    during, stats = asyncio.run(scenario())
+    assert during == (1, 2)
+    assert (stats["active"], stats["queued"], stats["served"]) == (0, 0, 3)
@@ -0,0 +1,21 @@
+import httpx
+
+import main
+from bench_serialize import build_upstream_body
+
+
+def test_models_unknown_to_the_proxy_share_one_series(monkeypatch, response_cache, fake_upstream, client):
+    monkeypatch.setattr(main.model_catalog, "model_ids", frozenset({"catalog-model"}))
+    fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(1, 20)))
+    other = main.requests_total.labels(main.OTHER_MODEL_LABEL, "false", "200")
+    before = other.value
+
+    for model in ("made-up-1", "made-up-2", "catalog-model"):
+        response = client.post("/chat/completions", json={"model": model,
+                                                          "messages": [{"role": "user", "content": model}]})
+        assert response.status_code == 200
+
+    assert other.value == before + 2
+    text = client.get("/metrics").text
+    assert 'model="catalog-model"' in text
+    assert "made-up" not in text
@@ -0,0 +1,70 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from model_catalog import ModelCatalog
+
+
+class Models:
+    """What the fake backend lists; `down` makes it answer 500"""
+
+    def __init__(self, *ids):
+        self.ids = list(ids)
+        self.down = False
+
+    def __call__(self, name, request):
+        if self.down:
+            return httpx.Response(500, json={"error": "model server down"})
+        return httpx.Response(200, json={"object": "list", "data": [
+            {"id": model, "object": "model", "created": 0, "owned_by": "lmstudio"} for model in self.ids
+        ]})
+
+
+@pytest.fixture
+def models():
+    return Models("qwen/qwen3-8b")
+
+
+@pytest.fixture
+def catalog(monkeypatch, models, fake_upstream):
+    catalog = ModelCatalog(fake_upstream(models).pool, refresh_interval=0)
+    monkeypatch.setattr(main, "model_catalog", catalog)
+    asyncio.run(catalog.refresh())
+    return catalog
+
+
+def test_if_none_match_is_compared_weakly(catalog, client):
+    response = client.get("/models")
+    etag = response.headers["etag"]
+    assert response.status_code == 200 and etag == catalog.etag
+    assert [m["id"] for m in response.json()["data"]] == ["qwen/qwen3-8b"]
+
+    for if_none_match in (etag, "W/" + etag, f'"stale", {etag}', "*"):
+        response = client.get("/models", headers={"if-none-match": if_none_match})
+        assert response.status_code == 304, if_none_match
+        assert response.headers["etag"] == etag and response.content == b""
+    assert client.get("/models", headers={"if-none-match": '"stale", W/"stale"'}).status_code == 200
+
+
+def test_etag_changes_only_with_the_model_list(models, catalog):
+    etag = catalog.etag
+    asyncio.run(catalog.refresh())
+    assert catalog.etag == etag
+
+    models.ids.append("qwen/qwen3-coder-30b")
+    asyncio.run(catalog.refresh())
+    assert catalog.etag != etag
+    assert catalog.model_ids == {"qwen/qwen3-8b", "qwen/qwen3-coder-30b"}
+
+
+def test_last_good_catalog_is_served_while_upstream_is_down(models, catalog, client):
+    etag = catalog.etag
+    models.down = True
+    asyncio.run(catalog.refresh())
+
+    assert catalog.last_error and catalog.etag == etag
+    response = client.get("/models")
+    assert response.status_code == 200 and response.headers["etag"] == etag
+    assert [m["id"] for m in response.json()["data"]] == ["qwen/qwen3-8b"]
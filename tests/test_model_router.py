@@ -0,0 +1,23 @@
+import httpx
+
+import main
+from bench_serialize import build_upstream_body
+from model_router import ModelRouter, Route
+
+
+def test_forced_route_is_found_by_its_configured_name(monkeypatch, response_cache, fake_upstream, client):
+    router = ModelRouter([Route("Small-Model", "qwen/qwen3-4b", {"model": "never-requested"})])
+    monkeypatch.setattr(main, "model_router", router)
+    upstream = fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(1, 20)))
+
+    def post(route):
+        response = client.post("/chat/completions", headers={"x-model-route": route},
+                               json={"model": "bench-model", "messages": [{"role": "user", "content": route}]})
+        assert response.status_code == 200
+        return response
+
+    assert post(" Small-Model ").headers["x-model-route"] == "Small-Model"
+    assert "x-model-route" not in post("OFF").headers
+    sent = [main.fast_json.loads(request.content)["model"] for _, request in upstream.requests]
+    assert sent == ["qwen/qwen3-4b", "bench-model"]
+    assert router.routed == {"Small-Model": 1}
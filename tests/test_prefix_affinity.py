@@ -0,0 +1,55 @@
+import httpx
+
+from prefix_affinity import PrefixAffinity
+from upstream_pool import Backend, UpstreamPool
+
+
+def make_pool(names=("a", "b", "c")) -> UpstreamPool:
+    return UpstreamPool([Backend(f"http://upstream-{name}/v1", http_client=httpx.AsyncClient()) for name in names])
+
+
+def conversation(turns: int, topic: str = "kv cache"):
+    messages = [{"role": "system", "content": f"You answer questions about {topic}."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+    return messages + [{"role": "user", "content": "next question"}]
+
+
+def test_conversation_sticks_to_the_backend_holding_its_prefix():
+    pool = make_pool()
+    affinity = PrefixAffinity()
+    first = affinity.route(pool, "m", conversation(0))
+    # Other conversations land anywhere in between
+    for topic in ("cats", "dogs", "birds"):
+        affinity.route(pool, "m", conversation(0, topic))
+    assert {affinity.route(pool, "m", conversation(turns)).name for turns in range(1, 8)} == {first.name}
+    assert affinity.stats()["hits"] == 7
+
+
+def test_prefix_moves_when_its_backend_is_ejected():
+    pool = make_pool()
+    affinity = PrefixAffinity()
+    first = affinity.route(pool, "m", conversation(1))
+    first.healthy = False
+
+    moved = affinity.route(pool, "m", conversation(2))
+    assert moved is not first
+    # The conversation now follows the backend it moved to, even once the first one is back
+    first.healthy = True
+    assert affinity.route(pool, "m", conversation(3)) is moved
+
+
+def test_overloaded_backend_sheds_the_prefix_to_the_least_loaded():
+    pool = make_pool()
+    affinity = PrefixAffinity(load_factor=1.25)
+    first = affinity.route(pool, "m", conversation(1))
+    first.in_flight = 5
+
+    overflowed = affinity.route(pool, "m", conversation(2))
+    assert overflowed is not first
+    assert affinity.stats()["overflows"] == 1
+
+    # Under the bound again, the prefix stays where it was moved to
+    first.in_flight = 0
+    assert affinity.route(pool, "m", conversation(3)) is overflowed
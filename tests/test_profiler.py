@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+from profiler import ProfileBusy, StackSampler, watch_event_loop
+
+ADMIN = {"x-admin-token": "secret"}
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    monkeypatch.setattr(main, "DEBUG_ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main, "stack_sampler", StackSampler())
+
+
+def spin_until(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_endpoints_need_the_admin_token(monkeypatch, client):
+    monkeypatch.setattr(main, "DEBUG_ADMIN_TOKEN", "")
+    assert client.get("/debug/profile?seconds=0.1").status_code == 404
+    monkeypatch.setattr(main, "DEBUG_ADMIN_TOKEN", "secret")
+    assert client.get("/debug/profile?seconds=0.1", headers={"x-admin-token": "wrong"}).status_code == 403
+    assert client.get("/debug/asyncio?seconds=0").status_code == 403
+
+
+def test_profile_returns_collapsed_stacks_of_busy_threads(admin, client):
+    stop = threading.Event()
+    busy = threading.Thread(target=spin_until, args=(stop,), name="busy-worker")
+    busy.start()
+    try:
+        response = client.get("/debug/profile?seconds=0.2&interval_ms=5", headers=ADMIN)
+    finally:
+        stop.set()
+        busy.join()
+
+    assert response.status_code == 200 and int(response.headers["x-profile-samples"]) > 0
+    lines = response.text.splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    # Folded format: thread name first, then frames from the root down
+    assert any(line.startswith("busy-worker;") and "spin_until (test_profiler.py:" in line for line in lines)
+
+
+def test_second_profile_at_once_is_refused(admin, client):
+    main.stack_sampler._lock.acquire()
+    try:
+        assert client.get("/debug/profile?seconds=0.1", headers=ADMIN).status_code == 409
+    finally:
+        main.stack_sampler._lock.release()
+    with pytest.raises(ProfileBusy):
+        with main.stack_sampler._lock:
+            main.stack_sampler.sample(0.1)
+
+
+def test_asyncio_view_lists_pending_tasks(admin, client):
+    report = client.get("/debug/asyncio?seconds=0", headers=ADMIN).json()
+    assert report["event_loop"] is None
+    assert report["pending_tasks"] == len(report["tasks"])
+
+
+def test_loop_watch_reports_a_blocking_callback_and_restores_the_loop():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, time.sleep, 0.1)
+        report = await watch_event_loop(0.3, threshold=0.05)
+        return report, loop.get_debug()
+
+    report, debug_after = asyncio.run(scenario())
+    assert not debug_after
+    assert report["slow_callbacks"] and report["slow_callbacks"][0]["duration_ms"] >= 100
+    assert report["stalls"] and report["loop_lag_ms"]["max"] >= 50
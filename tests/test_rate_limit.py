@@ -0,0 +1,67 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import rate_limit
+from rate_limit import SQLiteBuckets
+
+
+def rows(path):
+    with sqlite3.connect(path) as conn:
+        return dict(conn.execute("SELECT key, tokens FROM buckets").fetchall())
+
+
+def test_sqlite_buckets_prune_full_idle_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(rate_limit, "_PRUNE_THRESHOLD", 3)
+    path = str(tmp_path / "buckets.sqlite")
+    buckets = SQLiteBuckets(path)
+    # 100 tokens/s: "idle" refills 50 tokens in half a second; "busy" is in debt for ten seconds
+    for key in ("idle-1", "idle-2", "idle-3"):
+        assert buckets.take(key, 50, 100.0, 100.0) == 0
+    assert buckets.take("busy", 1100, 100.0, 100.0) == 0
+    time.sleep(0.6)
+    buckets.take("new", 1, 100.0, 100.0)
+    assert set(rows(path)) == {"busy", "new"}
+
+
+def test_tenant_header_values_are_hashed_like_keys():
+    tenant = rate_limit.tenant_id({"x-tenant-id": "acme-corp"}, "x-tenant-id")
+    assert tenant.startswith("header:") and "acme-corp" not in tenant
+    assert tenant == rate_limit.tenant_id({"x-tenant-id": " acme-corp "}, "x-tenant-id")
+    assert rate_limit.tenant_id({"authorization": "Bearer sk-secret"}, "x-tenant-id").startswith("key:")
+
+
+def test_shared_snapshot_runs_off_the_event_loop(tmp_path):
+    buckets = SQLiteBuckets(str(tmp_path / "buckets.sqlite"))
+    limiter = rate_limit.TokenRateLimiter(default_limit=600, store=buckets)
+    reader_threads = []
+    snapshot = buckets.snapshot
+
+    def recording_snapshot():
+        reader_threads.append(threading.current_thread())
+        return snapshot()
+
+    buckets.snapshot = recording_snapshot
+
+    async def scenario():
+        await limiter.reserve(rate_limit.tenant_id({"x-tenant-id": "acme-corp"}, "x-tenant-id"), "m", 10, 10)
+        return await limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert reader_threads and reader_threads[0] is not threading.main_thread()
+    assert list(stats["buckets"].values()) == [580.0]
+    assert not any("acme-corp" in key for key in stats["buckets"])
+
+
+def test_counters_of_models_past_the_limit_go_under_other():
+    limiter = rate_limit.TokenRateLimiter(default_limit=1000, max_models=2)
+
+    async def scenario():
+        for model in ("a", "b", "c", "d", "a"):
+            reservation = await limiter.reserve("tenant", model, 1, 1)
+            reservation.settle(2)
+
+    asyncio.run(scenario())
+    assert limiter.granted == {"a": 2, "b": 1, rate_limit.OTHER_MODELS: 2}
+    assert limiter.tokens_used == {"a": 4, "b": 2, rate_limit.OTHER_MODELS: 4}
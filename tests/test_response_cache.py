@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+import main
+from bench_serialize import build_upstream_body
+from conftest import chunk_frames, split_reads, sse_response
+from disk_cache import DiskCache
+from response_cache import CachedCompletion, ResponseCache, StreamRecording, decode_value, encode_value
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def stream(client, **headers):
+    with client.stream("POST", "/chat/completions", headers=headers,
+                       json={"model": "bench-model", "messages": MESSAGES, "stream": True, "temperature": 0}) as response:
+        return response.headers["x-cache"], b"".join(response.iter_raw())
+
+
+def test_recording_with_bytes_frames_round_trips():
+    recording = StreamRecording()
+    recording.add(0.0, b"data: {\"x\": \"\xe4\xbd")  # ends inside a UTF-8 sequence
+    recording.add(0.1, "data: [DONE]\n\n")
+    value, size = decode_value(encode_value(recording))
+    assert value.frames == recording.frames
+    assert size == recording.size
+
+
+def test_passthrough_stream_cached_on_disk(tmp_path, monkeypatch, fake_upstream, client):
+    upstream_bytes = chunk_frames("你好，世界")
+    upstream = fake_upstream(lambda name, request: sse_response(split_reads(upstream_bytes, 7)))
+    store = DiskCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(store=store))
+
+    status, body = stream(client, **{"x-stream-passthrough": "true"})
+    assert status == "MISS"
+    assert body.startswith(b"".join(upstream_bytes))
+    assert main.response_cache.stats()["store_errors"] == 0
+    store.flush()
+    assert store.stats()["entries"] == 1
+
+    # Another worker: empty memory, same file
+    monkeypatch.setattr(main, "response_cache", ResponseCache(store=DiskCache(str(tmp_path / "cache.sqlite"))))
+    status, replayed = stream(client, **{"x-stream-passthrough": "true"})
+    assert status == "HIT"
+    assert replayed.startswith(b"".join(upstream_bytes))
+    assert len(upstream.requests) == 1
+
+
+def test_store_failure_does_not_break_the_stream(monkeypatch, fake_upstream, client):
+    class BrokenStore:
+        def get_entry(self, key):
+            return None
+
+        def set(self, key, value):
+            raise OSError("disk full")
+
+    fake_upstream(lambda name, request: sse_response(chunk_frames("hi")))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(store=BrokenStore()))
+
+    status, body = stream(client)
+    assert status == "MISS"
+    assert b'{"error"' not in body
+    assert b"data: [DONE]\n\n" in body
+    assert main.response_cache.stats()["store_errors"] == 1
+    # The memory copy was kept even though the store write failed
+    assert stream(client)[0] == "HIT"
+
+
+def test_disk_entry_keeps_its_remaining_ttl(tmp_path):
+    store = DiskCache(str(tmp_path / "cache.sqlite"), ttl=5.0)
+    ResponseCache(store=store).set("k", CachedCompletion(b'{"answer":42}'), 13)
+    store.flush()
+
+    reader_threads = []
+    get_entry = store.get_entry
+
+    def recording_get_entry(key):
+        reader_threads.append(threading.current_thread())
+        return get_entry(key)
+
+    store.get_entry = recording_get_entry
+    cache = ResponseCache(ttl=300.0, store=store)
+    assert asyncio.run(cache.get("k")).response == {"answer": 42}
+    # SQLite is read off the event loop's thread
+    assert reader_threads and reader_threads[0] is not threading.main_thread()
+    # Loaded with what is left of the disk entry's 5s, not a fresh 300s
+    assert cache._entries["k"].expires_at - time.monotonic() <= 5.0
+    assert cache.stats()["hits"] == 1
+
+
+def test_only_greedy_requests_are_cached(response_cache, fake_upstream, client):
+    upstream = fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(1, 20)))
+
+    def complete(temperature):
+        response = client.post("/chat/completions", json={"model": "bench-model", "messages": MESSAGES,
+                                                           "temperature": temperature})
+        assert response.status_code == 200
+        return response.headers["x-cache"]
+
+    assert [complete(0.7), complete(0.7)] == ["BYPASS", "BYPASS"]
+    assert [complete(0), complete(0)] == ["MISS", "HIT"]
+    assert len(upstream.requests) == 3
+
+
+def test_hits_send_the_stored_body(monkeypatch, response_cache, fake_upstream, client):
+    fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(2, 50)))
+    encoded = []
+    serialize = main.serialize
+    monkeypatch.setattr(main, "serialize", lambda response, trace=None: encoded.append(1) or serialize(response, trace))
+    request = {"model": "bench-model", "messages": MESSAGES, "temperature": 0}
+
+    miss = client.post("/chat/completions", json=request)
+    hit = client.post("/chat/completions", json=request)
+    assert (miss.headers["x-cache"], hit.headers["x-cache"]) == ("MISS", "HIT")
+    assert hit.content == miss.content
+    assert len(encoded) == 1
+
+
+def test_completion_body_round_trips_through_the_store():
+    body = b'{"id":"x","choices":[{"message":{"content":"\xe4\xbd\xa0\xe5\xa5\xbd"}}],"usage":{"total_tokens":3}}'
+    value, size = decode_value(encode_value(CachedCompletion(body)))
+    assert value.body == body and size == len(body)
+    assert value.response["choices"][0]["message"]["content"] == "你好"
+    assert value.usage == {"total_tokens": 3}
+
+
+def test_stream_cut_short_is_not_cached(response_cache, fake_upstream, client):
+    # Content chunks, then a clean EOF: no finish_reason chunk, no [DONE]
+    upstream = fake_upstream(lambda name, request: sse_response(chunk_frames("你好，世界")[:3]))
+
+    status, body = stream(client)
+    assert status == "MISS"
+    assert b"data: [DONE]" not in body
+    assert b'data: {"error"' in body
+    assert stream(client)[0] == "MISS"
+    assert len(upstream.requests) == 2
+
+
+def test_passthrough_stream_cut_short_is_not_cached(response_cache, fake_upstream, client):
+    upstream = fake_upstream(lambda name, request: sse_response(split_reads(chunk_frames("你好，世界")[:3], 7)))
+
+    assert stream(client, **{"x-stream-passthrough": "true"})[0] == "MISS"
+    assert stream(client, **{"x-stream-passthrough": "true"})[0] == "MISS"
+    assert len(upstream.requests) == 2
+    assert response_cache.stats()["entries"] == 0
+
+
+def test_completion_wire_format_is_the_upstream_object(response_cache, fake_upstream, client):
+    upstream_body = {
+        "id": "chatcmpl-wire", "object": "chat.completion", "created": 1700000000, "model": "bench-model",
+        "system_fingerprint": "fp_1",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "你好", "tool_calls": None},
+                     "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4,
+                  "completion_tokens_details": {"reasoning_tokens": 0}},
+    }
+    fake_upstream(lambda name, request: httpx.Response(200, json=upstream_body))
+    response = client.post("/chat/completions", json={"model": "bench-model", "messages": MESSAGES})
+
+    # Nothing dropped, nothing added: no SDK-style nulls the upstream did not send
+    assert response.json() == upstream_body
+    assert list(response.json()) == list(upstream_body)
+
+
+def test_clearing_the_cache_needs_the_admin_token(monkeypatch, response_cache, client):
+    response_cache.set("k", CachedCompletion(b'{"answer":42}'), 13)
+
+    monkeypatch.setattr(main, "DEBUG_ADMIN_TOKEN", "")
+    assert client.delete("/cache").status_code == 404
+    monkeypatch.setattr(main, "DEBUG_ADMIN_TOKEN", "secret")
+    assert client.delete("/cache").status_code == 403
+    assert client.delete("/cache", headers={"x-admin-token": "wrong"}).status_code == 403
+    assert response_cache.stats()["entries"] == 1
+
+    assert client.delete("/cache", headers={"x-admin-token": "secret"}).status_code == 200
+    assert response_cache.stats()["entries"] == 0
+
+
+def test_disk_stats_are_read_off_the_event_loop(tmp_path, monkeypatch, client):
+    store = DiskCache(str(tmp_path / "cache.sqlite"))
+    on_loop = []
+    stats = store.stats
+
+    def recording_stats():
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return stats()
+
+    monkeypatch.setattr(store, "stats", recording_stats)
+    monkeypatch.setattr(main, "disk_cache", store)
+    response = client.get("/cache/stats")
+    assert response.json()["disk_cache"]["entries"] == 0
+    assert on_loop == [False]
@@ -0,0 +1,77 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from bench_serialize import build_upstream_body
+
+pytest.importorskip("numpy")
+
+from semantic_cache import HashingEmbedder, LMStudioEmbedder, SemanticCache
+
+CONTEXT = [{"role": "system", "content": "You answer FAQ questions."}]
+ASKED = CONTEXT + [{"role": "user", "content": "How do I reset my password?"}]
+PARAPHRASE = CONTEXT + [{"role": "user", "content": "how do i reset my password"}]
+
+
+def lookup(cache, messages, **params):
+    async def run():
+        query = await cache.query("complete", params.get("model", "m"), messages, params.get("max_tokens", 100),
+                                  params.get("temperature", 0.0), params.get("top_p", 1.0))
+
+        async def get(key):
+            return f"answer for {key}"
+        return await cache.lookup(query, get)
+    return asyncio.run(run())[0]
+
+
+@pytest.fixture
+def cache():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.8)
+
+    async def add():
+        cache.add(await cache.query("complete", "m", ASKED, 100, 0.0, 1.0), "k1")
+    asyncio.run(add())
+    return cache
+
+
+def test_paraphrase_hits_in_the_same_scope(cache):
+    assert lookup(cache, PARAPHRASE) == "answer for k1"
+
+
+@pytest.mark.parametrize("params", [
+    {"temperature": 1.5}, {"top_p": 0.5}, {"max_tokens": 50}, {"model": "other"},
+])
+def test_other_sampling_parameters_never_match(cache, params):
+    assert lookup(cache, PARAPHRASE, **params) is None
+
+
+def test_other_context_never_matches(cache):
+    assert lookup(cache, [{"role": "user", "content": "how do i reset my password"}]) is None
+
+
+class SlowEmbedder(HashingEmbedder):
+    name = "slow"
+
+    async def embed(self, text):
+        await asyncio.sleep(1)
+        return self.vector(text)
+
+
+def test_slow_embedder_is_a_skip(monkeypatch, response_cache, fake_upstream, client):
+    cache = SemanticCache(SlowEmbedder(), threshold=0.8, embed_timeout=0.05)
+    monkeypatch.setattr(main, "semantic_cache", cache)
+    fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(1, 20)))
+    response = client.post("/chat/completions", json={"model": "m", "messages": PARAPHRASE, "temperature": 0})
+    assert response.status_code == 200 and response.headers["x-cache"] == "MISS"
+    assert cache.stats()["timeouts"] == 1
+
+
+def test_lmstudio_embedder_does_not_retry(fake_upstream):
+    upstream = fake_upstream(lambda name, request: httpx.Response(503, json={"error": "busy"}))
+    # The SDK's default of two retries would multiply a slow embedding endpoint's latency
+    upstream.pool.backends[0].client = upstream.pool.backends[0].client.with_options(max_retries=2)
+    with pytest.raises(Exception):
+        asyncio.run(LMStudioEmbedder(upstream.pool, "embedder").embed("hello"))
+    assert len(upstream.requests) == 1
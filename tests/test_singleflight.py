@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+from conftest import chunk_frames, sse_response
+from singleflight import STREAM_OVERFLOW_FRAME, SingleFlight, StreamBroadcaster
+
+
+def test_identical_calls_share_one_upstream_call():
+    calls = []
+
+    async def scenario():
+        flight = SingleFlight()
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"answer": 42}
+
+        return await asyncio.gather(flight.do("k", fetch), flight.do("k", fetch)), flight.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == [({"answer": 42}, False), ({"answer": 42}, True)]
+    assert len(calls) == 1 and stats["in_flight"] == 0
+
+
+def test_call_survives_until_its_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            await asyncio.sleep(10)
+
+        first = asyncio.ensure_future(flight.do("k", fetch))
+        second = asyncio.ensure_future(flight.do("k", fetch))
+        await started.wait()
+        call = flight._calls["k"]
+        first.cancel()
+        await asyncio.sleep(0)
+        alive_with_one_waiter = not call.task.cancelled()
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0)
+        return alive_with_one_waiter, call.task.cancelled()
+
+    assert asyncio.run(scenario()) == (True, True)
+
+
+def test_late_subscriber_replays_history_and_slow_one_is_dropped():
+    async def scenario():
+        broadcaster = StreamBroadcaster(buffer_size=4)
+        release = asyncio.Event()
+        closed = []
+
+        async def source():
+            try:
+                yield "a"
+                yield "b"
+                await release.wait()
+                for frame in "cdefgh":
+                    yield frame
+            finally:
+                closed.append(True)
+
+        fast, shared_first = broadcaster.subscribe("k", source)
+        received = [await fast.__anext__(), await fast.__anext__()]
+        late, shared_late = broadcaster.subscribe("k", source)
+        slow, _ = broadcaster.subscribe("k", source)
+        release.set()
+
+        async def drain(frames):
+            return [frame async for frame in frames]
+
+        # The slow subscriber only starts reading once the stream has ended
+        rest, late_frames = await asyncio.gather(drain(fast), drain(late))
+        received += rest
+        slow_frames = await drain(slow)
+        return shared_first, shared_late, received, late_frames, slow_frames, closed
+
+    shared_first, shared_late, received, late_frames, slow_frames, closed = asyncio.run(scenario())
+    assert (shared_first, shared_late) == (False, True)
+    assert received == list("abcdefgh")
+    assert late_frames == list("abcdefgh")
+    assert slow_frames[-1] == STREAM_OVERFLOW_FRAME
+    assert closed == [True]
+
+
+def test_lone_subscriber_slows_the_source_instead_of_being_dropped():
+    async def scenario():
+        broadcaster = StreamBroadcaster(buffer_size=4)
+
+        async def source():
+            # Never suspends, like an upstream whose reads are all buffered already
+            for i in range(50):
+                yield i
+
+        frames, _ = broadcaster.subscribe("k", source)
+        received = []
+        async for frame in frames:
+            received.append(frame)
+            await asyncio.sleep(0)
+        return received, broadcaster.stats()
+
+    received, stats = asyncio.run(scenario())
+    assert received == list(range(50))
+    assert stats["dropped_slow_subscribers"] == 0
+
+
+async def drain(frames):
+    return [frame async for frame in frames]
+
+
+def test_stalled_leader_is_dropped_instead_of_stalling_followers():
+    async def scenario():
+        broadcaster = StreamBroadcaster(buffer_size=4)
+        release = asyncio.Event()
+
+        async def source():
+            yield 0
+            await release.wait()
+            for i in range(1, 50):
+                yield i
+
+        leader, _ = broadcaster.subscribe("k", source)
+        first = await leader.__anext__()
+        follower, shared = broadcaster.subscribe("k", source)
+        release.set()
+
+        # The leader reads nothing while the follower drains the whole stream
+        follower_frames = await asyncio.wait_for(drain(follower), timeout=1.0)
+        leader_frames = [first] + await drain(leader)
+        return shared, leader_frames, follower_frames, broadcaster.stats()
+
+    shared, leader_frames, follower_frames, stats = asyncio.run(scenario())
+    assert shared
+    assert follower_frames == list(range(50))
+    assert leader_frames[-1] == STREAM_OVERFLOW_FRAME
+    assert stats["dropped_slow_subscribers"] == 1
+
+
+def test_long_stream_through_the_proxy_is_not_cut(response_cache, fake_upstream, client):
+    text = "x" * 600
+    fake_upstream(lambda name, request: sse_response(chunk_frames(text)))
+    response = client.post("/chat/completions", json={
+        "model": "bench-model", "messages": [{"role": "user", "content": "long"}], "stream": True})
+    frames = [frame for frame in response.text.split("\n\n") if frame.startswith("data: ")]
+    assert "error" not in response.text
+    assert frames[-1] == "data: [DONE]"
+    content = "".join(json.loads(frame[6:])["choices"][0]["delta"].get("content") or ""
+                      for frame in frames[:-1])
+    assert content == text
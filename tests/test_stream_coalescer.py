@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+from openai.types.chat import ChatCompletionChunk
+
+from conftest import chunk_frames
+from stream_coalescer import coalesce_chunks, coalesce_raw
+
+TEXT = "The quick brown fox jumps over the lazy dog. 你好，世界！" * 2
+
+
+def sdk_chunks(text):
+    """The SDK chunks of an upstream streaming `text`: role, one per character, then finish_reason"""
+    chunks = []
+    for frame in chunk_frames(text):
+        data = frame[6:].strip()
+        if data != b"[DONE]":
+            chunks.append(ChatCompletionChunk.model_validate(json.loads(data)))
+    chunks[0].choices[0].delta.role = "assistant"
+    return chunks
+
+
+async def source(items, gap: float = 0.0, stall_after: int = -1, stall: float = 0.0):
+    for i, item in enumerate(items):
+        if i == stall_after:
+            await asyncio.sleep(stall)
+        elif gap:
+            await asyncio.sleep(gap)
+        else:
+            # Like network reads: the consumer gets a chance to run between items
+            await asyncio.sleep(0)
+        yield item
+
+
+def collect(frames):
+    """[(seconds since start, frame)] of a coalesced stream"""
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        return [(loop.time() - start, frame) async for frame in frames()]
+    return asyncio.run(scenario())
+
+
+def content(chunks):
+    return "".join(c.choices[0].delta.content or "" for c in chunks if c.choices)
+
+
+def test_first_content_token_is_not_held_back():
+    chunks = sdk_chunks(TEXT)
+    # The second token only comes 0.3s later, well inside the 1s window
+    received = collect(lambda: coalesce_chunks(source(chunks, stall_after=2, stall=0.3), 1.0, 4096))
+    offset, first = received[0]
+    assert first.choices[0].delta.content == TEXT[0]
+    assert offset < 0.1
+
+
+def test_content_survives_merging_into_fewer_frames():
+    chunks = sdk_chunks(TEXT)
+    received = collect(lambda: coalesce_chunks(source(chunks), 0.05, 4096))
+    frames = [frame for _, frame in received]
+    assert len(frames) < len(chunks) // 4
+    assert content(frames) == TEXT
+    # The finish_reason chunk is never merged into content
+    assert frames[-1].choices[0].finish_reason == "stop"
+    assert frames[-1].choices[0].delta.content is None
+
+
+def test_slow_stream_is_not_delayed():
+    chunks = sdk_chunks("slow")
+    received = collect(lambda: coalesce_chunks(source(chunks, gap=0.03), 0.01, 4096))
+    assert len(received) == len(chunks)
+    assert content(frame for _, frame in received) == "slow"
+
+
+def test_byte_limit_flushes_before_the_window_ends():
+    chunks = sdk_chunks("x" * 200)
+    received = collect(lambda: coalesce_chunks(source(chunks), 5.0, 20))
+    assert received[-1][0] < 1.0
+    # A frame closes once the limit is reached, one token past it at most
+    assert all(len(frame.choices[0].delta.content or "") <= 21 for _, frame in received)
+    assert content(frame for _, frame in received) == "x" * 200
+
+
+def test_raw_reads_are_batched_byte_for_byte():
+    reads = chunk_frames(TEXT)
+    received = collect(lambda: coalesce_raw(source(reads), 0.05, 1 << 16))
+    frames = [frame for _, frame in received]
+    assert len(frames) < len(reads) // 4
+    assert b"".join(frames) == b"".join(reads)
+    # The first read with content goes out on its own
+    assert frames[0] == reads[0]
@@ -0,0 +1,60 @@
+import httpx
+import pytest
+
+import main
+from bench_serialize import build_upstream_body
+from conftest import chunk_frames, sse_response
+from tracing import Trace, TraceBuffer
+
+REQUEST = {"model": "bench-model", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+
+
+@pytest.fixture
+def traces(monkeypatch) -> TraceBuffer:
+    buffer = TraceBuffer(8)
+    monkeypatch.setattr(main, "traces", buffer)
+    return buffer
+
+
+def phases(server_timing: str):
+    return {part.split(";")[0].strip(): float(part.split("dur=")[1]) for part in server_timing.split(",")}
+
+
+def test_completion_phases_go_out_as_server_timing_and_into_the_buffer(traces, response_cache, fake_upstream,
+                                                                       client):
+    fake_upstream(lambda name, request: httpx.Response(200, content=build_upstream_body(1, 20)))
+    response = client.post("/chat/completions", json=REQUEST)
+    timing = phases(response.headers["server-timing"])
+    assert {"parse", "upstream", "total"} <= set(timing)
+    assert timing["total"] >= timing["upstream"]
+
+    trace = client.get(f"/debug/requests/{response.headers['x-request-id']}").json()
+    assert (trace["status"], trace["cache"], trace["stream"]) == ("200", "MISS", False)
+    assert set(trace["phases_ms"]) >= {"parse", "upstream"}
+    assert client.get("/debug/requests/no-such-request").status_code == 404
+
+
+def test_stream_phases_follow_as_a_trailing_comment(traces, response_cache, fake_upstream, client):
+    fake_upstream(lambda name, request: sse_response(chunk_frames("traced")))
+    with client.stream("POST", "/chat/completions", json=dict(REQUEST, stream=True)) as response:
+        request_id = response.headers["x-request-id"]
+        body = b"".join(response.iter_raw()).decode("utf-8")
+
+    comment = body.rstrip("\n").rsplit("\n\n", 1)[-1]
+    assert comment.startswith(": server-timing ")
+    assert {"ttfc", "total"} <= set(phases(comment[len(": server-timing "):]))
+    trace = traces.find(request_id)
+    assert trace is not None and trace.stream and trace.status == "200"
+
+
+def test_buffer_keeps_the_newest_and_filters_by_duration():
+    buffer = TraceBuffer(3)
+    for i in range(5):
+        trace = Trace(f"r{i}", "m", False, start=0.0)
+        trace.duration = i / 10
+        buffer.add(trace)
+
+    assert [t.request_id for t in buffer.query()] == ["r4", "r3", "r2"]
+    assert [t.request_id for t in buffer.query(min_duration=0.3)] == ["r4", "r3"]
+    assert [t.request_id for t in buffer.query(limit=1)] == ["r4"]
+    assert buffer.find("r0") is None and buffer.recorded == 5
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+from bench_serialize import build_upstream_body
+from model_catalog import ModelCatalog
+
+URLS = ["http://upstream-a/v1", "http://upstream-b/v1"]
+MODELS = {"object": "list", "data": [{"id": "bench-model", "object": "model", "created": 0, "owned_by": "test"}]}
+
+
+@pytest.fixture
+def pool_only(monkeypatch):
+    # One attempt per request, on whichever backend the pool picks
+    monkeypatch.setattr(main, "hedger", None)
+    monkeypatch.setattr(main, "prefix_affinity", None)
+
+
+def test_failing_backend_is_ejected_and_traffic_moves(pool_only, response_cache, fake_upstream, client):
+    def handler(name, request):
+        if name == "upstream-a":
+            return httpx.Response(500, json={"error": "model crashed"})
+        return httpx.Response(200, content=build_upstream_body(1, 20))
+
+    upstream = fake_upstream(handler, URLS)
+    broken = upstream.pool.get("upstream-a")
+    statuses = []
+    for i in range(40):
+        response = client.post("/chat/completions", json={"model": "bench-model",
+                                                          "messages": [{"role": "user", "content": str(i)}]})
+        statuses.append(response.status_code)
+
+    assert not broken.healthy and broken.consecutive_failures == upstream.pool.failure_threshold
+    # Only the failures that ejected it reached the broken backend
+    assert [name for name, _ in upstream.requests].count("upstream-a") == upstream.pool.failure_threshold
+    assert statuses.count(500) == upstream.pool.failure_threshold
+    assert statuses[-5:] == [200] * 5
+
+
+def test_ejected_backend_is_reprobed_once_its_window_ends(fake_upstream):
+    up = {"upstream-a": False, "upstream-b": True}
+
+    def handler(name, request):
+        return httpx.Response(200, json=MODELS) if up[name] else httpx.Response(503, json={"error": "loading"})
+
+    upstream = fake_upstream(handler, URLS)
+    pool = upstream.pool
+    pool.failure_threshold = 1
+    catalog = ModelCatalog(pool, refresh_interval=0)
+    probe = pool.get("upstream-a")
+
+    def probes():
+        return [name for name, _ in upstream.requests].count("upstream-a")
+
+    asyncio.run(catalog.refresh())
+    assert not probe.healthy and probes() == 1
+
+    # Still inside its ejection window: left alone
+    up["upstream-a"] = True
+    asyncio.run(catalog.refresh())
+    assert not probe.healthy and probes() == 1
+
+    # A failed re-probe starts a new window
+    up["upstream-a"] = False
+    probe.ejected_until = time.monotonic()
+    asyncio.run(catalog.refresh())
+    assert not probe.healthy and probes() == 2 and probe.ejected_until > time.monotonic()
+
+    up["upstream-a"] = True
+    probe.ejected_until = time.monotonic()
+    asyncio.run(catalog.refresh())
+    assert probe.healthy and probes() == 3
+    assert pool.available() == pool.backends
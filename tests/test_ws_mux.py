@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import main
+from conftest import chunk_frames, split_reads, sse_response
+from singleflight import StreamBroadcaster
+from ws_mux import MuxSession
+
+TEXT = "你好，世界！"
+
+
+def run_session(frames):
+    """One stream over a MuxSession whose upstream yields `frames`; returns the messages sent"""
+    sent = []
+
+    async def scenario():
+        finished = asyncio.Event()
+
+        async def send(text):
+            message = json.loads(text)
+            sent.append(message)
+            if message["type"] in ("done", "error"):
+                finished.set()
+
+        async def open_stream(stream_id, body):
+            async def upstream():
+                for frame in frames:
+                    yield frame
+            return upstream()
+
+        incoming = [json.dumps({"type": "start", "id": "s1", "request": {}})]
+
+        async def receive():
+            if incoming:
+                return incoming.pop()
+            await finished.wait()
+            raise ConnectionError("client went away")
+
+        try:
+            await MuxSession(send, open_stream).run(receive)
+        except ConnectionError:
+            pass
+
+    asyncio.run(scenario())
+    return sent
+
+
+def content(messages):
+    return "".join(m["data"]["choices"][0]["delta"].get("content") or "" for m in messages if m["type"] == "chunk")
+
+
+def test_split_passthrough_reads_are_reassembled():
+    # Three-byte reads cut both JSON documents and UTF-8 sequences in half
+    sent = run_session(split_reads(chunk_frames(TEXT), 3))
+    assert [m["type"] for m in sent if m["type"] != "chunk"] == ["done"]
+    assert content(sent) == TEXT
+
+
+def test_sdk_frames_pass_unchanged():
+    sent = run_session([frame.decode("utf-8") for frame in chunk_frames(TEXT)])
+    assert content(sent) == TEXT and sent[-1]["type"] == "done"
+
+
+def test_upstream_that_stops_without_done_ends_in_an_error():
+    # The finish_reason chunk and [DONE] never arrive
+    sent = run_session(chunk_frames(TEXT)[:3])
+    assert content(sent) == TEXT[:3]
+    assert sent[-1]["type"] == "error" and sent[-1]["error"]["status"] == 502
+
+
+def test_passthrough_over_websocket(response_cache, fake_upstream, client):
+    # Three-byte reads are far more frames than the shared stream's subscriber buffer holds
+    fake_upstream(lambda name, request: sse_response(split_reads(chunk_frames(TEXT), 3)))
+    with client.websocket_connect("/ws/chat", headers={"x-stream-passthrough": "true"}) as ws:
+        ws.send_text(json.dumps({"type": "start", "id": "a", "request": {
+            "model": "bench-model", "messages": [{"role": "user", "content": "hi"}]}}))
+        messages = []
+        while not messages or messages[-1]["type"] not in ("done", "error"):
+            messages.append(json.loads(ws.receive_text()))
+    assert messages[-1]["type"] == "done"
+    assert content(messages) == TEXT
+
+
+class CountingStream(httpx.AsyncByteStream):
+    """Upstream body that counts how many reads the proxy has pulled"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.reads = 0
+
+    async def __aiter__(self):
+        for frame in self.frames:
+            self.reads += 1
+            yield frame
+
+
+def test_withheld_credit_holds_back_the_upstream(monkeypatch, response_cache, fake_upstream, client):
+    monkeypatch.setattr(main, "stream_broadcaster", StreamBroadcaster(buffer_size=8))
+    text = "x" * 500
+    body = CountingStream(chunk_frames(text))
+    fake_upstream(lambda name, request: httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                                       stream=body))
+    with client.websocket_connect("/ws/chat") as ws:
+        ws.send_text(json.dumps({"type": "start", "id": "a", "window": 4, "request": {
+            "model": "bench-model", "messages": [{"role": "user", "content": "hi"}]}}))
+        messages = [json.loads(ws.receive_text()) for _ in range(4)]
+        time.sleep(0.2)
+        # The window plus the subscriber buffer and a frame or two in flight, not the whole answer
+        assert body.reads < 30
+        ws.send_text(json.dumps({"type": "credit", "id": "a", "frames": 1000}))
+        while messages[-1]["type"] not in ("done", "error"):
+            messages.append(json.loads(ws.receive_text()))
+    assert messages[-1]["type"] == "done"
+    assert content(messages) == text
+
+
+def test_binary_frame_closes_the_connection_as_unsupported_data(client):
+    with client.websocket_connect("/ws/chat") as ws:
+        ws.send_bytes(b'{"type": "start", "id": "s1"}')
+        message = ws.receive()
+    assert message == {"type": "websocket.close", "code": 1003, "reason": ""}
+    assert main.websocket_connections.labels().value == 0
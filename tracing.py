@@ -0,0 +1,107 @@
+"""
+Per-request phase timings, exposed as Server-Timing and kept in a ring buffer for /debug/requests
+"""
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Key under scope["state"] holding the perf_counter() at which the request arrived
+RECEIVED_AT = "trace_received_at"
+
+
+class TraceStartMiddleware:
+    """Stamp the arrival time before the body is read, so body parsing shows up as a phase"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            scope.setdefault("state", {})[RECEIVED_AT] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+def received_at(scope: Scope) -> Optional[float]:
+    return scope.get("state", {}).get(RECEIVED_AT)
+
+
+class Trace:
+    """Named phase durations of one request, in seconds; repeated phases accumulate"""
+
+    __slots__ = ("request_id", "model", "stream", "started_at", "start", "phases", "status", "cache", "duration")
+
+    def __init__(self, request_id: str, model: Optional[str], stream: bool, start: Optional[float] = None):
+        self.request_id = request_id
+        self.model = model
+        self.stream = stream
+        self.start = start if start is not None else time.perf_counter()
+        self.started_at = time.time() - (time.perf_counter() - self.start)
+        self.phases: Dict[str, float] = {}
+        self.status: Optional[str] = None
+        self.cache: Optional[str] = None
+        self.duration: Optional[float] = None
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def since(self, name: str, start: float) -> None:
+        """Record the time from a perf_counter() reading until now"""
+        self.record(name, time.perf_counter() - start)
+
+    def elapsed(self) -> float:
+        return self.duration if self.duration is not None else time.perf_counter() - self.start
+
+    def finish(self, status: str) -> None:
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start
+            self.status = status
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in milliseconds"""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "model": self.model,
+            "stream": self.stream,
+            "started_at": round(self.started_at, 6),
+            "status": self.status,
+            "cache": self.cache,
+            "duration_ms": round(self.elapsed() * 1000, 3),
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+        }
+
+
+class TraceBuffer:
+    """The last `size` finished traces"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._traces: "deque[Trace]" = deque(maxlen=max(size, 0))
+        self.recorded = 0
+
+    def add(self, trace: Trace) -> None:
+        if self.size > 0:
+            self._traces.append(trace)
+            self.recorded += 1
+
+    def find(self, request_id: str) -> Optional[Trace]:
+        for trace in reversed(self._traces):
+            if trace.request_id == request_id:
+                return trace
+        return None
+
+    def query(self, min_duration: float = 0.0, limit: int = 100) -> List[Trace]:
+        """Newest first, only traces that took at least min_duration seconds"""
+        found = []
+        for trace in reversed(self._traces):
+            if len(found) >= limit:
+                break
+            if trace.elapsed() >= min_duration:
+                found.append(trace)
+        return found
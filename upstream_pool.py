@@ -0,0 +1,153 @@
+"""
+Pool of OpenAI-compatible upstream backends with least-outstanding-requests balancing
+"""
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Errors that say something about the backend rather than the request"""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return False
+
+
+class Backend:
+    """One upstream LMStudio / OpenAI-compatible server"""
+
+    def __init__(self, base_url: str, weight: float = 1.0, name: Optional[str] = None,
+                 api_key: str = "lm-studio", http_client: Optional[httpx.AsyncClient] = None):
+        self.base_url = base_url.rstrip("/")
+        self.name = name or httpx.URL(self.base_url).netloc.decode("ascii") or self.base_url
+        self.weight = weight if weight > 0 else 1.0
+        self.api_key = api_key
+        # One connection pool per backend, shared by the SDK and the raw passthrough path
+        self.http = http_client or httpx.AsyncClient(timeout=httpx.Timeout(600.0, connect=10.0))
+        self.client = AsyncOpenAI(base_url=self.base_url, api_key=api_key, http_client=self.http)
+
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_probe: Optional[float] = None
+
+    @property
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.weight
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "ejected_for": max(0.0, round(self.ejected_until - time.monotonic(), 3)) if not self.healthy else 0.0,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "last_error": self.last_error,
+            "last_probe": self.last_probe,
+        }
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class UpstreamPool:
+    """Route requests to the backend with the fewest in-flight requests"""
+
+    def __init__(self, backends: List[Backend], failure_threshold: int = 3, ejection_seconds: float = 30.0):
+        if not backends:
+            raise ValueError("UpstreamPool needs at least one backend")
+        self.backends = backends
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+
+    @classmethod
+    def from_config(cls, spec: str, api_key: str = "lm-studio", **kwargs) -> "UpstreamPool":
+        """Parse "url[|weight],url[|weight],..." into a pool"""
+        backends = []
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            url, _, weight = item.partition("|")
+            backends.append(Backend(url.strip(), weight=float(weight) if weight else 1.0, api_key=api_key))
+        return cls(backends, **kwargs)
+
+    def get(self, name: str) -> Optional[Backend]:
+        for backend in self.backends:
+            if backend.name == name:
+                return backend
+        return None
+
+    def available(self, exclude: Iterable[str] = ()) -> List[Backend]:
+        excluded = set(exclude)
+        return [b for b in self.backends if b.healthy and b.name not in excluded]
+
+    def pick(self, exclude: Iterable[str] = ()) -> Backend:
+        """Least outstanding requests (weighted); fails open when every backend is ejected"""
+        candidates = self.available(exclude)
+        if not candidates:
+            excluded = set(exclude)
+            candidates = [b for b in self.backends if b.name not in excluded]
+        if not candidates:
+            raise NoBackendAvailable("No upstream backend available")
+        best = min(b.load for b in candidates)
+        return random.choice([b for b in candidates if b.load == best])
+
+    @asynccontextmanager
+    async def lease(self, backend: Optional[Backend] = None, exclude: Iterable[str] = ()):
+        """Hold an in-flight slot on a backend for the duration of an upstream call"""
+        backend = backend or self.pick(exclude)
+        backend.in_flight += 1
+        backend.total_requests += 1
+        try:
+            yield backend
+        except Exception as e:
+            if is_backend_failure(e):
+                self.report_failure(backend, e)
+            raise
+        else:
+            self.report_success(backend)
+        finally:
+            backend.in_flight -= 1
+
+    def report_success(self, backend: Backend) -> None:
+        backend.consecutive_failures = 0
+
+    def report_failure(self, backend: Backend, error: BaseException) -> None:
+        backend.consecutive_failures += 1
+        backend.total_failures += 1
+        backend.last_error = f"{type(error).__name__}: {str(error)}"
+        if backend.healthy and backend.consecutive_failures >= self.failure_threshold:
+            backend.healthy = False
+            backend.ejected_until = time.monotonic() + self.ejection_seconds
+            logger.warning(f"Ejected upstream {backend.name} after {backend.consecutive_failures} consecutive failures")
+
+    def mark_healthy(self, backend: Backend) -> None:
+        if not backend.healthy:
+            logger.info(f"Upstream {backend.name} is back, returning it to the pool")
+        backend.healthy = True
+        backend.consecutive_failures = 0
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [b.status() for b in self.backends]
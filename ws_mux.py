@@ -0,0 +1,212 @@
+"""
+Many concurrent completion streams over one WebSocket, with per-stream cancellation and credit flow control
+"""
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class StreamRejected(Exception):
+    """A stream that cannot be started; reported to the client as an error message with `status`"""
+
+    def __init__(self, message: str, status: int, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Stream:
+    """Server side of one stream: its pump task and the frames the client still accepts"""
+
+    def __init__(self, window: int):
+        self.task: Optional[asyncio.Task] = None
+        # 0 turns flow control off for this stream
+        self.window = window
+        self.credit = window
+        self._credited = asyncio.Event()
+        # Set once done or error has been sent
+        self.ended = False
+
+    def grant(self, frames: int) -> None:
+        self.credit += frames
+        self._credited.set()
+
+    async def spend(self) -> None:
+        if not self.window:
+            return
+        while self.credit <= 0:
+            self._credited.clear()
+            await self._credited.wait()
+        self.credit -= 1
+
+
+class MuxSession:
+    """Protocol of one connection; every message is a JSON object with a "type"
+
+    Client to server:
+        {"type": "start", "id": "s1", "request": {...chat completion body...}, "window": 64}
+        {"type": "credit", "id": "s1", "frames": 32}
+        {"type": "cancel", "id": "s1"}
+    Server to client:
+        {"type": "chunk", "id": "s1", "data": {...chat.completion.chunk...}}
+        {"type": "done", "id": "s1"}
+        {"type": "error", "id": "s1", "error": {"status": 429, "message": "...", "retry_after": 3}}
+        {"type": "cancelled", "id": "s1"}
+
+    A stream sends at most `window` chunks beyond the credit the client granted, so a
+    slow reader holds back its own upstream generation rather than the connection.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[None]],
+                 open_stream: Callable[[str, Dict[str, Any]], Awaitable[AsyncIterator[Union[str, bytes]]]],
+                 max_streams: int = 64, window: int = 64, send_buffer: int = 256):
+        self._send = send
+        self._open_stream = open_stream
+        self.max_streams = max_streams
+        self.window = window
+        self.streams: Dict[str, _Stream] = {}
+        # One writer drains this queue; a full queue pauses every pump until the socket catches up
+        self._outbox: "asyncio.Queue[str]" = asyncio.Queue(maxsize=send_buffer)
+        self.started = 0
+        self.cancelled = 0
+
+    async def run(self, receive: Callable[[], Awaitable[str]]) -> None:
+        """Serve until the client disconnects; every open stream is cancelled then"""
+        writer = asyncio.ensure_future(self._write())
+        try:
+            while True:
+                text = await receive()
+                if writer.done():
+                    # The socket is gone; the writer's error says why
+                    writer.result()
+                    return
+                await self._dispatch(text)
+        finally:
+            for stream in list(self.streams.values()):
+                if stream.task is not None:
+                    stream.task.cancel()
+            tasks = [s.task for s in self.streams.values() if s.task is not None]
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.cancel()
+            try:
+                await writer
+            except BaseException:
+                pass
+
+    async def _write(self) -> None:
+        while True:
+            await self._send(await self._outbox.get())
+
+    async def _emit(self, message_type: str, stream_id: Optional[str], **fields: Any) -> None:
+        await self._outbox.put(json.dumps({"type": message_type, "id": stream_id, **fields}, ensure_ascii=False))
+
+    async def _error(self, stream_id: Optional[str], status: int, message: str,
+                     retry_after: Optional[int] = None) -> None:
+        error: Dict[str, Any] = {"status": status, "message": message}
+        if retry_after is not None:
+            error["retry_after"] = retry_after
+        await self._emit("error", stream_id, error=error)
+
+    async def _dispatch(self, text: str) -> None:
+        try:
+            message = json.loads(text)
+        except ValueError:
+            await self._error(None, 400, "Messages must be JSON objects")
+            return
+        if not isinstance(message, dict):
+            await self._error(None, 400, "Messages must be JSON objects")
+            return
+        message_type = message.get("type")
+        stream_id = message.get("id")
+        if not isinstance(stream_id, str) or not stream_id:
+            await self._error(None, 400, "Every message needs a string id")
+            return
+
+        if message_type == "start":
+            if stream_id in self.streams:
+                await self._error(stream_id, 409, "A stream with this id is already open")
+            elif len(self.streams) >= self.max_streams:
+                await self._error(stream_id, 429, f"At most {self.max_streams} streams per connection")
+            elif not isinstance(message.get("request"), dict):
+                await self._error(stream_id, 400, "start needs a request object")
+            else:
+                window = message.get("window", self.window)
+                stream = self.streams[stream_id] = _Stream(max(0, int(window)) if isinstance(window, int) else self.window)
+                stream.task = asyncio.ensure_future(self._pump(stream_id, stream, message["request"]))
+                self.started += 1
+        elif message_type == "credit":
+            stream = self.streams.get(stream_id)
+            frames = message.get("frames")
+            if stream is not None and isinstance(frames, int) and frames > 0:
+                stream.grant(frames)
+        elif message_type == "cancel":
+            stream = self.streams.get(stream_id)
+            if stream is not None and stream.task is not None:
+                stream.task.cancel()
+        else:
+            await self._error(stream_id, 400, f"Unknown message type {message_type!r}")
+
+    async def _forward(self, stream_id: str, stream: _Stream, prefix: str, events: str) -> bool:
+        """Send the data lines of one or more SSE events; False once the stream has failed"""
+        # Comments and blank lines are dropped
+        for line in events.split("\n"):
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                stream.ended = True
+                await self._emit("done", stream_id)
+                continue
+            if data.startswith('{"error"'):
+                stream.ended = True
+                await self._error(stream_id, 502, str(json.loads(data)["error"]))
+                return False
+            await stream.spend()
+            # The chunk's JSON is forwarded as-is instead of being parsed and re-serialized
+            await self._outbox.put(prefix + data + "}")
+        return True
+
+    async def _pump(self, stream_id: str, stream: _Stream, body: Dict[str, Any]) -> None:
+        frames = None
+        prefix = '{"type":"chunk","id":' + json.dumps(stream_id, ensure_ascii=False) + ',"data":'
+        try:
+            try:
+                frames = await self._open_stream(stream_id, body)
+            except StreamRejected as e:
+                await self._error(stream_id, e.status, str(e), e.retry_after)
+                return
+            pending = b""
+            async for frame in frames:
+                if isinstance(frame, bytes):
+                    # Raw passthrough reads end anywhere, even inside a UTF-8 sequence: only whole events are decoded
+                    pending += frame
+                    end = pending.rfind(b"\n\n")
+                    if end == -1:
+                        continue
+                    events, pending = pending[:end + 2].decode("utf-8"), pending[end + 2:]
+                else:
+                    events = frame
+                if not await self._forward(stream_id, stream, prefix, events):
+                    return
+            if pending:
+                await self._forward(stream_id, stream, prefix, pending.decode("utf-8"))
+            if not stream.ended:
+                # Every stream ends with done or error, even when the upstream just stops
+                await self._error(stream_id, 502, "Upstream stream ended before [DONE]")
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            try:
+                self._outbox.put_nowait(json.dumps({"type": "cancelled", "id": stream_id}))
+            except asyncio.QueueFull:
+                pass
+        except Exception as e:
+            logger.error(f"WebSocket stream {stream_id} failed: {type(e).__name__}: {str(e)}")
+            await self._error(stream_id, 500, str(e))
+        finally:
+            if frames is not None:
+                await frames.aclose()
+            self.streams.pop(stream_id, None)